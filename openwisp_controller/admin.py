@@ -1,9 +1,60 @@
 """
 Base admin classes and mixins
 """
-from django.core.exceptions import PermissionDenied
+from contextlib import contextmanager
+
+from django.conf.urls import url
+from django.contrib.admin.widgets import RelatedFieldWidgetWrapper
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.db.models import Q
+from django.forms import ModelMultipleChoiceField
+from django.http import HttpResponseBadRequest, JsonResponse
+from django.urls import reverse_lazy
 
 from openwisp_utils.admin import MultitenantAdminMixin as BaseMultitenantAdminMixin
+from openwisp_utils.admin import MultitenantOrgFilter as BaseMultitenantOrgFilter
+
+from .widgets import AutocompleteSelect, AutocompleteSortedCheckboxSelectMultiple
+
+
+def get_organizations_pk(request):
+    """
+    returns the primary keys of the organizations the
+    user of ``request`` is associated with; the value is
+    computed once and memoized on the request, so that
+    querysets, form fields and list filters rendered in the
+    same request don't repeat the ``OrganizationUser`` query
+    """
+    try:
+        return request._organizations_pk
+    except AttributeError:
+        orgs_pk = [pk for pk, in request.user.organizations_pk]
+        request._organizations_pk = orgs_pk
+        return orgs_pk
+
+
+@contextmanager
+def memoized_organizations(request):
+    """
+    replaces the lazy ``request.user.organizations_pk`` queryset
+    (embedded as a subquery wherever it's used) with the primary
+    keys returned by ``get_organizations_pk`` while the block runs,
+    so that the base implementations of openwisp_utils can be reused
+    """
+    user = request.user
+    if user.is_superuser:
+        yield
+        return
+    missing = object()
+    previous = user.__dict__.get('organizations_pk', missing)
+    user.__dict__['organizations_pk'] = get_organizations_pk(request)
+    try:
+        yield
+    finally:
+        if previous is missing:
+            del user.__dict__['organizations_pk']
+        else:
+            user.__dict__['organizations_pk'] = previous
 
 
 class OrgVersionMixin(object):
@@ -19,9 +70,121 @@ class OrgVersionMixin(object):
 
 class MultitenantAdminMixin(OrgVersionMixin, BaseMultitenantAdminMixin):
     """
-    openwisp_utils.admin.MultitenantAdminMixin + OrgVersionMixin
+    openwisp_utils.admin.MultitenantAdminMixin + OrgVersionMixin,
+    organizations of the user are looked up once per request;
+    relations listed in ``autocomplete_fields`` are rendered with
+    autocomplete widgets (the admin of the related model must
+    include ``AutocompleteAdminMixin``)
+    """
+    autocomplete_fields = ()
+
+    def get_queryset(self, request):
+        with memoized_organizations(request):
+            return super(MultitenantAdminMixin, self).get_queryset(request)
+
+    def _edit_form(self, request, form):
+        self._set_autocomplete_widgets(form)
+        with memoized_organizations(request):
+            super(MultitenantAdminMixin, self)._edit_form(request, form)
+
+    def _set_autocomplete_widgets(self, form):
+        fields = form.base_fields
+        for field_name in self.autocomplete_fields:
+            # each relation may be readonly
+            # and not present in field list
+            if field_name not in fields:
+                continue
+            field = fields[field_name]
+            opts = field.queryset.model._meta
+            url_name = '{0}_{1}_autocomplete'.format(opts.app_label, opts.model_name)
+            url = reverse_lazy('{0}:{1}'.format(self.admin_site.name, url_name))
+            if isinstance(field, ModelMultipleChoiceField):
+                widget = AutocompleteSortedCheckboxSelectMultiple(url)
+            else:
+                widget = AutocompleteSelect(url)
+            widget.choices = field.choices
+            if isinstance(field.widget, RelatedFieldWidgetWrapper):
+                field.widget.widget = widget
+            else:
+                field.widget = widget
+
+
+class MultitenantOrgFilter(BaseMultitenantOrgFilter):
+    """
+    openwisp_utils.admin.MultitenantOrgFilter which
+    looks up organizations of the user once per request
+    """
+    def field_choices(self, field, request, model_admin):
+        if request.user.is_superuser:
+            return super(MultitenantOrgFilter, self).field_choices(field, request, model_admin)
+        return field.get_choices(include_blank=False,
+                                 limit_choices_to={self.multitenant_lookup: get_organizations_pk(request)})
+
+
+class MultitenantRelatedOrgFilter(MultitenantOrgFilter):
+    """
+    openwisp_utils.admin.MultitenantRelatedOrgFilter which
+    looks up organizations of the user once per request
+    """
+    multitenant_lookup = 'organization__in'
+
+
+class AutocompleteAdminMixin(object):
+    """
+    adds a paginated JSON endpoint used by the autocomplete widgets
+    of relations pointing to the model of this admin;
+    non superusers get only the objects of their organizations
+    and shared objects, like ``multitenant_shared_relations``
     """
-    pass
+    autocomplete_search_fields = ('name',)
+    autocomplete_page_size = 20
+
+    def get_urls(self):
+        info = (self.model._meta.app_label, self.model._meta.model_name)
+        return [
+            url(r'^autocomplete/$',
+                self.admin_site.admin_view(self.autocomplete_view),
+                name='{0}_{1}_autocomplete'.format(*info)),
+        ] + super(AutocompleteAdminMixin, self).get_urls()
+
+    def get_autocomplete_queryset(self, request):
+        qs = self.model._default_manager.all()
+        if not request.user.is_superuser:
+            orgs_pk = get_organizations_pk(request)
+            qs = qs.filter(Q(organization__in=orgs_pk) | Q(organization=None))
+        organization = request.GET.get('organization')
+        if organization:
+            qs = qs.filter(Q(organization=organization) | Q(organization=None))
+        query = request.GET.get('q', '').strip()
+        if query:
+            q = Q()
+            for field_name in self.autocomplete_search_fields:
+                q |= Q(**{'{0}__icontains'.format(field_name): query})
+            qs = qs.filter(q)
+        return qs.order_by(*self.autocomplete_search_fields)
+
+    def autocomplete_view(self, request):
+        """
+        returns a page of objects matching the ``q`` parameter,
+        like django's autocomplete view it requires
+        the change permission on the model of this admin
+        """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        try:
+            page = max(int(request.GET.get('page', 1)), 1)
+        except ValueError:
+            return HttpResponseBadRequest()
+        size = self.autocomplete_page_size
+        offset = (page - 1) * size
+        try:
+            # fetch one more object to know whether there's a next page
+            objects = list(self.get_autocomplete_queryset(request)[offset:offset + size + 1])
+        # invalid organization parameter
+        except (ValueError, ValidationError):
+            return HttpResponseBadRequest()
+        results = [{'id': str(obj.pk), 'text': str(obj)} for obj in objects[:size]]
+        return JsonResponse({'results': results, 'more': len(objects) > size})
 
 
 class AlwaysHasChangedMixin(object):
@@ -1,19 +1,102 @@
+import codecs
 import json
 
 from django import forms
-from django.contrib import admin
-from django.urls import reverse
+from django.conf.urls import url
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.db.models import Q
+from django.http import Http404, HttpResponseRedirect, StreamingHttpResponse
+from django.template.response import TemplateResponse
+from django.urls import reverse, reverse_lazy
+from django.utils.timesince import timesince
+from django.utils.translation import ugettext_lazy as _
 from django_netjsonconfig import settings as django_netjsonconfig_settings
 from django_netjsonconfig.base.admin import (AbstractConfigForm, AbstractConfigInline, AbstractDeviceAdmin,
                                              AbstractTemplateAdmin, AbstractVpnAdmin, AbstractVpnForm,
                                              BaseForm)
+from sortedm2m.forms import SortedMultipleChoiceField
 
 from openwisp_users.admin import OrganizationAdmin as BaseOrganizationAdmin
 from openwisp_users.models import Organization
-from openwisp_utils.admin import MultitenantOrgFilter, MultitenantRelatedOrgFilter
 
-from ..admin import AlwaysHasChangedMixin, MultitenantAdminMixin
+from ..admin import (AlwaysHasChangedMixin, AutocompleteAdminMixin, MultitenantAdminMixin,
+                     MultitenantOrgFilter, MultitenantRelatedOrgFilter, get_organizations_pk)
+from ..widgets import AutocompleteSortedCheckboxSelectMultiple
+from .importer import DeviceImporter
 from .models import Config, Device, OrganizationConfigSettings, Template, Vpn
+from .preview import get_preview, get_preview_key, iter_output, paginate_output, set_preview
+
+
+class PreviewCacheMixin(object):
+    """
+    caches the rendered previews (see ``preview``), so that posting
+    the same form again does not render the configuration again;
+    large outputs are split in pages which are loaded from the cache
+    (``?key=<key>&page=<n>``) and the full output can be streamed
+    as plain text (``?key=<key>&raw=1``)
+    """
+    class Media:
+        js = ('openwisp-controller/js/preview.js',)
+
+    def preview_view(self, request):
+        if request.method == 'GET' and 'key' in request.GET:
+            return self._cached_preview_view(request)
+        if request.method != 'POST':
+            return super(PreviewCacheMixin, self).preview_view(request)
+        try:
+            key = get_preview_key(request, Template)
+        except ValidationError:
+            return super(PreviewCacheMixin, self).preview_view(request)
+        output = get_preview(key)
+        if output is not None:
+            return self._get_preview_response(request, key, output)
+        response = super(PreviewCacheMixin, self).preview_view(request)
+        context = getattr(response, 'context_data', None)
+        # errors are not cached
+        if not context or context['error']:
+            return response
+        set_preview(key, context['output'])
+        return self._get_preview_response(request, key, context['output'], response)
+
+    def _cached_preview_view(self, request):
+        key = request.GET['key']
+        output = get_preview(key)
+        if output is None:
+            raise Http404()
+        if request.GET.get('raw'):
+            return StreamingHttpResponse(iter_output(output), content_type='text/plain')
+        try:
+            page = int(request.GET.get('page', 1))
+        except ValueError:
+            page = 1
+        return self._get_preview_response(request, key, output, page=page)
+
+    def _get_preview_response(self, request, key, output, response=None, page=1):
+        if response is None:
+            opts = self.model._meta
+            context = self.admin_site.each_context(request)
+            context.update({
+                'is_popup': True,
+                'opts': opts,
+                'change': False,
+                'media': self.media,
+                'error': None,
+            })
+            response = TemplateResponse(request, self.preview_template or [
+                'admin/%s/%s/preview.html' % (opts.app_label, opts.model_name),
+                'admin/%s/preview.html' % opts.app_label
+            ], context)
+        page_output, page, num_pages = paginate_output(output, page)
+        response.context_data.update({
+            'output': page_output,
+            'page': page,
+            'num_pages': num_pages,
+            'preview_key': key,
+            'preview_url': request.path,
+        })
+        return response
 
 
 class ConfigForm(AlwaysHasChangedMixin, AbstractConfigForm):
@@ -31,9 +114,27 @@ class ConfigInline(MultitenantAdminMixin, AbstractConfigInline):
     form = ConfigForm
     extra = 0
     multitenant_shared_relations = ('templates',)
+    autocomplete_fields = ('templates',)
 
 
-class DeviceAdmin(MultitenantAdminMixin, AbstractDeviceAdmin):
+class BulkTemplatesForm(forms.Form):
+    templates = SortedMultipleChoiceField(queryset=Template.objects.none(),
+                                          required=False,
+                                          label=_('templates'),
+                                          help_text=_('configuration templates, applied from '
+                                                      'first to last'))
+
+
+class DeviceImportForm(forms.Form):
+    organization = forms.ModelChoiceField(queryset=Organization.objects.none(),
+                                          label=_('organization'))
+    format = forms.ChoiceField(choices=(('csv', _('CSV')),
+                                        ('netjson', _('NetJSON (one object per line)'))),
+                               label=_('format'))
+    file = forms.FileField(label=_('file'))
+
+
+class DeviceAdmin(MultitenantAdminMixin, PreviewCacheMixin, AbstractDeviceAdmin):
     inlines = [ConfigInline]
     list_filter = [('organization', MultitenantOrgFilter),
                    'config__backend',
@@ -41,6 +142,9 @@ class DeviceAdmin(MultitenantAdminMixin, AbstractDeviceAdmin):
                    'config__status',
                    'created']
     list_select_related = ('config', 'organization')
+    actions = ['assign_templates']
+    change_list_template = 'admin/config/device/change_list.html'
+    import_errors_shown = 20
 
     def _get_default_template_urls(self):
         """
@@ -62,6 +166,114 @@ class DeviceAdmin(MultitenantAdminMixin, AbstractDeviceAdmin):
         extra_context = self.get_extra_context()
         return super(DeviceAdmin, self).add_view(request, form_url, extra_context)
 
+    def _get_bulk_templates_form(self, request):
+        form = BulkTemplatesForm(request.POST if request.POST.get('apply') else None)
+        field = form.fields['templates']
+        queryset = Template.objects.all()
+        if not request.user.is_superuser:
+            queryset = queryset.filter(Q(organization__in=get_organizations_pk(request)) |
+                                       Q(organization=None))
+        field.queryset = queryset
+        field.widget = AutocompleteSortedCheckboxSelectMultiple(
+            reverse_lazy('{0}:config_template_autocomplete'.format(self.admin_site.name))
+        )
+        field.widget.choices = field.choices
+        return form
+
+    def assign_templates(self, request, queryset):
+        """
+        replaces the templates of the selected devices
+        (see ``Config.bulk_set_templates``)
+        """
+        form = self._get_bulk_templates_form(request)
+        if form.is_valid():
+            configs = Config.objects.filter(device__in=queryset.values('pk'))
+            try:
+                count = Config.bulk_set_templates(configs, form.cleaned_data['templates'])
+            except ValidationError as e:
+                for name, errors in sorted(e.message_dict.items()):
+                    self.message_user(request, '{0}: {1}'.format(name, ' '.join(errors)),
+                                      messages.ERROR)
+            else:
+                self.message_user(request,
+                                  _('The templates of {0} devices have been updated').format(count),
+                                  messages.SUCCESS)
+            return None
+        context = self.admin_site.each_context(request)
+        context.update({
+            'title': _('Assign templates'),
+            'opts': self.model._meta,
+            'form': form,
+            'media': self.media + form.media,
+            'count': queryset.count(),
+            'selected': request.POST.getlist(helpers.ACTION_CHECKBOX_NAME),
+            'select_across': request.POST.get('select_across') == '1',
+            'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+        })
+        return TemplateResponse(request, 'admin/config/device/assign_templates.html', context)
+
+    assign_templates.short_description = _('Assign templates to the selected devices')
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        matches the words of ``search_term`` against the normalized
+        ``search`` field (see ``Device.get_search_query``), in addition
+        to the default lookups on ``search_fields`` (eg: key, model)
+        """
+        if not search_term:
+            return queryset, False
+        results, use_distinct = super(DeviceAdmin, self).get_search_results(request,
+                                                                            queryset,
+                                                                            search_term)
+        return queryset.filter(Device.get_search_query(search_term)) | results, use_distinct
+
+    def get_urls(self):
+        info = (self.model._meta.app_label, self.model._meta.model_name)
+        return [
+            url(r'^import/$',
+                self.admin_site.admin_view(self.import_view),
+                name='{0}_{1}_import'.format(*info)),
+        ] + super(DeviceAdmin, self).get_urls()
+
+    def import_view(self, request):
+        """
+        imports devices from an uploaded file (see ``importer``)
+        """
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        form = DeviceImportForm(request.POST or None, request.FILES or None)
+        organizations = Organization.objects.filter(is_active=True)
+        if not request.user.is_superuser:
+            organizations = organizations.filter(pk__in=get_organizations_pk(request))
+        form.fields['organization'].queryset = organizations
+        if form.is_valid():
+            importer = DeviceImporter(form.cleaned_data['organization'])
+            stream = codecs.iterdecode(form.cleaned_data['file'], 'utf-8')
+            try:
+                importer.run(stream, form.cleaned_data['format'])
+            except UnicodeDecodeError:
+                form.add_error('file', _('The file must be encoded in UTF-8'))
+            else:
+                self.message_user(request,
+                                  _('{0} devices have been imported').format(importer.created),
+                                  messages.SUCCESS if importer.created else messages.WARNING)
+                for line, error in importer.errors[:self.import_errors_shown]:
+                    self.message_user(request, _('line {0}: {1}').format(line, error), messages.ERROR)
+                if importer.error_count > self.import_errors_shown:
+                    self.message_user(request,
+                                      _('{0} more errors').format(importer.error_count -
+                                                                  self.import_errors_shown),
+                                      messages.ERROR)
+                info = (self.model._meta.app_label, self.model._meta.model_name)
+                return HttpResponseRedirect(reverse('admin:{0}_{1}_changelist'.format(*info)))
+        context = self.admin_site.each_context(request)
+        context.update({
+            'title': _('Import devices'),
+            'opts': self.model._meta,
+            'form': form,
+        })
+        return TemplateResponse(request, 'admin/config/device/import.html', context)
+
 
 DeviceAdmin.list_display.insert(1, 'organization')
 DeviceAdmin.fields.insert(1, 'organization')
@@ -72,9 +284,11 @@ class TemplateForm(BaseForm):
         model = Template
 
 
-class TemplateAdmin(MultitenantAdminMixin, AbstractTemplateAdmin):
+class TemplateAdmin(MultitenantAdminMixin, AutocompleteAdminMixin, PreviewCacheMixin,
+                    AbstractTemplateAdmin):
     form = TemplateForm
     multitenant_shared_relations = ('vpn',)
+    autocomplete_fields = ('vpn',)
 
 
 TemplateAdmin.list_display.insert(1, 'organization')
@@ -87,15 +301,28 @@ class VpnForm(AbstractVpnForm):
         model = Vpn
 
 
-class VpnAdmin(MultitenantAdminMixin, AbstractVpnAdmin):
+class VpnAdmin(MultitenantAdminMixin, AutocompleteAdminMixin, AbstractVpnAdmin):
     form = VpnForm
     multitenant_shared_relations = ('ca', 'cert')
+    autocomplete_fields = ('ca', 'cert')
+    readonly_fields = ('dh_status',)
+
+    def dh_status(self, obj):
+        if not obj.pk:
+            return '-'
+        if obj.dh_pending:
+            return _('generating (started {0} ago), reload the page to check '
+                     'progress').format(timesince(obj.modified))
+        return _('ready')
+
+    dh_status.short_description = _('DH parameters')
 
 
 VpnAdmin.list_display.insert(1, 'organization')
 VpnAdmin.list_filter.insert(0, ('organization', MultitenantOrgFilter))
 VpnAdmin.list_filter.remove('ca')
 VpnAdmin.fields.insert(2, 'organization')
+VpnAdmin.fields.insert(VpnAdmin.fields.index('dh'), 'dh_status')
 
 
 class ConfigSettingsForm(AlwaysHasChangedMixin, forms.ModelForm):
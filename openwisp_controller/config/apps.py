@@ -1,3 +1,4 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
 from django_netjsonconfig.apps import DjangoNetjsonconfigApp
 
 
@@ -10,5 +11,67 @@ class ConfigConfig(DjangoNetjsonconfigApp):
         self.config_model = Config
         self.vpnclient_model = VpnClient
 
+    def connect_signals(self):
+        """
+        * signals of ``DjangoNetjsonconfigApp``
+        * invalidation of the cached context of VPN clients
+        * pinning of reads to the primary database (see ``replica``)
+        * invalidation of the cached auth data of devices
+        * invalidation of the cached index of template tags
+        * cleanup of deactivated organizations
+        * update of the search text of devices
+        """
+        super(ConfigConfig, self).connect_signals()
+        from openwisp_users.models import Organization
+        from ..pki.models import Ca, Cert
+        from .models import DeactivationJob, Device, TaggedTemplate, Template, TemplateTag, Vpn
+        from .replica import config_modified, object_modified
+        for model in [Vpn, Ca, Cert, self.vpnclient_model]:
+            post_save.connect(self.vpnclient_model.invalidate_context_cache,
+                              sender=model,
+                              dispatch_uid='{0}_vpnclient_context'.format(model._meta.label_lower))
+        post_delete.connect(self.vpnclient_model.invalidate_context_cache,
+                            sender=self.vpnclient_model,
+                            dispatch_uid='vpnclient_context_delete')
+        for signal in [post_save, post_delete]:
+            signal.connect(config_modified,
+                           sender=self.config_model,
+                           dispatch_uid='config_replica_pin')
+            for model in [Template, Vpn, Ca, Cert]:
+                signal.connect(object_modified,
+                               sender=model,
+                               dispatch_uid='{0}_replica_pin'.format(model._meta.label_lower))
+            for model in [Device, self.config_model]:
+                signal.connect(Device.invalidate_auth_cache,
+                               sender=model,
+                               dispatch_uid='{0}_device_auth'.format(model._meta.label_lower))
+        # relations are removed along with the instances, hence the
+        # devices affected by deletions are looked up in pre_delete
+        for signal in [post_save, pre_delete]:
+            for model in [Organization, Template, Vpn, Ca, Cert]:
+                signal.connect(Device.invalidate_related_auth_cache,
+                               sender=model,
+                               dispatch_uid='{0}_device_auth_related'.format(model._meta.label_lower))
+        m2m_changed.connect(Device.invalidate_auth_cache,
+                            sender=self.config_model.templates.through,
+                            dispatch_uid='config_templates_device_auth')
+        for signal in [post_save, post_delete]:
+            for model in [Template, TemplateTag, TaggedTemplate]:
+                signal.connect(Template.invalidate_tag_index,
+                               sender=model,
+                               dispatch_uid='{0}_tag_index'.format(model._meta.label_lower))
+        m2m_changed.connect(Template.invalidate_tag_index,
+                            sender=TaggedTemplate,
+                            dispatch_uid='template_tags_tag_index')
+        post_save.connect(Device.config_search_changed,
+                          sender=self.config_model,
+                          dispatch_uid='config_device_search')
+        pre_save.connect(DeactivationJob.organization_pre_save,
+                         sender=Organization,
+                         dispatch_uid='organization_deactivation_pre_save')
+        post_save.connect(DeactivationJob.organization_post_save,
+                          sender=Organization,
+                          dispatch_uid='organization_deactivation_post_save')
+
     def check_settings(self):
         pass
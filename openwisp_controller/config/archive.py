@@ -0,0 +1,64 @@
+"""
+Helpers to read and build configuration archives
+in the same format of netjsonconfig backends
+"""
+import gzip
+import hashlib
+import tarfile
+from collections import OrderedDict
+from io import BytesIO
+
+
+def get_checksum(contents):
+    """
+    returns the checksum of an archive, like ``Config.checksum``
+    """
+    return hashlib.md5(contents).hexdigest()
+
+
+def read_archive(contents):
+    """
+    returns an ``OrderedDict`` which maps the path of each
+    file contained in the archive to a ``(mode, contents)`` tuple
+    """
+    files = OrderedDict()
+    with tarfile.open(fileobj=BytesIO(contents), mode='r:gz') as tar:
+        for member in tar.getmembers():
+            if not member.isfile():
+                continue
+            files[member.name] = (member.mode, tar.extractfile(member).read())
+    return files
+
+
+def build_archive(files):
+    """
+    builds a tar.gz archive out of a dict like the one
+    returned by ``read_archive``; like netjsonconfig,
+    mtimes are set to ``0`` to get reproducible checksums
+    """
+    tar_bytes = BytesIO()
+    with tarfile.open(fileobj=tar_bytes, mode='w') as tar:
+        for name, (mode, contents) in files.items():
+            info = tarfile.TarInfo(name=name)
+            info.size = len(contents)
+            info.mtime = 0
+            info.type = tarfile.REGTYPE
+            info.mode = mode
+            tar.addfile(tarinfo=info, fileobj=BytesIO(contents))
+    gzip_bytes = BytesIO()
+    with gzip.GzipFile(fileobj=gzip_bytes, mode='wb', mtime=0) as gz:
+        gz.write(tar_bytes.getvalue())
+    return gzip_bytes.getvalue()
+
+
+def diff_archives(old, new):
+    """
+    compares two dicts returned by ``read_archive``, returns
+    ``(changed, removed)``: ``changed`` contains the files which
+    are new or different in ``new``, ``removed`` is the sorted
+    list of the paths which are not present in ``new`` anymore
+    """
+    changed = OrderedDict((name, item) for name, item in new.items()
+                          if old.get(name) != item)
+    removed = sorted(set(old.keys()) - set(new.keys()))
+    return changed, removed
@@ -0,0 +1,48 @@
+"""
+Helpers shared by the caches used in openwisp_controller.config
+"""
+import uuid
+
+from django.core.cache import caches
+
+from . import settings as app_settings
+
+
+def get_cache():
+    """
+    returns the cache backend specified in ``OPENWISP_CONTROLLER_CACHE``
+    """
+    return caches[app_settings.CACHE]
+
+
+def get_cache_key(prefix, *args):
+    """
+    returns a namespaced cache key, eg:
+    ``openwisp_controller:vpnclient_context:12``
+    """
+    parts = ['openwisp_controller', prefix] + [str(arg) for arg in args]
+    return ':'.join(parts)
+
+
+def get_generation(name):
+    """
+    returns the token of the current generation of the cached data
+    named ``name`` (created if missing); cached entries store the token
+    they have been built with and are ignored once it changes
+    (see ``bump_generation``)
+    """
+    cache = get_cache()
+    key = get_cache_key(name)
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, uuid.uuid4().hex, app_settings.CACHE_TIMEOUT)
+        generation = cache.get(key)
+    return generation
+
+
+def bump_generation(name):
+    """
+    starts a new generation of the cached data named ``name``,
+    which invalidates the entries of the previous ones
+    """
+    get_cache().set(get_cache_key(name), uuid.uuid4().hex, app_settings.CACHE_TIMEOUT)
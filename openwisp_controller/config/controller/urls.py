@@ -1,5 +1,16 @@
+from django.conf.urls import url
 from django_netjsonconfig.utils import get_controller_urls
 
 from . import views
 
-urlpatterns = get_controller_urls(views)
+urlpatterns = get_controller_urls(views) + [
+    url(r'^controller/checksum-batch/$',
+        views.checksum_batch,
+        name='checksum_batch'),
+    url(r'^controller/checksum-wait/(?P<pk>[^/]+)/$',
+        views.checksum_wait,
+        name='checksum_wait'),
+    url(r'^controller/download-config-delta/(?P<pk>[^/]+)/$',
+        views.download_config_delta,
+        name='download_config_delta'),
+]
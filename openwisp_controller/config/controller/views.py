@@ -1,9 +1,48 @@
+import json
+import math
+import time
+import uuid
+
 from django.db.models import Q
+from django.http import Http404
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.csrf import csrf_exempt
+from django.views.generic import View
+from django_netjsonconfig import settings as django_netjsonconfig_settings
 from django_netjsonconfig.controller.generics import (BaseChecksumView, BaseDownloadConfigView,
                                                       BaseRegisterView, BaseReportStatusView)
-from django_netjsonconfig.utils import invalid_response
+from django_netjsonconfig.utils import (ControllerResponse, forbid_unallowed, invalid_response, send_file,
+                                        update_last_ip)
+
+from ... import metrics
+from .. import settings as app_settings
+from ..archive import get_checksum
+from ..cache import get_cache
+from ..models import Config, Device, OrganizationConfigSettings, Template
+from ..pubsub import get_pubsub_backend
+from ..replica import is_pinned, replica_enabled, use_primary, use_replica
+from ..throttling import check_failed_auth_rate_limit, check_rate_limit, coalescer
+from ..utils import normalize_mac_address
 
-from ..models import Device, OrganizationConfigSettings
+
+class MetricsMixin(object):
+    """
+    counts the requests to the view (by status code)
+    and observes their duration, see ``openwisp_controller.metrics``
+    """
+    metrics_name = None
+
+    def dispatch(self, request, *args, **kwargs):
+        start = time.time()
+        try:
+            response = super(MetricsMixin, self).dispatch(request, *args, **kwargs)
+        except Http404:
+            metrics.controller_requests.inc(view=self.metrics_name, status=404)
+            raise
+        finally:
+            metrics.controller_request_duration.observe(time.time() - start, view=self.metrics_name)
+        metrics.controller_requests.inc(view=self.metrics_name, status=response.status_code)
+        return response
 
 
 class ActiveOrgMixin(object):
@@ -15,27 +54,243 @@ class ActiveOrgMixin(object):
         return super(ActiveOrgMixin, self).get_object(*args, **kwargs)
 
 
-class ChecksumView(ActiveOrgMixin, BaseChecksumView):
+class ReplicaMixin(object):
+    """
+    performs the reads of the view on the read replica,
+    unless the config of the device has just been modified
+    """
+    def dispatch(self, request, *args, **kwargs):
+        if not replica_enabled() or is_pinned(kwargs.get('pk')):
+            return super(ReplicaMixin, self).dispatch(request, *args, **kwargs)
+        with use_replica():
+            return super(ReplicaMixin, self).dispatch(request, *args, **kwargs)
+
+
+class RateLimitMixin(object):
+    """
+    answers with HTTP 429 to devices (or organizations) which exceed
+    ``OPENWISP_CONTROLLER_RATE_LIMIT_DEVICE`` (or ``_ORGANIZATION``);
+    tokens are spent only by requests with the right key, the other
+    requests are limited by address with ``_RATE_LIMIT_FAILED_AUTH``
+    """
+    def dispatch(self, request, *args, **kwargs):
+        if app_settings.RATE_LIMIT_DEVICE or app_settings.RATE_LIMIT_ORGANIZATION or \
+           app_settings.RATE_LIMIT_FAILED_AUTH:
+            retry_after = self.check_rate_limit(request, kwargs.get('pk'))
+            if retry_after:
+                response = invalid_response(request, 'error: too many requests\n', status=429)
+                response['Retry-After'] = int(math.ceil(retry_after))
+                return response
+        return super(RateLimitMixin, self).dispatch(request, *args, **kwargs)
+
+    def check_rate_limit(self, request, pk):
+        """
+        authenticates the device with the data cached by
+        ``Device.get_auth_data`` (the view repeats the checks
+        without further queries), then consumes the tokens
+        """
+        auth_data = self.model.get_auth_data(pk)
+        params = request.POST if request.method == 'POST' else request.GET
+        key = params.get('key')
+        if auth_data is None or key is None or not self.model.check_auth_key(auth_data, key):
+            return check_failed_auth_rate_limit(request.META.get('REMOTE_ADDR'))
+        org_pk = auth_data['organization_id'] if app_settings.RATE_LIMIT_ORGANIZATION else None
+        return check_rate_limit(pk, org_pk)
+
+
+class ChecksumView(MetricsMixin, RateLimitMixin, ReplicaMixin, ActiveOrgMixin, BaseChecksumView):
+    """
+    returns configuration checksum, devices are authenticated
+    with the data cached by ``Device.get_auth_data``, hence polls
+    don't hit the database unless something has changed
+    """
+    model = Device
+    metrics_name = 'checksum'
+
+    def get(self, request, pk):
+        auth_data = self.model.get_auth_data(pk)
+        if auth_data is None or not auth_data['organization_active']:
+            raise Http404()
+        bad_request = forbid_unallowed(request, 'GET', 'key')
+        if bad_request:
+            return bad_request
+        if not self.model.check_auth_key(auth_data, request.GET['key']):
+            return invalid_response(request, 'error: wrong key\n', status=403)
+        last_ip = request.META.get('REMOTE_ADDR')
+        if auth_data['last_ip'] != last_ip:
+            self.model.update_auth_last_ip(pk, auth_data, last_ip)
+        return ControllerResponse(auth_data['checksum'], content_type='text/plain')
+
+
+class ChecksumWaitView(ChecksumView):
+    """
+    long-poll variant of ``ChecksumView``: given the ``checksum`` of the
+    configuration the device is running, the request is held until the
+    configuration changes or ``timeout`` seconds (at most and by default
+    ``OPENWISP_CONTROLLER_LONG_POLL_TIMEOUT``) have passed, then the
+    current checksum is returned; changes are notified through
+    ``OPENWISP_CONTROLLER_PUBSUB_BACKEND``.
+    Each request occupies a worker thread while it waits,
+    threaded (or greenlet based) workers are recommended.
+    """
+    metrics_name = 'checksum_wait'
+
+    def get(self, request, pk):
+        bad_request = forbid_unallowed(request, 'GET', 'checksum')
+        if bad_request:
+            return bad_request
+        try:
+            channel = uuid.UUID(pk).hex
+        except ValueError:
+            raise Http404()
+        try:
+            timeout = float(request.GET.get('timeout', app_settings.LONG_POLL_TIMEOUT))
+        except ValueError:
+            return invalid_response(request, 'error: invalid timeout\n', status=400)
+        deadline = time.time() + max(0, min(timeout, app_settings.LONG_POLL_TIMEOUT))
+        # subscribe before checking, changes which happen in
+        # between are not missed
+        with get_pubsub_backend().subscribe(channel) as subscription:
+            response = super(ChecksumWaitView, self).get(request, pk)
+            while response.status_code == 200 and \
+                    response.content.decode() == request.GET['checksum']:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not subscription.wait(remaining):
+                    break
+                # the replica may not have received the change yet
+                with use_primary():
+                    response = super(ChecksumWaitView, self).get(request, pk)
+        return response
+
+
+class BatchChecksumView(MetricsMixin, View):
+    """
+    returns the checksums of many devices at once (eg: gateways which
+    manage several sub-devices); expects a ``device`` POST parameter
+    (repeated) for each device, in the form ``<id>:<key>``, and
+    answers with a ``<id> <checksum>`` line for each device, or
+    ``<id> <status>`` (403, 404 or 429) if the checksum of the device
+    can't be returned; devices are authenticated like in ``ChecksumView``
+    and the data which is not cached is looked up with one query
+    """
     model = Device
+    metrics_name = 'checksum_batch'
+
+    def post(self, request, *args, **kwargs):
+        pairs = []
+        for value in request.POST.getlist('device'):
+            pk, sep, key = value.partition(':')
+            if not sep or not pk or not key:
+                return invalid_response(request, 'error: malformed device "{0}"\n'.format(value),
+                                        status=400)
+            pairs.append((pk, key))
+        if not pairs:
+            return invalid_response(request, 'error: missing required parameter "device"\n',
+                                    status=400)
+        if len(pairs) > app_settings.CHECKSUM_BATCH_SIZE:
+            error = 'error: too many devices (max {0})\n'.format(app_settings.CHECKSUM_BATCH_SIZE)
+            return invalid_response(request, error, status=400)
+        auth_data = self.model.get_many_auth_data([pk for pk, key in pairs])
+        last_ip = request.META.get('REMOTE_ADDR')
+        changed = {}
+        lines = []
+        for pk, key in pairs:
+            data = auth_data[pk]
+            if data is None or not data['organization_active']:
+                result = 429 if self.is_failed_auth_rate_limited(request) else 404
+            elif not self.model.check_auth_key(data, key):
+                result = 429 if self.is_failed_auth_rate_limited(request) else 403
+            elif self.is_rate_limited(pk, data):
+                result = 429
+            else:
+                result = data['checksum']
+                if data['last_ip'] != last_ip:
+                    changed[pk] = data
+            lines.append('{0} {1}\n'.format(pk, result))
+        if changed:
+            self.model.update_many_auth_last_ip(changed, last_ip)
+        return ControllerResponse(''.join(lines), content_type='text/plain')
 
+    def is_rate_limited(self, pk, auth_data):
+        if not app_settings.RATE_LIMIT_DEVICE and not app_settings.RATE_LIMIT_ORGANIZATION:
+            return False
+        org_pk = auth_data['organization_id'] if app_settings.RATE_LIMIT_ORGANIZATION else None
+        return bool(check_rate_limit(pk, org_pk))
 
-class DownloadConfigView(ActiveOrgMixin, BaseDownloadConfigView):
+    def is_failed_auth_rate_limited(self, request):
+        return bool(check_failed_auth_rate_limit(request.META.get('REMOTE_ADDR')))
+
+
+class DownloadConfigView(MetricsMixin, RateLimitMixin, ReplicaMixin, ActiveOrgMixin,
+                         BaseDownloadConfigView):
+    """
+    returns configuration archive as attachment, concurrent
+    requests for the same configuration render it only once
+    and archives which are cached already are not rendered
+    (see ``Config.get_current_archive``)
+    """
     model = Device
+    metrics_name = 'download_config'
 
+    def get(self, request, *args, **kwargs):
+        device = self.get_object(*args, **kwargs)
+        bad_request = forbid_unallowed(request, 'GET', 'key', device.key)
+        if bad_request:
+            return bad_request
+        config = device.config
+        update_last_ip(config, request)
+        contents = coalescer.do(('download_config', config.pk), config.get_current_archive)
+        return send_file(filename='{0}.tar.gz'.format(config.name), contents=contents)
 
-class ReportStatusView(ActiveOrgMixin, BaseReportStatusView):
+
+class DownloadConfigDeltaView(DownloadConfigView):
+    """
+    like ``DownloadConfigView`` but, given the ``checksum`` of the
+    configuration the device is running, returns only the files which
+    changed since then; the paths of removed files are listed (JSON
+    encoded) in the ``X-Openwisp-Controller-Removed`` header.
+    If the checksum is not in the archive history of the configuration
+    the full archive is returned and ``X-Openwisp-Controller-Delta``
+    is ``false``.
+    """
+    metrics_name = 'download_config_delta'
+
+    def get(self, request, *args, **kwargs):
+        device = self.get_object(*args, **kwargs)
+        bad_request = (forbid_unallowed(request, 'GET', 'key', device.key) or
+                       forbid_unallowed(request, 'GET', 'checksum'))
+        if bad_request:
+            return bad_request
+        config = device.config
+        update_last_ip(config, request)
+        contents = coalescer.do(('download_config', config.pk), config.get_current_archive)
+        delta, removed = config.get_archive_delta(request.GET['checksum'], contents)
+        response = send_file(filename='{0}.tar.gz'.format(config.name), contents=delta)
+        response['X-Openwisp-Controller-Checksum'] = get_checksum(contents)
+        response['X-Openwisp-Controller-Delta'] = 'false' if removed is None else 'true'
+        if removed:
+            response['X-Openwisp-Controller-Removed'] = json.dumps(removed)
+        return response
+
+
+class ReportStatusView(MetricsMixin, RateLimitMixin, ActiveOrgMixin, BaseReportStatusView):
     model = Device
+    metrics_name = 'report_status'
 
 
-class RegisterView(BaseRegisterView):
+class RegisterView(MetricsMixin, BaseRegisterView):
     model = Device
+    metrics_name = 'register'
 
     def forbidden(self, request):
         """
         ensures request is authorized:
             - secret matches an organization's shared_secret
             - the organization has registration_enabled set to True
+        (the check is performed only once per request)
         """
+        if getattr(self, 'organization', None) is not None:
+            return
         try:
             secret = request.POST.get('secret')
             org_settings = OrganizationConfigSettings.objects \
@@ -50,6 +305,83 @@ class RegisterView(BaseRegisterView):
         # this attribute will be used in ``init_object``
         self.organization = org_settings.organization
 
+    def post(self, request, *args, **kwargs):
+        if django_netjsonconfig_settings.REGISTRATION_ENABLED:
+            response = self.invalid(request) or self.forbidden(request) or \
+                self.register_existing(request)
+            if response:
+                return response
+        return super(RegisterView, self).post(request, *args, **kwargs)
+
+    def get_existing_device(self, request):
+        """
+        returns the device of the organization which has the key sent
+        in the request if its MAC address (compared regardless of case
+        and separators), name and backend are unchanged, ``None`` otherwise;
+        credentials are never returned to requests which don't know the
+        key, as every device of the organization knows the shared secret
+        """
+        key = request.POST.get('key')
+        if not key:
+            return None
+        device = Device.objects.select_related('config') \
+                               .only('id', 'key', 'name', 'mac_address', 'organization_id',
+                                     'config__id', 'config__device_id', 'config__backend',
+                                     'config__last_ip') \
+                               .filter(organization=self.organization, key=key) \
+                               .first()
+        if not device or not device._has_config():
+            return None
+        # the lookup may be case insensitive on some databases
+        mac_address = normalize_mac_address(request.POST['mac_address'])
+        unchanged = constant_time_compare(device.key, key) and \
+            normalize_mac_address(device.mac_address) == mac_address and \
+            device.name == request.POST['name'] and \
+            device.config.backend == request.POST['backend']
+        return device if unchanged else None
+
+    def register_existing(self, request):
+        """
+        fast path for devices which register again with their
+        key (eg: after a reset, see ``CONSISTENT_REGISTRATION``):
+        if the device is unchanged its credentials are returned
+        without going through validation again;
+        templates of new tags are added to the configuration
+        """
+        if not django_netjsonconfig_settings.CONSISTENT_REGISTRATION:
+            return None
+        device = self.get_existing_device(request)
+        if not device:
+            metrics.registration_fast_path.inc(result='miss')
+            return None
+        tags = request.POST.get('tags')
+        template_pks = []
+        if tags:
+            template_pks = Template.get_tagged_template_pks(self.organization.pk, tags.split())
+        if template_pks:
+            existing = set(device.config.templates.values_list('pk', flat=True))
+            template_pks = [pk for pk in template_pks if pk not in existing]
+        if template_pks:
+            metrics.registration_fast_path.inc(result='miss')
+            # validation needs the fields deferred by ``get_existing_device``
+            config = Config.objects.select_related('device').get(pk=device.config.pk)
+            config.templates.add(*template_pks)
+        else:
+            metrics.registration_fast_path.inc(result='hit')
+        last_ip = request.META.get('REMOTE_ADDR')
+        if device.config.last_ip != last_ip:
+            Config.objects.filter(pk=device.config.pk).update(last_ip=last_ip)
+            Device.update_search([device.pk], last_ip)
+            get_cache().delete(Device.get_auth_cache_key(device.pk))
+        s = 'registration-result: success\n' \
+            'uuid: {id}\n' \
+            'key: {key}\n' \
+            'hostname: {name}\n' \
+            'is-new: 0\n'
+        return ControllerResponse(s.format(id=device.pk.hex, key=device.key, name=device.name),
+                                  content_type='text/plain',
+                                  status=201)
+
     def init_object(self, **kwargs):
         config = super(RegisterView, self).init_object(**kwargs)
         config.organization = self.organization
@@ -62,8 +394,25 @@ class RegisterView(BaseRegisterView):
         return queryset.filter(Q(organization=self.organization) |
                                Q(organization=None))
 
+    def add_tagged_templates(self, config, request):
+        """
+        looks up the templates of the tags in the cached
+        index of ``Template.get_tag_index`` and adds them at once
+        """
+        tags = request.POST.get('tags')
+        if not tags:
+            return
+        template_pks = Template.get_tagged_template_pks(self.organization.pk, tags.split())
+        if template_pks:
+            config.templates.add(*template_pks)
+
 
-checksum = ChecksumView.as_view()
-download_config = DownloadConfigView.as_view()
-report_status = ReportStatusView.as_view()
-register = RegisterView.as_view()
+# the mixins override ``dispatch``, hence the CSRF exemption
+# of the base views would not be copied to the view functions
+checksum = csrf_exempt(ChecksumView.as_view())
+checksum_batch = csrf_exempt(BatchChecksumView.as_view())
+checksum_wait = csrf_exempt(ChecksumWaitView.as_view())
+download_config = csrf_exempt(DownloadConfigView.as_view())
+download_config_delta = csrf_exempt(DownloadConfigDeltaView.as_view())
+report_status = csrf_exempt(ReportStatusView.as_view())
+register = csrf_exempt(RegisterView.as_view())
@@ -0,0 +1,59 @@
+"""
+Pool of pre-generated Diffie-Hellman parameters
+"""
+import threading
+from collections import defaultdict, deque
+
+from . import settings as app_settings
+from .executor import get_executor
+
+
+class DhParamsPool(object):
+    """
+    thread-safe, in-process pool of pre-generated
+    DH parameters, one queue for each key size
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._params = defaultdict(deque)
+        self._generating = defaultdict(int)
+
+    def get(self, length):
+        """
+        returns DH parameters of the specified length
+        or ``None`` if the pool is empty
+        """
+        with self._lock:
+            if self._params[length]:
+                return self._params[length].popleft()
+
+    def put(self, length, dh):
+        with self._lock:
+            self._params[length].append(dh)
+
+    def size(self, length):
+        return len(self._params[length])
+
+    def fill(self, length, generator, size=None):
+        """
+        schedules the generation of the DH parameters
+        needed to bring the pool back to ``size`` items,
+        ``generator`` is called with ``length`` as argument
+        """
+        size = app_settings.DH_POOL_SIZE if size is None else size
+        with self._lock:
+            missing = size - len(self._params[length]) - self._generating[length]
+            self._generating[length] += max(missing, 0)
+        executor = get_executor()
+        for i in range(missing):
+            executor.submit(self._generate, length, generator)
+
+    def _generate(self, length, generator):
+        try:
+            self.put(length, generator(length))
+        finally:
+            with self._lock:
+                self._generating[length] -= 1
+
+
+dh_pool = DhParamsPool()
@@ -0,0 +1,79 @@
+"""
+Minimal job executors used to move slow operations
+(eg: generation of DH parameters) out of the request/response cycle
+"""
+import logging
+import threading
+
+from django.db import connection
+from django.utils.module_loading import import_string
+
+from . import settings as app_settings
+
+logger = logging.getLogger(__name__)
+_running = set()
+_running_lock = threading.Lock()
+
+
+class LocalExecutor(object):
+    """
+    runs each job in a daemon thread of the current process
+    """
+    def submit(self, func, *args, **kwargs):
+        thread = threading.Thread(target=self._run, args=(func, args, kwargs))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _run(self, func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logger.exception('Background job {0} failed'.format(func))
+        finally:
+            # each thread opens its own database connection
+            connection.close()
+
+
+class SyncExecutor(object):
+    """
+    runs jobs immediately in the calling thread,
+    useful for debugging and in automated tests
+    """
+    def submit(self, func, *args, **kwargs):
+        func(*args, **kwargs)
+
+
+def get_executor():
+    """
+    returns an instance of the executor class
+    specified in ``OPENWISP_CONTROLLER_EXECUTOR``
+    """
+    return import_string(app_settings.EXECUTOR)()
+
+
+def submit_once(key, func, *args, **kwargs):
+    """
+    submits ``func`` to the executor unless a job with
+    the same ``key`` is still running in this process;
+    returns ``False`` if the job has not been submitted
+    """
+    with _running_lock:
+        if key in _running:
+            return False
+        _running.add(key)
+
+    def job():
+        try:
+            func(*args, **kwargs)
+        finally:
+            with _running_lock:
+                _running.discard(key)
+
+    try:
+        get_executor().submit(job)
+    except Exception:
+        with _running_lock:
+            _running.discard(key)
+        raise
+    return True
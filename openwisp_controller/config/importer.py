@@ -0,0 +1,249 @@
+"""
+Streaming import of devices (and of their configurations) in an
+organization; rows are read one at a time from CSV files or from
+JSON lines files (one NetJSON object per line), validated, and
+inserted in batches with bulk queries, hence memory usage does not
+depend on the size of the file.
+
+Each row has the following keys (CSV columns):
+
+* ``name``, ``mac_address`` (required)
+* ``key``, ``model``, ``os``, ``system``, ``notes`` (optional)
+* ``backend`` (optional, defaults to ``OpenWrt``)
+* ``config``: NetJSON DeviceConfiguration (JSON encoded in CSV files)
+* ``templates``: names of the templates of the organization (or shared),
+  separated by commas in CSV files; the default templates of the
+  organization (of the same backend) are used if missing
+"""
+import csv
+import json
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import six
+from django_netjsonconfig import settings as django_netjsonconfig_settings
+
+from . import settings as app_settings
+from .models import Config, Device, Template, VpnClient
+from .replica import pin_primary
+from .utils import get_default_templates_queryset, get_search_text
+
+DEVICE_FIELDS = ('name', 'mac_address', 'key', 'model', 'os', 'system', 'notes')
+
+
+def _csv_rows(stream):
+    """
+    returns a ``csv.DictReader`` of ``stream``; on python 2, where the
+    csv module can't read unicode, lines are encoded to UTF-8 and the
+    rows are decoded after being read
+    """
+    if not six.PY2:
+        reader = csv.DictReader(stream)
+        return reader, reader
+    reader = csv.DictReader(line.encode('utf-8') if isinstance(line, six.text_type) else line
+                            for line in stream)
+
+    def decode(value):
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    rows = (dict((decode(key), decode(value)) for key, value in row.items()) for row in reader)
+    return reader, rows
+
+
+def read_csv(stream):
+    """
+    yields ``(line, row)`` tuples from a CSV text stream
+    """
+    reader, rows = _csv_rows(stream)
+    for row in rows:
+        if row.get('config'):
+            try:
+                row['config'] = json.loads(row['config'])
+            except ValueError as e:
+                row['config'] = ValidationError('invalid JSON in config: {0}'.format(e))
+        if 'templates' in row:
+            row['templates'] = [name.strip() for name in (row['templates'] or '').split(',')
+                                if name.strip()] or None
+        yield reader.line_num, row
+
+
+def read_netjson(stream):
+    """
+    yields ``(line, row)`` tuples from a JSON lines text stream
+    """
+    for line, text in enumerate(stream, 1):
+        if not text.strip():
+            continue
+        try:
+            row = json.loads(text)
+            if not isinstance(row, dict):
+                raise ValueError('expected an object')
+        except ValueError as e:
+            row = ValidationError('invalid JSON: {0}'.format(e))
+        yield line, row
+
+
+READERS = {
+    'csv': read_csv,
+    'netjson': read_netjson,
+}
+
+
+class DeviceImporter(object):
+    """
+    imports devices in ``organization``; errors are collected in
+    ``errors`` as ``(line, message)`` tuples (at most ``max_errors``
+    of them, ``error_count`` counts them all) and passed to
+    ``on_error`` if given
+    """
+    max_errors = 1000
+    max_validated = 10000
+
+    def __init__(self, organization, batch_size=None, on_error=None):
+        self.organization = organization
+        self.batch_size = batch_size or app_settings.CHUNK_SIZE
+        self.on_error = on_error
+        self.created = 0
+        self.errors = []
+        self.error_count = 0
+        self._validated = {}
+        self.templates = {}
+        # organization templates take precedence over shared templates
+        templates = Template.objects.filter(organization=None)
+        for template in list(templates) + list(Template.objects.filter(organization=organization)):
+            self.templates[template.name] = template
+        self.default_templates = list(get_default_templates_queryset(organization.pk,
+                                                                     model=Template).order_by('name'))
+
+    def add_error(self, line, error):
+        if isinstance(error, ValidationError):
+            if hasattr(error, 'error_dict'):
+                error = '; '.join('{0}: {1}'.format(field, ' '.join(messages))
+                                  for field, messages in sorted(error.message_dict.items()))
+            else:
+                error = ' '.join(error.messages)
+        self.error_count += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append((line, error))
+        if self.on_error:
+            self.on_error(line, error)
+
+    def run(self, stream, format='csv'):
+        """
+        imports the rows of the text ``stream``,
+        returns the number of created devices
+        """
+        batch = []
+        for line, row in READERS[format](stream):
+            try:
+                batch.append((line,) + self.build(row))
+            except ValidationError as e:
+                self.add_error(line, e)
+                continue
+            if len(batch) >= self.batch_size:
+                self.insert(batch)
+                batch = []
+        if batch:
+            self.insert(batch)
+        if self.created:
+            pin_primary()
+        return self.created
+
+    def build(self, row):
+        """
+        returns the ``(device, config, templates)`` of ``row``
+        (not saved), raises ``ValidationError`` if invalid
+        """
+        if isinstance(row, ValidationError):
+            raise row
+        if isinstance(row.get('config'), ValidationError):
+            raise row['config']
+        device = Device(organization=self.organization,
+                        **dict((f, row[f]) for f in DEVICE_FIELDS if row.get(f)))
+        device.full_clean(validate_unique=False)
+        device.search = get_search_text(device.name, device.mac_address)
+        backend = row.get('backend') or django_netjsonconfig_settings.DEFAULT_BACKEND
+        names = row.get('templates')
+        if names is None:
+            templates = [t for t in self.default_templates if t.backend == backend]
+        else:
+            missing = [name for name in names if name not in self.templates]
+            if missing:
+                raise ValidationError('unknown templates: {0}'.format(', '.join(missing)))
+            templates = [self.templates[name] for name in names]
+        config = Config(device=device,
+                        organization=self.organization,
+                        backend=backend,
+                        config=row.get('config') or {})
+        config.clean_fields(exclude=['device'])
+        self.validate_config(config, templates)
+        return device, config, templates
+
+    def validate_config(self, config, templates):
+        """
+        validates the configuration resulting from ``config``
+        and ``templates``, each combination is validated once
+        """
+        key = (config.backend, json.dumps(config.config, sort_keys=True),
+               tuple(template.pk for template in templates))
+        if key not in self._validated:
+            if len(self._validated) >= self.max_validated:
+                self._validated = {}
+            try:
+                config.clean_netjsonconfig_backend(config.get_backend_instance(template_instances=templates))
+            except ValidationError as e:
+                self._validated[key] = e
+            else:
+                self._validated[key] = None
+        if self._validated[key]:
+            raise self._validated[key]
+
+    def check_unique(self, batch):
+        """
+        returns the rows of ``batch`` whose name, mac address and key are
+        not used by existing devices nor by previous rows of the batch
+        """
+        existing = {}
+        for field in ('name', 'mac_address', 'key'):
+            values = [getattr(row[1], field) for row in batch]
+            existing[field] = set(Device.objects.filter(**{'{0}__in'.format(field): values})
+                                                .values_list(field, flat=True))
+        valid = []
+        for row in batch:
+            device = row[1]
+            duplicates = [field for field in ('name', 'mac_address', 'key')
+                          if getattr(device, field) in existing[field]]
+            if duplicates:
+                self.add_error(row[0], ValidationError(dict(
+                    (field, 'device with this {0} already exists'.format(field.replace('_', ' ')))
+                    for field in duplicates
+                )))
+                continue
+            for field in ('name', 'mac_address', 'key'):
+                existing[field].add(getattr(device, field))
+            valid.append(row)
+        return valid
+
+    def insert(self, batch):
+        """
+        inserts the devices, configurations, template
+        relations and VPN clients of ``batch``
+        """
+        batch = self.check_unique(batch)
+        if not batch:
+            return
+        through = Config.templates.through
+        vpn_configs = {}
+        relations = []
+        for line, device, config, templates in batch:
+            for i, template in enumerate(templates, 1):
+                relations.append(through(config_id=config.pk, template_id=template.pk, sort_value=i))
+                if template.type == 'vpn':
+                    vpn_configs.setdefault(template, []).append(config)
+        with transaction.atomic():
+            Device.objects.bulk_create([row[1] for row in batch])
+            Config.bulk_insert([row[2] for row in batch])
+            through.objects.bulk_create(relations)
+            for template, configs in vpn_configs.items():
+                VpnClient.bulk_create_clients(configs, [template])
+        self.created += len(batch)
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from ... import settings as app_settings
+from ...models import ConfigVersion
+
+
+class Command(BaseCommand):
+    help = 'Deletes expired configuration versions and the files which are not referenced anymore'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days',
+                            type=int,
+                            default=app_settings.CONFIG_HISTORY_RETENTION,
+                            help='delete versions older than this number of days')
+        parser.add_argument('--chunk-size',
+                            type=int,
+                            default=app_settings.CHUNK_SIZE,
+                            help='number of versions deleted per chunk')
+
+    def handle(self, *args, **options):
+        versions, blobs = ConfigVersion.delete_expired(days=options['days'],
+                                                       chunk_size=options['chunk_size'])
+        self.stdout.write('Deleted {0} versions and {1} blobs'.format(versions, blobs))
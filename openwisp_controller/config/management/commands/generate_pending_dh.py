@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from ...models import Vpn
+
+
+class Command(BaseCommand):
+    help = 'Generates the DH parameters of the VPN servers still pending, ' \
+           'eg: because the process running their background job has exited'
+
+    def handle(self, *args, **options):
+        pks = list(Vpn.objects.filter(dh_pending=True).values_list('pk', flat=True))
+        for pk in pks:
+            Vpn.generate_dh(pk)
+        self.stdout.write('Generated DH parameters of {0} VPN servers'.format(len(pks)))
@@ -0,0 +1,44 @@
+import io
+
+from django.core.management.base import BaseCommand, CommandError
+
+from openwisp_users.models import Organization
+
+from ... import settings as app_settings
+from ...importer import READERS, DeviceImporter
+
+
+class Command(BaseCommand):
+    help = 'Imports devices and their configurations in an organization from a CSV ' \
+           'or JSON lines (NetJSON) file, see openwisp_controller.config.importer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='path of the file')
+        parser.add_argument('--organization',
+                            required=True,
+                            help='slug of the organization')
+        parser.add_argument('--format',
+                            choices=sorted(READERS.keys()),
+                            help='format of the file (by default guessed from its extension)')
+        parser.add_argument('--batch-size',
+                            type=int,
+                            default=app_settings.CHUNK_SIZE,
+                            help='number of devices inserted per batch')
+
+    def handle(self, *args, **options):
+        try:
+            organization = Organization.objects.get(slug=options['organization'])
+        except Organization.DoesNotExist:
+            raise CommandError('organization "{0}" does not exist'.format(options['organization']))
+        path = options['path']
+        file_format = options['format'] or ('csv' if path.lower().endswith('.csv') else 'netjson')
+        importer = DeviceImporter(organization,
+                                  batch_size=options['batch_size'],
+                                  on_error=self.print_error)
+        with io.open(path, newline='', encoding='utf-8') as stream:
+            importer.run(stream, file_format)
+        self.stdout.write('Imported {0} devices, {1} errors'.format(importer.created,
+                                                                    importer.error_count))
+
+    def print_error(self, line, error):
+        self.stderr.write('line {0}: {1}'.format(line, error))
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+
+from ...models import GenerationProfile
+
+
+class Command(BaseCommand):
+    help = 'Prints the organizations and templates which are slowest to generate (or validate), ' \
+           'see OPENWISP_CONTROLLER_PROFILING'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--operation',
+                            choices=['generate', 'validate'],
+                            default='generate',
+                            help='operation to report')
+        parser.add_argument('--order',
+                            choices=['total', 'mean', 'max'],
+                            default='total',
+                            help='order by total, mean or max time')
+        parser.add_argument('--limit',
+                            type=int,
+                            default=10,
+                            help='number of organizations and templates printed')
+        parser.add_argument('--clear',
+                            action='store_true',
+                            help='delete the collected data')
+
+    def handle(self, *args, **options):
+        if options['clear']:
+            count = GenerationProfile.objects.all().delete()[1].get(GenerationProfile._meta.label, 0)
+            self.stdout.write('Deleted {0} profiles'.format(count))
+            return
+        for by, title in [('organization', 'Organizations'), ('template', 'Templates')]:
+            rows = GenerationProfile.get_slowest(by=by,
+                                                 operation=options['operation'],
+                                                 order=options['order'],
+                                                 limit=options['limit'])
+            self.stdout.write('{0} ({1}, by {2} time):'.format(title, options['operation'], options['order']))
+            if not rows:
+                self.stdout.write('  no data collected')
+            for row in rows:
+                name = row['name']
+                if by == 'template':
+                    name = '{0} ({1})'.format(name, row['organization'] or 'shared')
+                self.stdout.write('  {name}: {count} samples, total {total:.3f}s, '
+                                  'mean {mean:.3f}s, max {max:.3f}s'.format(**dict(row, name=name)))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from ... import settings as app_settings
+from ...models import VpnClient
+
+
+class Command(BaseCommand):
+    help = 'Renews automatically managed VPN client certificates which are about to expire'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days',
+                            type=int,
+                            default=app_settings.CERT_RENEWAL_DAYS,
+                            help='renew certificates expiring within this number of days')
+        parser.add_argument('--chunk-size',
+                            type=int,
+                            default=app_settings.CHUNK_SIZE,
+                            help='number of certificates processed per chunk')
+
+    def handle(self, *args, **options):
+        renewed = VpnClient.renew_expiring_certs(days=options['days'],
+                                                 chunk_size=options['chunk_size'])
+        self.stdout.write('Renewed {0} certificates'.format(renewed))
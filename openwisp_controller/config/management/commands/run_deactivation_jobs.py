@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from ... import settings as app_settings
+from ...models import DeactivationJob
+
+
+class Command(BaseCommand):
+    help = 'Runs (or resumes from their last checkpoint) the cleanup jobs of deactivated ' \
+           'organizations which have not been completed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--organization',
+                            help='slug of the organization whose jobs are run')
+        parser.add_argument('--chunk-size',
+                            type=int,
+                            default=app_settings.CHUNK_SIZE,
+                            help='number of objects processed per chunk')
+
+    def handle(self, *args, **options):
+        jobs = DeactivationJob.objects.exclude(status__in=['completed', 'cancelled']) \
+                                      .select_related('organization')
+        if options['organization']:
+            jobs = jobs.filter(organization__slug=options['organization'])
+        for job in jobs:
+            try:
+                status = job.run(chunk_size=options['chunk_size'])
+            except Exception as e:
+                self.stderr.write('{0}: failed ({1})'.format(job.organization.slug, e))
+                continue
+            self.stdout.write('{0}: {1} ({2} objects processed)'.format(job.organization.slug,
+                                                                        status,
+                                                                        job.processed))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from ... import settings as app_settings
+from ...models import ConfigContent
+
+
+class Command(BaseCommand):
+    help = 'Moves the configurations of existing rows to contents shared by identical configurations ' \
+           '(or back to their rows if OPENWISP_CONTROLLER_SHARED_CONFIG is disabled) and deletes ' \
+           'the unreferenced contents'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size',
+                            type=int,
+                            default=app_settings.CHUNK_SIZE,
+                            help='number of configurations processed per chunk')
+
+    def handle(self, *args, **options):
+        if app_settings.SHARED_CONFIG:
+            moved = ConfigContent.share_existing(chunk_size=options['chunk_size'])
+            self.stdout.write('Shared {0} configurations'.format(moved))
+        else:
+            moved = ConfigContent.inline_existing(chunk_size=options['chunk_size'])
+            self.stdout.write('Moved {0} configurations back to their rows'.format(moved))
+        deleted = ConfigContent.delete_unreferenced()
+        self.stdout.write('Deleted {0} unreferenced contents'.format(deleted))
@@ -0,0 +1,97 @@
+import time
+from multiprocessing import Pool, cpu_count
+
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from ... import settings as app_settings
+from ...models import Config
+from ...utils import chunked_queryset
+
+
+def init_worker():
+    # connections inherited from the parent process must not be shared
+    connections.close_all()
+    for cache in caches.all():
+        cache.close()
+
+
+def warm_up_chunk(pks):
+    return Config.warm_cache(pks)
+
+
+class Command(BaseCommand):
+    help = 'Renders the configurations of the active organizations and stores their checksums and ' \
+           'archives in OPENWISP_CONTROLLER_CACHE, so that the first requests of the devices are ' \
+           'answered without rendering (eg: after a deploy or after the cache has been flushed)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--organization',
+                            action='append',
+                            help='slug of the organization whose configurations are rendered '
+                                 '(may be repeated, all the active organizations by default)')
+        parser.add_argument('--chunk-size',
+                            type=int,
+                            default=app_settings.CHUNK_SIZE,
+                            help='number of configurations rendered by each task')
+        parser.add_argument('--workers',
+                            type=int,
+                            default=cpu_count(),
+                            help='number of worker processes (1 renders in the current process)')
+        parser.add_argument('--rate',
+                            type=float,
+                            help='maximum number of configurations rendered per second')
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        configs = Config.objects.filter(organization__is_active=True).only('id')
+        if options['organization']:
+            configs = configs.filter(organization__slug__in=options['organization'])
+        chunk_size = options['chunk_size']
+        rate = options['rate']
+        if rate:
+            # smaller chunks let the rate limit be applied evenly
+            chunk_size = max(1, min(chunk_size, int(rate)))
+        workers = max(1, options['workers'])
+        pool = None
+        if workers > 1:
+            connections.close_all()
+            pool = Pool(workers, initializer=init_worker)
+        start = time.time()
+        rendered = errors = 0
+        wave = []
+        try:
+            for chunk in chunked_queryset(configs, chunk_size):
+                wave.append([config.pk for config in chunk])
+                if len(wave) < workers:
+                    continue
+                rendered, errors = self._run_wave(pool, wave, rendered, errors, start, rate)
+                wave = []
+            if wave:
+                rendered, errors = self._run_wave(pool, wave, rendered, errors, start, rate)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        self.stdout.write('Rendered {rendered} configurations ({errors} errors) '
+                          'in {elapsed:.1f}s'.format(rendered=rendered,
+                                                     errors=errors,
+                                                     elapsed=time.time() - start))
+
+    def _run_wave(self, pool, wave, rendered, errors, start, rate):
+        """
+        renders a chunk of configurations in each worker,
+        then waits as long as needed to respect ``rate``
+        """
+        results = pool.map(warm_up_chunk, wave) if pool else [warm_up_chunk(pks) for pks in wave]
+        for chunk_rendered, chunk_errors in results:
+            rendered += chunk_rendered
+            errors += chunk_errors
+        if self.verbosity > 1:
+            self.stdout.write('{0} configurations rendered'.format(rendered + errors))
+        if rate:
+            delay = (rendered + errors) / rate - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+        return rendered, errors
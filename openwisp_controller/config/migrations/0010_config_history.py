@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 22:49
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('config', '0009_device_system'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConfigBlob',
+            fields=[
+                ('checksum', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('contents', models.BinaryField()),
+            ],
+            options={
+                'verbose_name': 'configuration blob',
+                'verbose_name_plural': 'configuration blobs',
+            },
+        ),
+        migrations.CreateModel(
+            name='ConfigVersion',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('checksum', models.CharField(db_index=True, max_length=32)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('config', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='versions', to='config.Config')),
+            ],
+            options={
+                'verbose_name': 'configuration version',
+                'verbose_name_plural': 'configuration versions',
+                'ordering': ('-created',),
+            },
+        ),
+        migrations.CreateModel(
+            name='ConfigVersionFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=255)),
+                ('mode', models.PositiveIntegerField()),
+                ('blob', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='files', to='config.ConfigBlob')),
+                ('version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='files', to='config.ConfigVersion')),
+            ],
+            options={
+                'verbose_name': 'configuration version file',
+                'verbose_name_plural': 'configuration version files',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='configversion',
+            index_together=set([('config', 'created')]),
+        ),
+    ]
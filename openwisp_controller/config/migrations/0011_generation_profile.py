@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 23:35
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('openwisp_users', '0007_unique_email'),
+        ('config', '0010_config_history'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GenerationProfile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('operation', models.CharField(choices=[('generate', 'generate'), ('validate', 'validate')], max_length=8)),
+                ('backend', models.CharField(max_length=128)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('total_time', models.FloatField(default=0)),
+                ('max_time', models.FloatField(default=0)),
+                ('profile', models.TextField(blank=True)),
+                ('profile_time', models.FloatField(blank=True, null=True)),
+                ('modified', models.DateTimeField(default=django.utils.timezone.now)),
+                ('organization', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='openwisp_users.Organization')),
+                ('template', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='config.Template')),
+            ],
+            options={
+                'verbose_name': 'generation profile',
+                'verbose_name_plural': 'generation profiles',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='generationprofile',
+            index_together=set([('operation', 'organization', 'template', 'backend')]),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 23:49
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('openwisp_users', '0007_unique_email'),
+        ('config', '0011_generation_profile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeactivationJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('running', 'running'), ('completed', 'completed'), ('cancelled', 'cancelled'), ('failed', 'failed')], db_index=True, default='pending', max_length=9)),
+                ('stage', models.CharField(default='devices', max_length=10)),
+                ('last_pk', models.CharField(blank=True, max_length=36)),
+                ('processed', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('modified', models.DateTimeField(default=django.utils.timezone.now)),
+                ('organization', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deactivation_jobs', to='openwisp_users.Organization')),
+            ],
+            options={
+                'verbose_name': 'deactivation job',
+                'verbose_name_plural': 'deactivation jobs',
+                'ordering': ('created',),
+            },
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 00:05
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('openwisp_users', '0007_unique_email'),
+        ('config', '0012_deactivation_job'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='device',
+            index_together=set([('organization', 'name')]),
+        ),
+    ]
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 00:13
+from __future__ import unicode_literals
+
+import re
+
+from django.db import migrations, models
+from django.db.models import Case, Value, When
+
+
+def get_search_text(name, mac_address, last_ip=None):
+    """
+    copy of ``openwisp_controller.config.utils.get_search_text``
+    as of this migration
+    """
+    mac_address = (mac_address or '').lower()
+    parts = [(name or '').lower(), mac_address, re.sub('[^0-9a-f]', '', mac_address)]
+    if last_ip:
+        parts.append(last_ip.lower())
+    return ' '.join(parts)[:255]
+
+
+def populate_search(apps, schema_editor):
+    """
+    fills ``search`` in chunks of 1000 devices (keyset pagination
+    on the primary key), with one ``UPDATE`` per chunk
+    """
+    Device = apps.get_model('config', 'Device')
+    Config = apps.get_model('config', 'Config')
+    alias = schema_editor.connection.alias
+    devices = Device.objects.using(alias).order_by('pk').values_list('pk', 'name', 'mac_address')
+    last_pk = None
+    while True:
+        qs = devices if last_pk is None else devices.filter(pk__gt=last_pk)
+        chunk = list(qs[:1000])
+        if not chunk:
+            return
+        pks = [pk for pk, name, mac_address in chunk]
+        last_ips = dict(Config.objects.using(alias)
+                                      .filter(device__in=pks)
+                                      .values_list('device_id', 'last_ip'))
+        cases = [When(pk=pk, then=Value(get_search_text(name, mac_address, last_ips.get(pk))))
+                 for pk, name, mac_address in chunk]
+        Device.objects.using(alias) \
+                      .filter(pk__in=pks) \
+                      .update(search=Case(*cases, output_field=models.CharField()))
+        last_pk = pks[-1]
+
+
+def create_trigram_index(apps, schema_editor):
+    """
+    on PostgreSQL ``search`` is indexed with a trigram GIN index,
+    which serves the ``LIKE '%...%'`` queries of device searches
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute('CREATE INDEX config_device_search_trgm '
+                          'ON config_device USING gin (search gin_trgm_ops)')
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS config_device_search_trgm')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('config', '0013_device_organization_name_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='search',
+            field=models.CharField(blank=True, editable=False, help_text='normalized name, mac address and last ip, matched by searches', max_length=255),
+        ),
+        migrations.RunPython(populate_search, reverse_code=migrations.RunPython.noop),
+        migrations.RunPython(create_trigram_index, reverse_code=drop_trigram_index),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 00:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('config', '0014_device_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConfigContent',
+            fields=[
+                ('checksum', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('config', models.TextField()),
+            ],
+            options={
+                'verbose_name': 'configuration content',
+                'verbose_name_plural': 'configuration contents',
+            },
+        ),
+        migrations.AddField(
+            model_name='config',
+            name='content',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='configs', to='config.ConfigContent'),
+        ),
+    ]
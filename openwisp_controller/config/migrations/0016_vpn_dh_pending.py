@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 00:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def mark_pending(apps, schema_editor):
+    Vpn = apps.get_model('config', 'Vpn')
+    Vpn.objects.using(schema_editor.connection.alias).filter(dh='').update(dh_pending=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('config', '0015_config_content'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vpn',
+            name='dh_pending',
+            field=models.BooleanField(db_index=True, default=False, editable=False, help_text='DH parameters are being generated in background', verbose_name='DH parameters pending'),
+        ),
+        migrations.RunPython(mark_pending, reverse_code=migrations.RunPython.noop),
+    ]
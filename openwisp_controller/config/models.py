@@ -1,9 +1,24 @@
+import cProfile
+import hashlib
+import json
+import logging
+import pstats
+import threading
+import time
 import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
 
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, F, Max, OuterRef, Q, Subquery, Sum, Value, When
+from django.utils import six, timezone
+from django.utils.crypto import constant_time_compare, salted_hmac
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
+from django_netjsonconfig import settings as django_netjsonconfig_settings
 from django_netjsonconfig.base.config import TemplatesVpnMixin as BaseMixin
 from django_netjsonconfig.base.config import AbstractConfig, TemplatesThrough
 from django_netjsonconfig.base.device import AbstractDevice
@@ -12,12 +27,23 @@ from django_netjsonconfig.base.template import AbstractTemplate
 from django_netjsonconfig.base.vpn import AbstractVpn, AbstractVpnClient
 from django_netjsonconfig.utils import get_random_key
 from django_netjsonconfig.validators import key_validator
+from netjsonconfig.exceptions import ValidationError as SchemaError
 from sortedm2m.fields import SortedManyToManyField
 from taggit.managers import TaggableManager
 
 from openwisp_users.mixins import OrgMixin, ShareableOrgMixin
 
-from .utils import get_default_templates_queryset
+from .. import metrics
+from . import settings as app_settings
+from .archive import build_archive, diff_archives, get_checksum, read_archive
+from .cache import bump_generation, get_cache, get_cache_key, get_generation
+from .dh import dh_pool
+from .executor import get_executor, submit_once
+from .pubsub import publish_change
+from .replica import pin_primary, use_primary
+from .utils import chunked_queryset, get_default_templates_queryset, get_search_text
+
+logger = logging.getLogger(__name__)
 
 
 class TemplatesVpnMixin(BaseMixin):
@@ -62,17 +88,516 @@ class TemplatesVpnMixin(BaseMixin):
         """
         adds organization validation
         """
+        if kwargs.get('reverse'):
+            return cls.clean_templates_reverse(action, instance, pk_set, **kwargs)
         templates = cls.clean_templates_org(action, instance, pk_set, **kwargs)
+        if not templates:
+            return
         # perform validation of configuration (local config + templates)
-        super(TemplatesVpnMixin, cls).clean_templates(action, instance, templates, **kwargs)
+        with metrics.template_validation_duration.time(backend=instance.backend), \
+                GenerationProfile.measure('validate', instance, templates):
+            super(TemplatesVpnMixin, cls).clean_templates(action, instance, templates, **kwargs)
+
+    @classmethod
+    def clean_templates_reverse(cls, action, instance, pk_set, **kwargs):
+        """
+        validates the organization of configs added to a template
+        (eg: ``template.config_relations.add(*configs)``)
+        """
+        if action != 'pre_add' or not instance.organization_id:
+            return
+        invalids = cls.objects.filter(pk__in=pk_set) \
+                              .exclude(organization=instance.organization_id) \
+                              .values_list('device__name', flat=True)
+        if invalids:
+            message = _('The organization of the following configurations does '
+                        'not match the organization of this template: {0}')
+            raise ValidationError(message.format(', '.join(invalids)))
+
+    @classmethod
+    def templates_changed(cls, action, instance, **kwargs):
+        """
+        adds support for changes performed on the template side of the
+        relationship, related configs are flagged with one UPDATE query
+        """
+        if not kwargs.get('reverse'):
+            return super(TemplatesVpnMixin, cls).templates_changed(action, instance, **kwargs)
+        if action in ['post_add', 'post_remove']:
+            cls.objects.filter(pk__in=kwargs['pk_set']).update(status='modified')
+        elif action == 'pre_clear':
+            instance.config_relations.update(status='modified')
+        else:
+            return
+        # bulk updates don't send post_save
+        pin_primary()
+
+    @classmethod
+    def bulk_set_templates(cls, configs, templates, chunk_size=None):
+        """
+        replaces the templates of ``configs`` (queryset) with ``templates``
+        (applied in the given order) without sending ``m2m_changed``:
+        the configuration resulting from each unique combination of
+        organization, backend and local configuration is validated once,
+        if any configuration is not valid a ``ValidationError`` mapping the
+        names of the devices to the errors is raised and nothing is changed;
+        the relationships are written in bulk and configs are flagged as
+        modified with one UPDATE query; returns the number of configs
+        (templates listed more than once are applied at their first position)
+        """
+        templates = list(OrderedDict((template.pk, template) for template in templates).values())
+        chunk_size = chunk_size or app_settings.CHUNK_SIZE
+        configs = configs.select_related('device')
+        results = {}
+        errors = {}
+        for chunk in chunked_queryset(configs, chunk_size):
+            for config in chunk:
+                key = (config.organization_id, config.backend,
+                       json.dumps(config.config, sort_keys=True))
+                if key not in results:
+                    results[key] = cls._validate_bulk_templates(config, templates)
+                if results[key]:
+                    errors[config.device.name] = results[key]
+        if errors:
+            raise ValidationError(errors)
+        through = cls.templates.through
+        vpnclient_model = cls.vpn.through
+        vpn_templates = [t for t in templates if t.type == 'vpn']
+        with transaction.atomic():
+            count = cls.objects.filter(pk__in=configs.values('pk')).update(status='modified')
+            for chunk in chunked_queryset(configs, chunk_size):
+                pks = [config.pk for config in chunk]
+                through.objects.filter(config__in=pks).delete()
+                through.objects.bulk_create([
+                    through(config_id=pk, template=template, sort_value=i)
+                    for pk in pks
+                    for i, template in enumerate(templates, 1)
+                ])
+                vpnclient_model.objects.filter(config__in=pks) \
+                                       .exclude(vpn__in=[t.vpn_id for t in vpn_templates]) \
+                                       .delete()
+                vpnclient_model.bulk_create_clients(chunk, vpn_templates)
+        # bulk operations don't send signals
+        Device.invalidate_all_auth_cache()
+        pin_primary()
+        return count
+
+    @classmethod
+    def _validate_bulk_templates(cls, config, templates):
+        """
+        returns the errors of ``clean_templates``, ``None`` if valid
+        """
+        try:
+            cls.clean_templates('pre_add', config, templates)
+        except ValidationError as e:
+            return ' '.join(e.messages)
+
+    @classmethod
+    def manage_vpn_clients(cls, action, instance, pk_set, **kwargs):
+        """
+        like ``TemplatesVpnMixin.manage_vpn_clients`` of django-netjsonconfig,
+        but VPN clients are created with ``VpnClient.bulk_create_clients``;
+        adds support for changes performed on the template side of the
+        relationship (eg: ``template.config_relations.add(*configs)``)
+        """
+        if kwargs.get('reverse'):
+            return cls._manage_vpn_clients_reverse(action, instance, pk_set)
+        if action != 'post_add':
+            return super(TemplatesVpnMixin, cls).manage_vpn_clients(action, instance, pk_set, **kwargs)
+        templates = cls.get_template_model().objects.filter(pk__in=list(pk_set), type='vpn')
+        cls.vpn.through.bulk_create_clients([instance], templates)
+
+    @classmethod
+    def _manage_vpn_clients_reverse(cls, action, template, pk_set):
+        if template.type != 'vpn':
+            return
+        vpnclient_model = cls.vpn.through
+        if action == 'post_add':
+            configs = cls.objects.filter(pk__in=pk_set).select_related('device')
+            vpnclient_model.bulk_create_clients(configs, [template])
+        elif action == 'post_remove':
+            vpnclient_model.objects.filter(config__in=pk_set, vpn=template.vpn_id).delete()
+        # pk_set is not available in post_clear
+        elif action == 'pre_clear':
+            vpnclient_model.objects.filter(config__templates=template, vpn=template.vpn_id).delete()
+
+    def get_context(self):
+        """
+        like ``TemplatesVpnMixin.get_context`` of django-netjsonconfig
+        but uses the cached context of each VPN client
+        """
+        c = super(BaseMixin, self).get_context()
+        c.update(self.get_vpn_context())
+        return c
+
+    def get_vpn_context(self):
+        """
+        returns the VPN context (CA, cert and key contents and paths) of the
+        VPN clients of this config; the context of each VPN client is cached
+        along with the modification times of its VPN, CA and certificate,
+        a cached block is reused only if these have not changed
+        """
+        vpnclient_model = self.vpn.through
+        versions = {}
+        for row in self.vpnclient_set.values_list('pk', 'vpn_id', 'vpn__modified',
+                                                  'vpn__ca__modified', 'cert_id', 'cert__modified'):
+            versions[row[0]] = row[1:]
+        if not versions:
+            return {}
+        cache = get_cache()
+        keys = dict((pk, vpnclient_model.get_context_cache_key(pk)) for pk in versions.keys())
+        cached = cache.get_many(keys.values())
+        c = {}
+        missing = []
+        for pk, version in versions.items():
+            value = cached.get(keys[pk])
+            if value and value[0] == version:
+                c.update(value[1])
+            else:
+                missing.append(pk)
+        metrics.cache_requests.inc(len(versions) - len(missing), cache='vpn_context', result='hit')
+        metrics.cache_requests.inc(len(missing), cache='vpn_context', result='miss')
+        if missing:
+            to_cache = {}
+            queryset = self.vpnclient_set.filter(pk__in=missing) \
+                                         .select_related('vpn', 'vpn__ca', 'cert')
+            for vpnclient in queryset:
+                context = vpnclient.get_context()
+                c.update(context)
+                to_cache[keys[vpnclient.pk]] = (versions[vpnclient.pk], context)
+            cache.set_many(to_cache, app_settings.CACHE_TIMEOUT)
+        return c
 
 
 class Device(OrgMixin, AbstractDevice):
     """
     Concrete Device model
     """
+    search = models.CharField(max_length=255,
+                              blank=True,
+                              editable=False,
+                              help_text=_('normalized name, mac address and last ip, '
+                                          'matched by searches'))
+
     class Meta(AbstractDevice.Meta):
         abstract = False
+        index_together = ('organization', 'name')
+
+    def save(self, *args, **kwargs):
+        self.search = self._get_search()
+        super(Device, self).save(*args, **kwargs)
+
+    def _get_search(self):
+        """
+        returns the search text of the device; the last ip is looked up
+        only if name or mac address differ from the ones of the current
+        search text, which otherwise is kept (it's updated by
+        ``config_search_changed`` when the last ip changes)
+        """
+        search = get_search_text(self.name, self.mac_address)
+        current = self.__dict__.get('search') or ''
+        if self._state.adding:
+            return search
+        if (current + ' ').startswith(search + ' '):
+            return current
+        if type(self).config.is_cached(self):
+            last_ip = self.config.last_ip
+        else:
+            last_ip = Config.objects.filter(device=self) \
+                                    .values_list('last_ip', flat=True) \
+                                    .first()
+        return get_search_text(self.name, self.mac_address, last_ip)
+
+    @staticmethod
+    def get_search_query(search):
+        """
+        returns a ``Q`` object which matches the devices whose ``search``
+        contains every word of ``search``; the lookup is served by
+        the trigram index of ``search`` on PostgreSQL
+        """
+        query = Q()
+        for word in search.lower().split():
+            query &= Q(search__contains=word)
+        return query
+
+    @classmethod
+    def update_search(cls, pks, last_ip):
+        """
+        updates the search text of the devices ``pks``
+        whose last ip has been changed to ``last_ip``
+        """
+        devices = cls.objects.filter(pk__in=pks).values_list('pk', 'name', 'mac_address')
+        cases = [When(pk=pk, then=Value(get_search_text(name, mac_address, last_ip)))
+                 for pk, name, mac_address in devices]
+        if cases:
+            cls.objects.filter(pk__in=pks).update(search=Case(*cases, output_field=models.CharField()))
+
+    @classmethod
+    def config_search_changed(cls, instance, **kwargs):
+        """
+        updates the search text of the device of the configuration
+        ``instance`` if its last ip changed, used as handler of
+        ``post_save`` of ``Config``
+        """
+        device = instance.device
+        search = get_search_text(device.name, device.mac_address, instance.last_ip)
+        if device.search != search:
+            cls.objects.filter(pk=device.pk).update(search=search)
+            device.search = search
+
+    @staticmethod
+    def _get_auth_pk(pk):
+        """
+        returns the hex of the UUID ``pk``, so that the cache keys of a
+        device don't depend on the format of ``pk`` (eg: devices use the
+        hex, while instances have ``UUID`` objects)
+        """
+        try:
+            return uuid.UUID(str(pk)).hex
+        except ValueError:
+            return str(pk)
+
+    @classmethod
+    def get_auth_cache_key(cls, pk):
+        return get_cache_key('device_auth', cls._get_auth_pk(pk))
+
+    @classmethod
+    def _get_auth_version_key(cls, pk):
+        return get_cache_key('device_auth_version', cls._get_auth_pk(pk))
+
+    @staticmethod
+    def hash_key(key):
+        return salted_hmac('openwisp_controller.device_auth', key).hexdigest()
+
+    @classmethod
+    def check_auth_key(cls, auth_data, key):
+        return constant_time_compare(cls.hash_key(key), auth_data['key_hash'])
+
+    @staticmethod
+    def _get_auth_generation():
+        """
+        returns the token of the current generation of cached
+        auth data, entries of previous generations are ignored
+        """
+        return get_generation('device_auth_generation')
+
+    @classmethod
+    def _get_auth_versions(cls, pks):
+        """
+        returns a dict which maps each of ``pks`` to the version of its
+        auth data (``None`` if it has never been invalidated); the version
+        is read before the database, so that the data built meanwhile an
+        invalidation is stored with a version which is not current anymore
+        """
+        keys = dict((pk, cls._get_auth_version_key(pk)) for pk in pks)
+        versions = get_cache().get_many(list(keys.values()))
+        return dict((pk, versions.get(key)) for pk, key in keys.items())
+
+    @staticmethod
+    def _is_auth_data_valid(data, generation, version):
+        return data is not None and data['generation'] == generation and data.get('version') == version
+
+    @classmethod
+    def get_auth_data(cls, pk):
+        """
+        returns a dict with the data needed to answer the controller
+        requests of device ``pk`` (hash of the key, organization id and
+        active flag, config id, checksum and last ip) or ``None`` if the device
+        does not exist or has no configuration; the data is cached
+        and reused until the device or its configuration are changed
+        """
+        cache = get_cache()
+        key = cls.get_auth_cache_key(pk)
+        data = cache.get(key)
+        generation = cls._get_auth_generation()
+        version = cls._get_auth_versions([pk])[pk]
+        if cls._is_auth_data_valid(data, generation, version):
+            metrics.cache_requests.inc(cache='auth', result='hit')
+            return data
+        metrics.cache_requests.inc(cache='auth', result='miss')
+        try:
+            device = cls.objects.select_related('config', 'organization') \
+                                .get(pk=pk, config__isnull=False)
+        except (cls.DoesNotExist, ValidationError, ValueError):
+            return None
+        data = cls._build_auth_data(device, generation, version)
+        cache.set(key, data, app_settings.CACHE_TIMEOUT)
+        return data
+
+    @classmethod
+    def get_many_auth_data(cls, pks):
+        """
+        like ``get_auth_data`` but for many devices: cached data
+        is fetched at once and the data which is missing is looked
+        up with a single query; returns a dict which maps each pk
+        to its data (``None`` for missing devices)
+        """
+        cache = get_cache()
+        keys = OrderedDict((pk, cls.get_auth_cache_key(pk)) for pk in pks)
+        cached = cache.get_many(list(keys.values()))
+        generation = cls._get_auth_generation()
+        versions = cls._get_auth_versions(pks)
+        result = OrderedDict()
+        missing = []
+        for pk, key in keys.items():
+            data = cached.get(key)
+            if cls._is_auth_data_valid(data, generation, versions[pk]):
+                result[pk] = data
+            else:
+                result[pk] = None
+                missing.append(pk)
+        metrics.cache_requests.inc(len(keys) - len(missing), cache='auth', result='hit')
+        metrics.cache_requests.inc(len(missing), cache='auth', result='miss')
+        valid = {}
+        for pk in missing:
+            try:
+                valid[uuid.UUID(pk)] = pk
+            except ValueError:
+                continue
+        if not valid:
+            return result
+        devices = cls.objects.select_related('config', 'organization') \
+                             .filter(pk__in=list(valid.keys()), config__isnull=False)
+        found = {}
+        for device in devices:
+            pk = valid[device.pk]
+            data = cls._build_auth_data(device, generation, versions[pk])
+            result[pk] = data
+            found[keys[pk]] = data
+        cache.set_many(found, app_settings.CACHE_TIMEOUT)
+        return result
+
+    @classmethod
+    def get_cached_auth_data(cls, pks):
+        """
+        returns a dict which maps each pk of ``pks`` whose auth data is
+        cached (and up to date) to its data, without querying the database
+        """
+        keys = dict((pk, cls.get_auth_cache_key(pk)) for pk in pks)
+        cached = get_cache().get_many(list(keys.values()))
+        generation = cls._get_auth_generation()
+        versions = cls._get_auth_versions(pks)
+        result = {}
+        for pk, key in keys.items():
+            data = cached.get(key)
+            if cls._is_auth_data_valid(data, generation, versions[pk]):
+                result[pk] = data
+        return result
+
+    @classmethod
+    def _build_auth_data(cls, device, generation, version, checksum=None):
+        config = device.config
+        return {'generation': generation,
+                'version': version,
+                'key_hash': cls.hash_key(device.key),
+                'organization_id': device.organization_id,
+                'organization_active': device.organization.is_active,
+                'config_id': config.pk,
+                'checksum': checksum or config.checksum,
+                'last_ip': config.last_ip}
+
+    @classmethod
+    def update_auth_last_ip(cls, pk, auth_data, last_ip):
+        """
+        updates ``last_ip`` of the configuration without
+        discarding the cached auth data of the device
+        """
+        config_model = cls.get_config_model()
+        config_model.objects.filter(pk=auth_data['config_id']).update(last_ip=last_ip)
+        cls.update_search([pk], last_ip)
+        auth_data['last_ip'] = last_ip
+        get_cache().set(cls.get_auth_cache_key(pk), auth_data, app_settings.CACHE_TIMEOUT)
+
+    @classmethod
+    def update_many_auth_last_ip(cls, auth_data, last_ip):
+        """
+        like ``update_auth_last_ip`` for a dict which maps
+        the pk of each device to its auth data
+        """
+        config_model = cls.get_config_model()
+        config_model.objects.filter(pk__in=[data['config_id'] for data in auth_data.values()]) \
+                            .update(last_ip=last_ip)
+        cls.update_search(list(auth_data.keys()), last_ip)
+        for data in auth_data.values():
+            data['last_ip'] = last_ip
+        get_cache().set_many(dict((cls.get_auth_cache_key(pk), data) for pk, data in auth_data.items()),
+                             app_settings.CACHE_TIMEOUT)
+
+    @classmethod
+    def invalidate_auth_cache(cls, instance, **kwargs):
+        """
+        invalidates the cached auth data of a device and publishes
+        the change (see ``pubsub``), used as handler of signals sent
+        by ``Device`` and ``Config`` (and by the ``templates`` relation
+        of ``Config``, on both sides)
+        """
+        if not kwargs.get('reverse'):
+            device_pk = instance.pk if isinstance(instance, cls) else instance.device_id
+            return cls.invalidate_many_auth_cache([device_pk])
+        # changes performed on the template side of the relationship
+        action = kwargs.get('action')
+        if action in ['post_add', 'post_remove']:
+            devices = cls.objects.filter(config__in=kwargs['pk_set'])
+        # pk_set is not available in post_clear
+        elif action == 'pre_clear':
+            devices = cls.objects.filter(config__templates=instance)
+        else:
+            return
+        cls.invalidate_many_auth_cache(list(devices.values_list('pk', flat=True)))
+
+    # lookups of the devices affected by the changes of related objects
+    _auth_lookups = {
+        'organization': 'organization',
+        'template': 'config__templates',
+        'vpn': 'config__vpnclient__vpn',
+        'ca': 'config__vpnclient__vpn__ca',
+        'cert': 'config__vpnclient__cert',
+    }
+
+    @classmethod
+    def invalidate_related_auth_cache(cls, instance, **kwargs):
+        """
+        invalidates the cached auth data of the devices affected by the
+        ``Organization``, ``Template``, ``Vpn``, ``Ca`` or ``Cert`` instance
+        which has been saved or is going to be deleted (relations are
+        removed along with the instance, hence ``pre_delete`` is used)
+        """
+        lookup = cls._auth_lookups[instance._meta.model_name]
+        pks = cls.objects.filter(**{lookup: instance}).values_list('pk', flat=True).distinct()
+        cls.invalidate_many_auth_cache(list(pks))
+
+    @classmethod
+    def invalidate_many_auth_cache(cls, pks):
+        """
+        invalidates the cached auth data of the devices ``pks`` and
+        publishes the change to each of them; the data is invalidated
+        again once the current transaction is committed, in case it
+        has been cached meanwhile by another process
+        """
+        pks = list(pks)
+        cls._invalidate_auth_data(pks)
+        transaction.on_commit(lambda: cls._invalidate_auth_data(pks))
+        for pk in pks:
+            publish_change(pk)
+
+    @classmethod
+    def _invalidate_auth_data(cls, pks):
+        cache = get_cache()
+        chunk_size = app_settings.CHUNK_SIZE
+        for i in range(0, len(pks), chunk_size):
+            chunk = pks[i:i + chunk_size]
+            cache.set_many(dict((cls._get_auth_version_key(pk), uuid.uuid4().hex) for pk in chunk),
+                           app_settings.CACHE_TIMEOUT)
+            cache.delete_many([cls.get_auth_cache_key(pk) for pk in chunk])
+
+    @classmethod
+    def invalidate_all_auth_cache(cls, **kwargs):
+        """
+        invalidates the cached auth data of every device and publishes
+        the change to every device, used by bulk operations which may
+        affect many devices (eg: ``Config.bulk_set_templates``)
+        """
+        bump_generation('device_auth_generation')
+        publish_change()
 
 
 class Config(OrgMixin, TemplatesVpnMixin, AbstractConfig):
@@ -91,15 +616,238 @@ class Config(OrgMixin, TemplatesVpnMixin, AbstractConfig):
                                  through='config.VpnClient',
                                  related_name='vpn_relations',
                                  blank=True)
+    content = models.ForeignKey('config.ConfigContent',
+                                null=True,
+                                blank=True,
+                                editable=False,
+                                on_delete=models.PROTECT,
+                                related_name='configs')
 
     class Meta(AbstractConfig.Meta):
         abstract = False
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """
+        loads ``config`` from the shared ``content`` if any
+        (see ``OPENWISP_CONTROLLER_SHARED_CONFIG``)
+        """
+        instance = super(Config, cls).from_db(db, field_names, values)
+        if 'config' in instance.__dict__ and instance.content_id:
+            instance.config = ConfigContent.load(instance.content_id)
+        return instance
+
+    def save(self, *args, **kwargs):
+        """
+        if ``OPENWISP_CONTROLLER_SHARED_CONFIG`` is ``True`` the
+        configuration is stored in a ``ConfigContent`` shared by the
+        configurations which are identical (otherwise it's stored in
+        the ``config`` column as usual)
+        """
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'config' in update_fields:
+            self.content_id = self._get_content_id()
+            if update_fields is not None:
+                kwargs['update_fields'] = list(update_fields) + ['content']
+        super(Config, self).save(*args, **kwargs)
+
+    def _get_content_id(self):
+        if not app_settings.SHARED_CONFIG or not self.config:
+            return None
+        # the content is already stored if the configuration is unchanged
+        checksum = ConfigContent.get_checksum(ConfigContent.dumps(self.config))
+        if self.content_id == checksum:
+            return checksum
+        return ConfigContent.store(self.config)
+
+    def _save_table(self, *args, **kwargs):
+        # the ``config`` column of shared configurations is left empty
+        if not self.content_id:
+            return super(Config, self)._save_table(*args, **kwargs)
+        config = self.config
+        self.config = {}
+        try:
+            return super(Config, self)._save_table(*args, **kwargs)
+        finally:
+            self.config = config
+
+    @classmethod
+    def bulk_insert(cls, configs):
+        """
+        like ``Config.objects.bulk_create``, but stores the
+        configurations like ``save`` (see ``ConfigContent``)
+        """
+        if not app_settings.SHARED_CONFIG:
+            return cls.objects.bulk_create(configs)
+        checksums = ConfigContent.store_many([config.config for config in configs])
+        originals = []
+        for config, checksum in zip(configs, checksums):
+            originals.append(config.config)
+            config.content_id = checksum
+            if checksum:
+                config.config = {}
+        try:
+            return cls.objects.bulk_create(configs)
+        finally:
+            for config, original in zip(configs, originals):
+                config.config = original
+
     def clean(self):
         if not hasattr(self, 'organization') and self._has_device():
             self.organization = self.device.organization
         super(Config, self).clean()
 
+    def generate(self):
+        """
+        observes the rendering time in
+        ``openwisp_controller.metrics.config_render_duration``
+        and profiles it (see ``GenerationProfile``)
+        """
+        with metrics.config_render_duration.time(backend=self.backend), \
+                GenerationProfile.measure('generate', self):
+            return super(Config, self).generate()
+
+    @staticmethod
+    def get_archive_cache_key(pk, checksum=None):
+        if checksum is None:
+            return get_cache_key('config_archives', pk)
+        return get_cache_key('config_archive', pk, checksum)
+
+    def get_archive(self):
+        """
+        generates the configuration archive and adds it to
+        the archive history of the configuration, which keeps
+        the last ``OPENWISP_CONTROLLER_ARCHIVE_HISTORY`` archives
+        """
+        contents = self.generate().getvalue()
+        new = True
+        if app_settings.ARCHIVE_HISTORY:
+            new = self.store_archive(contents)[1]
+        # the latest archive of the history has been recorded already
+        if new and app_settings.CONFIG_HISTORY:
+            ConfigVersion.record(self, contents)
+        return contents
+
+    def get_current_archive(self):
+        """
+        like ``get_archive``, but returns the archive from the archive
+        history if the checksum of the current configuration is known
+        (cached auth data of the device, see ``Device.get_auth_data``)
+        """
+        auth_data = Device.get_cached_auth_data([str(self.device_id)]).get(str(self.device_id))
+        if auth_data and app_settings.ARCHIVE_HISTORY:
+            contents = get_cache().get(self.get_archive_cache_key(self.pk, auth_data['checksum']))
+            if contents is not None:
+                metrics.cache_requests.inc(cache='archive', result='hit')
+                return contents
+        metrics.cache_requests.inc(cache='archive', result='miss')
+        return self.get_archive()
+
+    @classmethod
+    def warm_cache(cls, pks):
+        """
+        renders the configurations ``pks`` and stores their archives
+        (see ``store_archive``) and the auth data of their devices in the
+        cache, so that the first requests of the devices are answered
+        without rendering; no ``ConfigVersion`` is recorded; returns the
+        number of configurations which have been rendered and the number
+        of those which failed
+        """
+        # versions are read before the configurations (see ``Device._get_auth_versions``)
+        generation = Device._get_auth_generation()
+        versions = Device._get_auth_versions(cls.objects.filter(pk__in=pks)
+                                                        .values_list('device_id', flat=True))
+        configs = cls.objects.select_related('device__organization').filter(pk__in=pks)
+        auth_data = {}
+        errors = 0
+        for config in configs:
+            try:
+                contents = config.generate().getvalue()
+            # invalid configurations are skipped
+            except (ValidationError, SchemaError) as e:
+                logger.warning('Configuration {0} could not be rendered: {1}'.format(config.pk, e))
+                errors += 1
+                continue
+            if app_settings.ARCHIVE_HISTORY:
+                config.store_archive(contents)
+            device = config.device
+            data = Device._build_auth_data(device, generation, versions.get(device.pk),
+                                           get_checksum(contents))
+            auth_data[Device.get_auth_cache_key(device.pk)] = data
+        get_cache().set_many(auth_data, app_settings.CACHE_TIMEOUT)
+        return len(auth_data), errors
+
+    def store_archive(self, contents):
+        """
+        adds ``contents`` to the archive history, returns its
+        checksum and whether it differs from the latest archive
+        of the history
+        """
+        cache = get_cache()
+        checksum = get_checksum(contents)
+        index_key = self.get_archive_cache_key(self.pk)
+        stored = cache.get(index_key, [])
+        new = not stored or stored[-1] != checksum
+        checksums = [c for c in stored if c != checksum]
+        checksums.append(checksum)
+        expired = checksums[:-app_settings.ARCHIVE_HISTORY]
+        checksums = checksums[-app_settings.ARCHIVE_HISTORY:]
+        cache.set_many({index_key: checksums,
+                        self.get_archive_cache_key(self.pk, checksum): contents},
+                       app_settings.CACHE_TIMEOUT)
+        if expired:
+            cache.delete_many([self.get_archive_cache_key(self.pk, c) for c in expired])
+        return checksum, new
+
+    @classmethod
+    def delete_archive_cache(cls, pks):
+        """
+        deletes the archive history of the configurations ``pks``
+        """
+        cache = get_cache()
+        index_keys = dict((cls.get_archive_cache_key(pk), pk) for pk in pks)
+        keys = list(index_keys.keys())
+        for index_key, checksums in cache.get_many(keys).items():
+            keys.extend(cls.get_archive_cache_key(index_keys[index_key], c) for c in checksums)
+        cache.delete_many(keys)
+
+    def get_stored_archive(self, checksum):
+        """
+        returns the archive with ``checksum`` from the archive
+        history of the configuration or from the stored versions,
+        ``None`` if not available
+        """
+        contents = get_cache().get(self.get_archive_cache_key(self.pk, checksum))
+        if contents is None and app_settings.CONFIG_HISTORY:
+            version = self.versions.filter(checksum=checksum).first()
+            if version:
+                contents = version.get_archive()
+        return contents
+
+    def get_version_at(self, when):
+        """
+        returns the ``ConfigVersion`` which was current
+        at the datetime ``when``, ``None`` if not available
+        """
+        return self.versions.filter(created__lte=when).first()
+
+    def get_archive_delta(self, checksum, contents=None):
+        """
+        returns ``(archive, removed)``, where ``archive`` contains only
+        the files which changed since the archive identified by
+        ``checksum`` was delivered and ``removed`` lists the paths of
+        the files which have been removed; if ``checksum`` is not in the
+        archive history ``archive`` is the full archive and ``removed``
+        is ``None``
+        """
+        if contents is None:
+            contents = self.get_archive()
+        previous = self.get_stored_archive(checksum)
+        if previous is None:
+            return contents, None
+        changed, removed = diff_archives(read_archive(previous), read_archive(contents))
+        return build_archive(changed), removed
+
 
 class TemplateTag(AbstractTemplateTag):
     """
@@ -141,6 +889,59 @@ class Template(ShareableOrgMixin, AbstractTemplate):
         self._validate_org_relation('vpn')
         super(Template, self).clean()
 
+    @staticmethod
+    def get_tag_index_cache_key(organization_pk):
+        return get_cache_key('template_tags', organization_pk)
+
+    @classmethod
+    def get_tag_index(cls, organization_pk):
+        """
+        returns a dict which maps the name of each tag to the
+        ``(position, pk)`` tuples of the templates of the organization
+        (and shared templates) which have the tag, positions follow
+        the order of the template names; the index is built with one
+        query and cached until templates or tags are changed
+        """
+        cache = get_cache()
+        key = cls.get_tag_index_cache_key(organization_pk)
+        generation = get_generation('template_tags_generation')
+        cached = cache.get(key)
+        if cached and cached[0] == generation:
+            metrics.cache_requests.inc(cache='tag_index', result='hit')
+            return cached[1]
+        metrics.cache_requests.inc(cache='tag_index', result='miss')
+        index = {}
+        positions = {}
+        rows = cls.objects.filter(Q(organization=organization_pk) | Q(organization=None),
+                                  tags__isnull=False) \
+                          .order_by('name', 'pk') \
+                          .values_list('tags__name', 'pk')
+        for tag, pk in rows:
+            position = positions.setdefault(pk, len(positions))
+            index.setdefault(tag, []).append((position, pk))
+        cache.set(key, (generation, index), app_settings.CACHE_TIMEOUT)
+        return index
+
+    @classmethod
+    def get_tagged_template_pks(cls, organization_pk, tags):
+        """
+        returns the ordered primary keys of the templates which
+        have any of ``tags`` (see ``get_tag_index``)
+        """
+        index = cls.get_tag_index(organization_pk)
+        items = set()
+        for tag in tags:
+            items.update(index.get(tag, []))
+        return [pk for position, pk in sorted(items)]
+
+    @classmethod
+    def invalidate_tag_index(cls, **kwargs):
+        """
+        invalidates the tag index of every organization, used as handler
+        of signals sent by ``Template``, ``TemplateTag`` and ``TaggedTemplate``
+        """
+        bump_generation('template_tags_generation')
+
 
 class Vpn(ShareableOrgMixin, AbstractVpn):
     """
@@ -152,6 +953,11 @@ class Vpn(ShareableOrgMixin, AbstractVpn):
                              help_text=_('leave blank to create automatically'),
                              blank=True,
                              null=True)
+    dh_pending = models.BooleanField(_('DH parameters pending'),
+                                     default=False,
+                                     editable=False,
+                                     db_index=True,
+                                     help_text=_('DH parameters are being generated in background'))
 
     class Meta(AbstractVpn.Meta):
         abstract = False
@@ -160,6 +966,65 @@ class Vpn(ShareableOrgMixin, AbstractVpn):
         self._validate_org_relation('ca')
         self._validate_org_relation('cert')
 
+    def save(self, *args, **kwargs):
+        """
+        like ``AbstractVpn.save``, but if ``OPENWISP_CONTROLLER_DH_ASYNC``
+        is ``True`` DH parameters are taken from the pre-generated pool;
+        if the pool is empty the VPN is saved right away in pending state
+        and the DH parameters are generated by a background job
+        """
+        if not app_settings.DH_ASYNC:
+            self.dh_pending = False
+            return super(Vpn, self).save(*args, **kwargs)
+        if not self.cert:
+            self.cert = self._auto_create_cert()
+        if not self.dh and not self._state.adding:
+            # do not overwrite parameters generated meanwhile
+            self.dh = self.__class__.objects.filter(pk=self.pk) \
+                                            .values_list('dh', flat=True) \
+                                            .first() or ''
+        if not self.dh:
+            self.dh = dh_pool.get(app_settings.DH_LENGTH) or ''
+            if self.dh:
+                # replaces the parameters taken from the pool
+                dh_pool.fill(app_settings.DH_LENGTH, self.dhparam)
+        self.dh_pending = not self.dh
+        # skips AbstractVpn.save, which generates DH parameters synchronously
+        super(AbstractVpn, self).save(*args, **kwargs)
+        if self.dh_pending:
+            pk = self.pk
+            transaction.on_commit(lambda: self.__class__.schedule_dh(pk))
+
+    @classmethod
+    def schedule_dh(cls, pk):
+        """
+        submits the generation of the DH parameters of a pending VPN,
+        unless a job for the same VPN is still running in this process
+        """
+        return submit_once('vpn-dh-{0}'.format(pk), cls.generate_dh, pk)
+
+    @classmethod
+    def generate_dh(cls, pk, length=None):
+        """
+        generates the DH parameters of a pending VPN and saves it
+        (executed in background by ``Vpn.save`` and by the
+        ``generate_pending_dh`` management command), then
+        refills the pool for the VPNs which will be created next
+        """
+        if not cls.objects.filter(pk=pk, dh_pending=True).exists():
+            return
+        length = length or app_settings.DH_LENGTH
+        dh = dh_pool.get(length) or cls.dhparam(length)
+        with transaction.atomic():
+            vpn = cls.objects.select_for_update().filter(pk=pk, dh_pending=True).first()
+            # parameters may have been set meanwhile
+            if vpn is not None:
+                vpn.dh = dh
+                # a regular save sends the signals which notify
+                # devices about the change and updates ``modified``
+                vpn.save()
+        dh_pool.fill(length, cls.dhparam)
+
     def _auto_create_cert_extra(self, cert):
         """
         sets the organization on the server certificate
@@ -191,6 +1056,187 @@ class VpnClient(AbstractVpnClient):
         cert.organization = self.vpn.organization
         return cert
 
+    def _build_cert(self):
+        """
+        returns an unsaved client certificate for this VPN client,
+        built like the ones created by ``AbstractVpnClient.save``
+        """
+        device = self.config.device
+        ca = self.vpn.ca
+        cn = django_netjsonconfig_settings.COMMON_NAME_FORMAT.format(**device.__dict__)
+        cert_model = self.__class__.cert.field.related_model
+        cert = cert_model(name=device.name,
+                          ca=ca,
+                          key_length=ca.key_length,
+                          digest=str(ca.digest),
+                          country_code=ca.country_code,
+                          state=ca.state,
+                          city=ca.city,
+                          organization_name=ca.organization_name,
+                          email=ca.email,
+                          common_name=cn,
+                          extensions=[{'name': 'nsCertType',
+                                       'value': 'client',
+                                       'critical': False}])
+        return self._auto_create_cert_extra(cert)
+
+    @classmethod
+    def bulk_create_clients(cls, configs, templates):
+        """
+        creates the VPN clients needed by ``configs`` for the VPN templates
+        contained in ``templates`` with bulk queries; the certificates of
+        clients having ``auto_cert`` set are validated, signed in parallel
+        threads and inserted with ``bulk_create`` as well; bulk queries
+        don't send ``post_save``, hence the cached VPN context and auth
+        data of the configurations are invalidated here
+        returns the list of created VPN clients
+        """
+        vpn_templates = [template for template in templates if template.type == 'vpn']
+        if not vpn_templates or not configs:
+            return []
+        vpn_model = cls.vpn.field.related_model
+        vpns = vpn_model.objects.select_related('ca', 'organization') \
+                                .in_bulk(list(set(t.vpn_id for t in vpn_templates)))
+        existing = set(cls.objects.filter(config__in=configs, vpn__in=vpns.keys())
+                                  .values_list('config_id', 'vpn_id'))
+        clients = []
+        for config in configs:
+            for template in vpn_templates:
+                if (config.pk, template.vpn_id) in existing:
+                    continue
+                existing.add((config.pk, template.vpn_id))
+                clients.append(cls(config=config,
+                                   vpn=vpns[template.vpn_id],
+                                   auto_cert=template.auto_cert))
+        certs = [client._build_cert() for client in clients if client.auto_cert]
+        if certs:
+            cls._bulk_create_certs(certs)
+        for client, cert in zip([c for c in clients if c.auto_cert], certs):
+            client.cert = cert
+        cls.objects.bulk_create(clients, batch_size=app_settings.CHUNK_SIZE)
+        if clients:
+            config_pks = set(client.config_id for client in clients)
+            pks = cls.objects.filter(config__in=config_pks).values_list('pk', flat=True)
+            get_cache().delete_many([cls.get_context_cache_key(pk) for pk in pks])
+            Device.invalidate_many_auth_cache(set(client.config.device_id for client in clients))
+            pin_primary()
+        return clients
+
+    @classmethod
+    def _bulk_create_certs(cls, certs):
+        """
+        signs ``certs`` in parallel threads (key generation is
+        performed by OpenSSL, which releases the GIL) and
+        inserts them with ``bulk_create``
+        """
+        for cert in certs:
+            cert.full_clean()
+            cert.serial_number = str(uuid.uuid4().int)
+        workers = min(app_settings.CERT_SIGNING_WORKERS, len(certs))
+        if workers > 1:
+            pool = ThreadPool(workers)
+            try:
+                pool.map(lambda cert: cert._generate(), certs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for cert in certs:
+                cert._generate()
+        cert_model = cls.cert.field.related_model
+        cert_model.objects.bulk_create(certs, batch_size=app_settings.CHUNK_SIZE)
+        # primary keys are set by bulk_create only on some databases
+        if certs[0].pk is not None:
+            return
+        pks = {}
+        for i in range(0, len(certs), 500):
+            chunk = certs[i:i + 500]
+            qs = cert_model.objects.filter(serial_number__in=[cert.serial_number for cert in chunk]) \
+                                   .values_list('ca_id', 'serial_number', 'pk')
+            pks.update(((ca_id, serial), pk) for ca_id, serial, pk in qs)
+        for cert in certs:
+            cert.pk = pks[(cert.ca_id, cert.serial_number)]
+
+    def get_context(self):
+        """
+        returns the configuration context of this VPN client
+        (CA, cert and key contents and their paths)
+        """
+        vpn = self.vpn
+        vpn_id = vpn.pk.hex
+        context_keys = vpn._get_auto_context_keys()
+        ca = vpn.ca
+        cert = self.cert
+        cert_path = django_netjsonconfig_settings.CERT_PATH
+        ca_filename = 'ca-{0}-{1}.pem'.format(ca.pk, ca.common_name)
+        c = {
+            context_keys['ca_path']: '{0}/{1}'.format(cert_path, ca_filename),
+            context_keys['ca_contents']: ca.certificate
+        }
+        # conditional needed for VPN without x509 authentication
+        # eg: simple password authentication
+        if cert:
+            cert_filename = 'client-{0}.pem'.format(vpn_id)
+            key_filename = 'key-{0}.pem'.format(vpn_id)
+            c.update({
+                context_keys['cert_path']: '{0}/{1}'.format(cert_path, cert_filename),
+                context_keys['cert_contents']: cert.certificate,
+                context_keys['key_path']: '{0}/{1}'.format(cert_path, key_filename),
+                context_keys['key_contents']: cert.private_key,
+            })
+        return c
+
+    @staticmethod
+    def get_context_cache_key(pk):
+        return get_cache_key('vpnclient_context', pk)
+
+    _context_lookups = {
+        'vpn': 'vpn',
+        'ca': 'vpn__ca',
+        'cert': 'cert',
+    }
+
+    @classmethod
+    def invalidate_context_cache(cls, instance, **kwargs):
+        """
+        signal handler which deletes the cached context of the VPN
+        clients related to the ``VpnClient``, ``Vpn``, ``Ca``
+        or ``Cert`` instance which has been saved or deleted
+        """
+        if isinstance(instance, cls):
+            pks = [instance.pk]
+        else:
+            lookup = cls._context_lookups[instance._meta.model_name]
+            pks = cls.objects.filter(**{lookup: instance}).values_list('pk', flat=True)
+        get_cache().delete_many([cls.get_context_cache_key(pk) for pk in pks])
+
+    @classmethod
+    def renew_expiring_certs(cls, days=None, chunk_size=None):
+        """
+        renews automatically managed client certificates which
+        are going to expire within ``days`` (processed in chunks),
+        related configurations are flagged as modified with one
+        UPDATE query per chunk; meant to be called periodically
+        (eg: by the ``renew_expiring_certs`` management command)
+        returns the number of renewed certificates
+        """
+        days = days if days is not None else app_settings.CERT_RENEWAL_DAYS
+        chunk_size = chunk_size or app_settings.CHUNK_SIZE
+        cert_model = cls.cert.field.related_model
+        config_model = cls.config.field.related_model
+        certs = cert_model.objects.expiring(days) \
+                                  .filter(vpnclient__auto_cert=True) \
+                                  .select_related('ca', 'vpnclient')
+        renewed = 0
+        for chunk in chunked_queryset(certs, chunk_size):
+            for cert in chunk:
+                cert.renew()
+            config_ids = [cert.vpnclient.config_id for cert in chunk]
+            config_model.objects.filter(pk__in=config_ids) \
+                                .update(status='modified')
+            renewed += len(chunk)
+        return renewed
+
 
 @python_2_unicode_compatible
 class OrganizationConfigSettings(models.Model):
@@ -220,3 +1266,592 @@ class OrganizationConfigSettings(models.Model):
 
     def __str__(self):
         return self.organization.name
+
+
+@python_2_unicode_compatible
+class AbstractStoredContents(models.Model):
+    """
+    Abstract model of contents stored once and addressed by their
+    SHA-256 hash (``checksum``), ``contents_field`` is the name
+    of the field which holds the contents
+    """
+    checksum = models.CharField(max_length=64, primary_key=True)
+    contents_field = None
+
+    class Meta:
+        abstract = True
+
+    def __str__(self):
+        return self.checksum
+
+    @staticmethod
+    def get_checksum(contents):
+        raise NotImplementedError()
+
+    @classmethod
+    def store_contents(cls, contents_list):
+        """
+        stores the contents which are not present yet
+        """
+        contents = OrderedDict((cls.get_checksum(c), c) for c in contents_list)
+        existing = set(cls.objects.filter(pk__in=list(contents.keys()))
+                                  .values_list('pk', flat=True))
+        missing = [cls(**{'checksum': checksum, cls.contents_field: c})
+                   for checksum, c in contents.items()
+                   if checksum not in existing]
+        try:
+            with transaction.atomic():
+                cls.objects.bulk_create(missing)
+        # the same contents have been stored concurrently
+        except IntegrityError:
+            for obj in missing:
+                cls.objects.get_or_create(pk=obj.pk,
+                                          defaults={cls.contents_field: getattr(obj, cls.contents_field)})
+
+
+class ConfigContent(AbstractStoredContents):
+    """
+    NetJSON configuration shared by the ``Config`` objects whose
+    ``config`` is identical, stored once and addressed by the SHA-256
+    hash of its JSON; contents are immutable, hence they are kept in
+    the memory of each process (at most ``memory_size`` of them)
+    and in ``OPENWISP_CONTROLLER_CACHE`` once loaded
+    """
+    config = models.TextField()
+    contents_field = 'config'
+    memory_size = 1000
+    _memory = {}
+
+    class Meta:
+        verbose_name = _('configuration content')
+        verbose_name_plural = _('configuration contents')
+
+    @staticmethod
+    def dumps(config):
+        return json.dumps(config or {})
+
+    @staticmethod
+    def get_checksum(text):
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    @staticmethod
+    def get_cache_key(checksum):
+        return get_cache_key('config_content', checksum)
+
+    @classmethod
+    def _remember(cls, checksum, text):
+        if len(cls._memory) >= cls.memory_size:
+            cls._memory.clear()
+        cls._memory[checksum] = text
+
+    @classmethod
+    def load(cls, checksum):
+        """
+        returns (a new copy of) the configuration with ``checksum``
+        """
+        text = cls._memory.get(checksum)
+        if text is None:
+            cache = get_cache()
+            key = cls.get_cache_key(checksum)
+            text = cache.get(key)
+            if text is None:
+                metrics.cache_requests.inc(cache='config_content', result='miss')
+                text = cls.objects.values_list('config', flat=True).get(pk=checksum)
+                cache.set(key, text, app_settings.CACHE_TIMEOUT)
+            else:
+                metrics.cache_requests.inc(cache='config_content', result='hit')
+            cls._remember(checksum, text)
+        return json.loads(text, object_pairs_hook=OrderedDict)
+
+    @classmethod
+    def store(cls, config):
+        """
+        stores ``config`` if not present yet and returns its
+        checksum; empty configurations are not stored (``None``)
+        """
+        return cls.store_many([config])[0]
+
+    @classmethod
+    def store_many(cls, configs):
+        """
+        like ``store`` for a list of configurations,
+        returns the list of their checksums
+        """
+        texts = [cls.dumps(config) if config else None for config in configs]
+        cls.store_contents([text for text in texts if text])
+        return [cls.get_checksum(text) if text else None for text in texts]
+
+    @classmethod
+    def share_existing(cls, chunk_size=None):
+        """
+        moves the configurations stored in the ``config`` column
+        to shared contents, chunk by chunk; returns the number
+        of moved configurations
+        """
+        config_model = cls.configs.field.model
+        queryset = config_model.objects.filter(content=None).only('id', 'config', 'content')
+        moved = 0
+        for chunk in chunked_queryset(queryset, chunk_size or app_settings.CHUNK_SIZE):
+            chunk = [config for config in chunk if config.config]
+            checksums = cls.store_many([config.config for config in chunk])
+            pks_by_checksum = OrderedDict()
+            for config, checksum in zip(chunk, checksums):
+                pks_by_checksum.setdefault(checksum, []).append(config.pk)
+            with transaction.atomic():
+                for checksum, pks in pks_by_checksum.items():
+                    config_model.objects.filter(pk__in=pks).update(content=checksum, config={})
+            moved += len(chunk)
+        return moved
+
+    @classmethod
+    def inline_existing(cls, chunk_size=None):
+        """
+        moves the shared configurations back to the ``config``
+        column, returns the number of moved configurations
+        """
+        config_model = cls.configs.field.model
+        queryset = config_model.objects.exclude(content=None).only('id', 'config', 'content')
+        moved = 0
+        for chunk in chunked_queryset(queryset, chunk_size or app_settings.CHUNK_SIZE):
+            with transaction.atomic():
+                for config in chunk:
+                    config_model.objects.filter(pk=config.pk).update(content=None, config=config.config)
+            moved += len(chunk)
+        return moved
+
+    @classmethod
+    def delete_unreferenced(cls):
+        """
+        deletes the contents which are not referenced by any
+        configuration, returns the number of deleted contents
+        """
+        return cls.objects.filter(configs=None).delete()[0]
+
+
+class ConfigBlob(AbstractStoredContents):
+    """
+    Contents of a file of a rendered configuration,
+    stored once and addressed by its SHA-256 hash
+    """
+    contents = models.BinaryField()
+    contents_field = 'contents'
+
+    class Meta:
+        verbose_name = _('configuration blob')
+        verbose_name_plural = _('configuration blobs')
+
+    @staticmethod
+    def get_checksum(contents):
+        return hashlib.sha256(contents).hexdigest()
+
+    @classmethod
+    def delete_unreferenced(cls):
+        """
+        deletes the blobs which are not referenced by any
+        configuration version, returns the number of deleted blobs
+        """
+        return cls.objects.filter(files=None).delete()[0]
+
+
+@python_2_unicode_compatible
+class ConfigVersion(models.Model):
+    """
+    Configuration rendered at a certain time, the contents of
+    its files are stored in deduplicated ``ConfigBlob`` objects
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    config = models.ForeignKey('config.Config',
+                               on_delete=models.CASCADE,
+                               related_name='versions')
+    checksum = models.CharField(max_length=32, db_index=True)
+    created = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        verbose_name = _('configuration version')
+        verbose_name_plural = _('configuration versions')
+        ordering = ('-created',)
+        index_together = ('config', 'created')
+
+    def __str__(self):
+        return '{0} ({1})'.format(self.checksum, self.created)
+
+    @staticmethod
+    def get_latest_cache_key(config_pk):
+        return get_cache_key('config_version', config_pk)
+
+    @classmethod
+    def record(cls, config, contents=None):
+        """
+        stores the configuration archive ``contents`` (generated if
+        not passed) as a new version of ``config``, unless it is equal
+        to the latest version; returns the new version or ``None``
+        """
+        if contents is None:
+            contents = config.get_backend_instance().generate().getvalue()
+        checksum = get_checksum(contents)
+        cache = get_cache()
+        cache_key = cls.get_latest_cache_key(config.pk)
+        if cache.get(cache_key) == checksum:
+            return None
+        # a lagging replica would lead to duplicate versions and blobs
+        with use_primary():
+            latest = cls.objects.filter(config=config).values_list('checksum', flat=True).first()
+            if latest != checksum:
+                files = read_archive(contents)
+                ConfigBlob.store_contents([c for mode, c in files.values()])
+                with transaction.atomic():
+                    version = cls.objects.create(config=config, checksum=checksum)
+                    ConfigVersionFile.objects.bulk_create([
+                        ConfigVersionFile(version=version,
+                                          blob_id=ConfigBlob.get_checksum(c),
+                                          path=path,
+                                          mode=mode)
+                        for path, (mode, c) in files.items()
+                    ])
+            else:
+                version = None
+        cache.set(cache_key, checksum, app_settings.CACHE_TIMEOUT)
+        return version
+
+    def get_archive(self):
+        """
+        rebuilds the configuration archive of this version
+        """
+        files = OrderedDict()
+        for f in self.files.select_related('blob').order_by('id'):
+            files[f.path] = (f.mode, bytes(f.blob.contents))
+        return build_archive(files)
+
+    @classmethod
+    def delete_expired(cls, days=None, chunk_size=None):
+        """
+        deletes the versions older than ``days`` (defaults to
+        ``OPENWISP_CONTROLLER_CONFIG_HISTORY_RETENTION``), the latest
+        version of each configuration is always kept; blobs which are
+        not referenced anymore are deleted too;
+        returns ``(deleted versions, deleted blobs)``
+        """
+        if days is None:
+            days = app_settings.CONFIG_HISTORY_RETENTION
+        if days is None:
+            return 0, 0
+        chunk_size = chunk_size or app_settings.CHUNK_SIZE
+        latest = cls.objects.filter(config=OuterRef('config')) \
+                            .order_by('-created', '-pk') \
+                            .values('pk')[:1]
+        queryset = cls.objects.filter(created__lt=timezone.now() - timedelta(days=days)) \
+                              .annotate(latest=Subquery(latest)) \
+                              .exclude(pk=F('latest')) \
+                              .only('pk')
+        deleted = 0
+        for chunk in chunked_queryset(queryset, chunk_size):
+            expired = cls.objects.filter(pk__in=[version.pk for version in chunk])
+            deleted += expired.delete()[1].get(cls._meta.label, 0)
+        return deleted, ConfigBlob.delete_unreferenced()
+
+
+@python_2_unicode_compatible
+class ConfigVersionFile(models.Model):
+    """
+    File of a ``ConfigVersion``
+    """
+    version = models.ForeignKey(ConfigVersion,
+                                on_delete=models.CASCADE,
+                                related_name='files')
+    blob = models.ForeignKey(ConfigBlob,
+                             on_delete=models.PROTECT,
+                             related_name='files')
+    path = models.CharField(max_length=255)
+    mode = models.PositiveIntegerField()
+
+    class Meta:
+        verbose_name = _('configuration version file')
+        verbose_name_plural = _('configuration version files')
+
+    def __str__(self):
+        return self.path
+
+
+@python_2_unicode_compatible
+class GenerationProfile(models.Model):
+    """
+    Time spent generating (or validating) the configurations of
+    an organization with a backend, collected when
+    ``OPENWISP_CONTROLLER_PROFILING`` is enabled; rows without
+    template hold the totals of the organization, rows with
+    template the time of the configurations which use it.
+    Samples slower than ``OPENWISP_CONTROLLER_PROFILING_THRESHOLD``
+    are profiled with cProfile and the statistics of the
+    slowest one are kept in ``profile``
+    """
+    OPERATIONS = (
+        ('generate', _('generate')),
+        ('validate', _('validate')),
+    )
+    operation = models.CharField(max_length=8, choices=OPERATIONS)
+    organization = models.ForeignKey('openwisp_users.Organization',
+                                     on_delete=models.CASCADE)
+    template = models.ForeignKey('config.Template',
+                                 on_delete=models.CASCADE,
+                                 blank=True,
+                                 null=True)
+    backend = models.CharField(max_length=128)
+    count = models.PositiveIntegerField(default=0)
+    total_time = models.FloatField(default=0)
+    max_time = models.FloatField(default=0)
+    profile = models.TextField(blank=True)
+    profile_time = models.FloatField(blank=True, null=True)
+    modified = models.DateTimeField(default=timezone.now)
+
+    _local = threading.local()
+
+    class Meta:
+        verbose_name = _('generation profile')
+        verbose_name_plural = _('generation profiles')
+        index_together = ('operation', 'organization', 'template', 'backend')
+
+    def __str__(self):
+        return '{0} {1} ({2})'.format(self.operation, self.backend, self.count)
+
+    @staticmethod
+    def format_stats(profiler, limit=30):
+        # pstats writes byte strings on python 2
+        stream = six.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(limit)
+        return stream.getvalue()
+
+    @classmethod
+    @contextmanager
+    def measure(cls, operation, config, templates=None):
+        """
+        measures the ``with`` block and records it for the organization
+        and backend of ``config`` and for ``templates`` (by default the
+        templates of ``config``); nested blocks are measured but not
+        profiled with cProfile, which allows one profiler at a time
+        """
+        if not app_settings.PROFILING or not config.organization_id:
+            yield
+            return
+        threshold = app_settings.PROFILING_THRESHOLD
+        profiler = None
+        if threshold is not None and not getattr(cls._local, 'profiling', False):
+            profiler = cProfile.Profile()
+            cls._local.profiling = True
+            profiler.enable()
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            if profiler:
+                profiler.disable()
+                cls._local.profiling = False
+        if templates is not None:
+            template_pks = [template.pk for template in templates]
+        elif not config._state.adding:
+            template_pks = list(config.templates.values_list('pk', flat=True))
+        else:
+            template_pks = []
+        stats = None
+        if profiler and duration >= threshold:
+            stats = cls.format_stats(profiler)
+        cls.record(operation, config.organization_id, config.backend,
+                   template_pks, duration, stats)
+
+    @classmethod
+    def record(cls, operation, organization_id, backend, template_pks, duration, stats=None):
+        """
+        adds a sample to the rows of the organization and of each template
+        """
+        now = timezone.now()
+        for template_pk in [None] + list(template_pks):
+            lookup = dict(operation=operation,
+                          organization_id=organization_id,
+                          template_id=template_pk,
+                          backend=backend)
+            updated = cls.objects.filter(**lookup).update(count=F('count') + 1,
+                                                          total_time=F('total_time') + duration,
+                                                          modified=now)
+            if not updated:
+                cls.objects.create(count=1,
+                                   total_time=duration,
+                                   max_time=duration,
+                                   profile=stats or '',
+                                   profile_time=duration if stats else None,
+                                   modified=now,
+                                   **lookup)
+                continue
+            cls.objects.filter(max_time__lt=duration, **lookup).update(max_time=duration)
+            if stats:
+                cls.objects.filter(Q(profile_time=None) | Q(profile_time__lt=duration), **lookup) \
+                           .update(profile=stats, profile_time=duration)
+
+    @classmethod
+    def get_slowest(cls, by='organization', operation='generate', order='total', limit=10):
+        """
+        returns the ``limit`` organizations (or templates, see ``by``)
+        with the highest total, mean or max time (see ``order``)
+        """
+        if by == 'organization':
+            queryset = cls.objects.filter(operation=operation, template=None)
+            fields = ['organization', 'organization__name']
+        else:
+            queryset = cls.objects.filter(operation=operation, template__isnull=False)
+            fields = ['template', 'template__name', 'template__organization__name']
+        rows = queryset.values(*fields) \
+                       .annotate(count_sum=Sum('count'),
+                                 time_sum=Sum('total_time'),
+                                 time_max=Max('max_time'))
+        results = []
+        for row in rows:
+            results.append({
+                'name': row[fields[1]],
+                'organization': row[fields[-1]],
+                'count': row['count_sum'],
+                'total': row['time_sum'],
+                'mean': row['time_sum'] / row['count_sum'],
+                'max': row['time_max'],
+            })
+        results.sort(key=lambda r: r[order], reverse=True)
+        return results[:limit]
+
+
+@python_2_unicode_compatible
+class DeactivationJob(models.Model):
+    """
+    Cleanup performed after the deactivation of an organization:
+    the auth data of its devices is discarded, its configurations
+    are flagged as modified (and their archives discarded), the
+    automatically managed certificates of its VPN clients are revoked
+    and their VPN context discarded. Objects are processed in chunks,
+    each one in a short transaction which also stores the checkpoint
+    (``stage`` and ``last_pk``), hence an interrupted job resumes
+    from the last processed chunk; the job is cancelled if the
+    organization is activated again.
+    """
+    STATUSES = (
+        ('pending', _('pending')),
+        ('running', _('running')),
+        ('completed', _('completed')),
+        ('cancelled', _('cancelled')),
+        ('failed', _('failed')),
+    )
+    STAGES = ('devices', 'configs', 'certs', 'vpnclients')
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    organization = models.ForeignKey('openwisp_users.Organization',
+                                     on_delete=models.CASCADE,
+                                     related_name='deactivation_jobs')
+    status = models.CharField(max_length=9, choices=STATUSES, default='pending', db_index=True)
+    stage = models.CharField(max_length=10, default=STAGES[0])
+    last_pk = models.CharField(max_length=36, blank=True)
+    processed = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(default=timezone.now, editable=False)
+    modified = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name = _('deactivation job')
+        verbose_name_plural = _('deactivation jobs')
+        ordering = ('created',)
+
+    def __str__(self):
+        return '{0} ({1})'.format(self.organization_id, self.status)
+
+    def get_queryset(self, stage):
+        """
+        returns the queryset of the objects processed in ``stage``
+        """
+        org_pk = self.organization_id
+        if stage == 'devices':
+            return Device.objects.filter(organization=org_pk)
+        if stage == 'configs':
+            return Config.objects.filter(organization=org_pk)
+        if stage == 'certs':
+            cert_model = VpnClient.cert.field.related_model
+            return cert_model.objects.filter(vpnclient__config__organization=org_pk,
+                                             vpnclient__auto_cert=True,
+                                             revoked=False)
+        return VpnClient.objects.filter(config__organization=org_pk)
+
+    def process_devices(self, pks):
+        get_cache().delete_many([Device.get_auth_cache_key(pk) for pk in pks])
+
+    def process_configs(self, pks):
+        Config.objects.filter(pk__in=pks).exclude(status='modified').update(status='modified')
+        Config.delete_archive_cache(pks)
+
+    def process_certs(self, pks):
+        now = timezone.now()
+        cert_model = VpnClient.cert.field.related_model
+        cert_model.objects.filter(pk__in=pks).update(revoked=True, revoked_at=now, modified=now)
+
+    def process_vpnclients(self, pks):
+        get_cache().delete_many([VpnClient.get_context_cache_key(pk) for pk in pks])
+
+    def _save_state(self, **kwargs):
+        for attr, value in kwargs.items():
+            setattr(self, attr, value)
+        self.modified = timezone.now()
+        self.save(update_fields=list(kwargs.keys()) + ['modified'])
+
+    def run(self, chunk_size=None):
+        """
+        processes the objects of the organization from the last
+        checkpoint onwards, returns the status of the job
+        """
+        chunk_size = chunk_size or app_settings.CHUNK_SIZE
+        self._save_state(status='running', error='')
+        organization_model = self._meta.get_field('organization').related_model
+        try:
+            for stage in self.STAGES[self.STAGES.index(self.stage):]:
+                if stage != self.stage:
+                    self._save_state(stage=stage, last_pk='')
+                queryset = self.get_queryset(stage).only('pk')
+                if self.last_pk:
+                    queryset = queryset.filter(pk__gt=self.last_pk)
+                process = getattr(self, 'process_{0}'.format(stage))
+                for chunk in chunked_queryset(queryset, chunk_size):
+                    if organization_model.objects.filter(pk=self.organization_id, is_active=True).exists():
+                        self._save_state(status='cancelled')
+                        return self.status
+                    pks = [obj.pk for obj in chunk]
+                    with transaction.atomic():
+                        process(pks)
+                        self._save_state(last_pk=str(pks[-1]), processed=self.processed + len(pks))
+        except Exception as e:
+            self._save_state(status='failed', error=str(e))
+            raise
+        self._save_state(status='completed')
+        return self.status
+
+    @classmethod
+    def run_job(cls, pk, chunk_size=None):
+        """
+        runs the job ``pk`` if it has not been completed or cancelled
+        (used with ``OPENWISP_CONTROLLER_EXECUTOR``)
+        """
+        job = cls.objects.filter(pk=pk).exclude(status__in=['completed', 'cancelled']).first()
+        if job:
+            return job.run(chunk_size)
+
+    @classmethod
+    def organization_pre_save(cls, instance, raw=False, **kwargs):
+        """
+        remembers whether the organization was active
+        """
+        if raw or instance._state.adding:
+            instance._was_active = None
+            return
+        organizations = type(instance).objects.filter(pk=instance.pk)
+        instance._was_active = organizations.values_list('is_active', flat=True).first()
+
+    @classmethod
+    def organization_post_save(cls, instance, created, raw=False, **kwargs):
+        """
+        creates a job when an organization is deactivated and
+        submits it to ``OPENWISP_CONTROLLER_EXECUTOR`` after commit
+        """
+        if raw or created or instance.is_active or not getattr(instance, '_was_active', None):
+            return
+        job = cls.objects.create(organization=instance)
+        transaction.on_commit(lambda: get_executor().submit(cls.run_job, job.pk))
@@ -0,0 +1,59 @@
+"""
+Cache of the configuration previews rendered in the admin
+"""
+import hashlib
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from . import settings as app_settings
+from .cache import get_cache, get_cache_key
+
+
+def get_preview_key(request, template_model):
+    """
+    returns a hash of the form data posted to the preview view, of the
+    templates it refers to (including their modification time) and
+    of the user, which identifies a rendered preview; raises
+    ``ValidationError`` if the template ids are not valid
+    """
+    data = sorted((key, request.POST.getlist(key)) for key in request.POST.keys()
+                  if key != 'csrfmiddlewaretoken')
+    templates = []
+    template_ids = request.POST.get('templates')
+    if template_ids:
+        templates = list(template_model.objects.filter(pk__in=template_ids.split(','))
+                                               .order_by('pk')
+                                               .values_list('pk', 'modified'))
+    payload = json.dumps([request.user.pk, data, templates], cls=DjangoJSONEncoder)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def get_preview(key):
+    return get_cache().get(get_cache_key('preview', key))
+
+
+def set_preview(key, output):
+    get_cache().set(get_cache_key('preview', key), output, app_settings.PREVIEW_CACHE_TIMEOUT)
+
+
+def paginate_output(output, page, page_size=None):
+    """
+    splits ``output`` in pages of ``page_size`` lines (defaults to
+    ``OPENWISP_CONTROLLER_PREVIEW_PAGE_SIZE``), returns
+    ``(page output, page number, number of pages)``
+    """
+    page_size = page_size or app_settings.PREVIEW_PAGE_SIZE
+    lines = output.splitlines(True)
+    num_pages = max(1, -(-len(lines) // page_size))
+    page = min(max(page, 1), num_pages)
+    start = (page - 1) * page_size
+    return ''.join(lines[start:start + page_size]), page, num_pages
+
+
+def iter_output(output, chunk_size=65536):
+    """
+    yields ``output`` in chunks, used to stream large previews
+    """
+    for start in range(0, len(output), chunk_size):
+        yield output[start:start + chunk_size]
@@ -0,0 +1,154 @@
+"""
+Publish/subscribe of configuration changes, used by the long-poll
+controller view to answer as soon as the configuration of a device
+changes: changes are published on the channel of the device (the hex
+of its UUID) or on ``BROADCAST`` when they may affect many devices.
+The backend is defined in ``OPENWISP_CONTROLLER_PUBSUB_BACKEND``.
+"""
+import threading
+import time
+import uuid
+
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from . import settings as app_settings
+from .cache import get_cache, get_cache_key
+
+BROADCAST = '*'
+
+
+class BaseSubscription(object):
+    def __init__(self, backend, channel):
+        self.backend = backend
+        self.channel = channel
+
+    def wait(self, timeout):
+        """
+        blocks until a change is published on the channel (or on
+        ``BROADCAST``) or ``timeout`` seconds have passed; returns
+        ``True`` if a change has been published since the subscription
+        was created or since the last call which returned ``True``
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class LocalSubscription(BaseSubscription):
+    def __init__(self, backend, channel):
+        super(LocalSubscription, self).__init__(backend, channel)
+        self.event = threading.Event()
+
+    def wait(self, timeout):
+        result = self.event.wait(timeout)
+        self.event.clear()
+        return result
+
+    def close(self):
+        self.backend.unsubscribe(self)
+
+
+class LocalBackend(object):
+    """
+    keeps subscriptions in the memory of the current process, hence
+    changes reach only the requests served by the process which
+    performed them; suited to single process deployments and tests
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._channels = {}
+
+    def subscribe(self, channel):
+        subscription = LocalSubscription(self, channel)
+        with self._lock:
+            self._channels.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._channels.get(subscription.channel, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._channels.pop(subscription.channel, None)
+
+    def publish(self, channel):
+        with self._lock:
+            if channel == BROADCAST:
+                subscriptions = [s for channel_subs in self._channels.values() for s in channel_subs]
+            else:
+                subscriptions = list(self._channels.get(channel, []))
+        for subscription in subscriptions:
+            subscription.event.set()
+
+
+class CacheSubscription(BaseSubscription):
+    def __init__(self, backend, channel):
+        super(CacheSubscription, self).__init__(backend, channel)
+        self.keys = [backend.get_token_key(channel), backend.get_token_key(BROADCAST)]
+        self.tokens = get_cache().get_many(self.keys)
+
+    def wait(self, timeout):
+        deadline = time.time() + timeout
+        while True:
+            tokens = get_cache().get_many(self.keys)
+            if tokens != self.tokens:
+                self.tokens = tokens
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.backend.poll_interval, remaining))
+
+
+class CacheBackend(object):
+    """
+    publishes changes by replacing a token in ``OPENWISP_CONTROLLER_CACHE``,
+    subscriptions poll the tokens every ``poll_interval`` seconds, so that
+    changes reach the requests served by every process
+    """
+    poll_interval = 0.5
+
+    @staticmethod
+    def get_token_key(channel):
+        return get_cache_key('pubsub', channel)
+
+    def subscribe(self, channel):
+        return CacheSubscription(self, channel)
+
+    def publish(self, channel):
+        get_cache().set(self.get_token_key(channel),
+                        uuid.uuid4().hex,
+                        app_settings.CACHE_TIMEOUT)
+
+
+_backend = None
+
+
+def get_pubsub_backend():
+    """
+    returns the instance of ``OPENWISP_CONTROLLER_PUBSUB_BACKEND``
+    (instantiated once per process)
+    """
+    global _backend
+    path = app_settings.PUBSUB_BACKEND
+    if _backend is None or _backend[0] != path:
+        _backend = (path, import_string(path)())
+    return _backend[1]
+
+
+def publish_change(device_pk=None):
+    """
+    publishes a change of the configuration of ``device_pk``
+    (or of any device if ``None``) once the current
+    transaction is committed
+    """
+    channel = BROADCAST if device_pk is None else uuid.UUID(str(device_pk)).hex
+    transaction.on_commit(lambda: get_pubsub_backend().publish(channel))
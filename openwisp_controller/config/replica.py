@@ -0,0 +1,129 @@
+"""
+Routing of the read-only controller queries to a read replica
+
+Reads are sent to the database alias specified in
+``OPENWISP_CONTROLLER_DATABASE_REPLICA`` only inside ``use_replica()``
+blocks and only if ``ReplicaRouter`` is listed in ``DATABASE_ROUTERS``.
+
+Since the replica may lag behind the primary database, modified
+objects "pin" reads to the primary for ``OPENWISP_CONTROLLER_REPLICA_LAG``
+seconds: changes to a config pin the related device only, changes to
+templates, VPNs, CAs and certificates (which may affect many devices)
+pin every read.
+"""
+import threading
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS
+
+from . import settings as app_settings
+from .cache import get_cache, get_cache_key
+
+_state = threading.local()
+
+
+def replica_enabled():
+    return bool(app_settings.DATABASE_REPLICA)
+
+
+@contextmanager
+def use_replica():
+    """
+    sends the reads performed in the block to the replica
+    """
+    previous = getattr(_state, 'replica', False)
+    _state.replica = True
+    try:
+        yield
+    finally:
+        _state.replica = previous
+
+
+@contextmanager
+def use_primary():
+    """
+    sends the reads performed in the block to the primary
+    database, also inside ``use_replica()`` blocks
+    """
+    previous = getattr(_state, 'replica', False)
+    _state.replica = False
+    try:
+        yield
+    finally:
+        _state.replica = previous
+
+
+class ReplicaRouter(object):
+    """
+    database router which sends the reads performed in
+    ``use_replica()`` blocks to ``OPENWISP_CONTROLLER_DATABASE_REPLICA``
+    """
+    def db_for_read(self, model, **hints):
+        if getattr(_state, 'replica', False) and replica_enabled():
+            return app_settings.DATABASE_REPLICA
+        return None
+
+    def db_for_write(self, model, **hints):
+        # objects read from the replica must be saved on the primary
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db == app_settings.DATABASE_REPLICA:
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = (DEFAULT_DB_ALIAS, app_settings.DATABASE_REPLICA)
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if replica_enabled() and db == app_settings.DATABASE_REPLICA:
+            return False
+        return None
+
+
+def _get_pin_key(device_pk=None):
+    if device_pk is None:
+        return get_cache_key('replica_pin')
+    return get_cache_key('replica_pin', device_pk)
+
+
+def pin_primary(device_pks=None):
+    """
+    sends the reads related to ``device_pks`` to the primary
+    database for ``OPENWISP_CONTROLLER_REPLICA_LAG`` seconds;
+    if ``device_pks`` is ``None`` every read is affected
+    """
+    if not replica_enabled():
+        return
+    if device_pks is None:
+        keys = [_get_pin_key()]
+    else:
+        keys = [_get_pin_key(pk) for pk in device_pks]
+    get_cache().set_many(dict.fromkeys(keys, True), app_settings.REPLICA_LAG)
+
+
+def is_pinned(device_pk=None):
+    """
+    returns ``True`` if reads related to ``device_pk``
+    (or any read if ``None``) must use the primary database
+    """
+    keys = [_get_pin_key()]
+    if device_pk is not None:
+        keys.append(_get_pin_key(device_pk))
+    return bool(get_cache().get_many(keys))
+
+
+def config_modified(sender, instance, **kwargs):
+    """
+    ``post_save`` and ``post_delete`` handler of ``Config``
+    """
+    pin_primary([instance.device_id])
+
+
+def object_modified(sender, instance, **kwargs):
+    """
+    ``post_save`` and ``post_delete`` handler of models which may
+    affect the configuration of many devices (templates, VPNs, CAs, certs)
+    """
+    pin_primary()
@@ -0,0 +1,33 @@
+from django.conf import settings
+
+CHUNK_SIZE = getattr(settings, 'OPENWISP_CONTROLLER_CHUNK_SIZE', 1000)
+CERT_RENEWAL_DAYS = getattr(settings, 'OPENWISP_CONTROLLER_CERT_RENEWAL_DAYS', 30)
+EXECUTOR = getattr(settings, 'OPENWISP_CONTROLLER_EXECUTOR',
+                   'openwisp_controller.config.executor.LocalExecutor')
+DH_ASYNC = getattr(settings, 'OPENWISP_CONTROLLER_DH_ASYNC', True)
+DH_LENGTH = getattr(settings, 'OPENWISP_CONTROLLER_DH_LENGTH', 1024)
+DH_POOL_SIZE = getattr(settings, 'OPENWISP_CONTROLLER_DH_POOL_SIZE', 2)
+CACHE = getattr(settings, 'OPENWISP_CONTROLLER_CACHE', 'default')
+CACHE_TIMEOUT = getattr(settings, 'OPENWISP_CONTROLLER_CACHE_TIMEOUT', 60 * 60 * 24)
+CERT_SIGNING_WORKERS = getattr(settings, 'OPENWISP_CONTROLLER_CERT_SIGNING_WORKERS', 4)
+DATABASE_REPLICA = getattr(settings, 'OPENWISP_CONTROLLER_DATABASE_REPLICA', None)
+REPLICA_LAG = getattr(settings, 'OPENWISP_CONTROLLER_REPLICA_LAG', 5)
+RATE_LIMIT_BACKEND = getattr(settings, 'OPENWISP_CONTROLLER_RATE_LIMIT_BACKEND',
+                             'openwisp_controller.config.throttling.CacheBackend')
+RATE_LIMIT_DEVICE = getattr(settings, 'OPENWISP_CONTROLLER_RATE_LIMIT_DEVICE', None)
+RATE_LIMIT_ORGANIZATION = getattr(settings, 'OPENWISP_CONTROLLER_RATE_LIMIT_ORGANIZATION', None)
+RATE_LIMIT_FAILED_AUTH = getattr(settings, 'OPENWISP_CONTROLLER_RATE_LIMIT_FAILED_AUTH', None)
+ARCHIVE_HISTORY = getattr(settings, 'OPENWISP_CONTROLLER_ARCHIVE_HISTORY', 3)
+CONFIG_HISTORY = getattr(settings, 'OPENWISP_CONTROLLER_CONFIG_HISTORY', True)
+CONFIG_HISTORY_RETENTION = getattr(settings, 'OPENWISP_CONTROLLER_CONFIG_HISTORY_RETENTION', 90)
+PREVIEW_CACHE_TIMEOUT = getattr(settings, 'OPENWISP_CONTROLLER_PREVIEW_CACHE_TIMEOUT', 60 * 5)
+PREVIEW_PAGE_SIZE = getattr(settings, 'OPENWISP_CONTROLLER_PREVIEW_PAGE_SIZE', 1000)
+METRICS_TOKEN = getattr(settings, 'OPENWISP_CONTROLLER_METRICS_TOKEN', None)
+PROFILING = getattr(settings, 'OPENWISP_CONTROLLER_PROFILING', False)
+PROFILING_THRESHOLD = getattr(settings, 'OPENWISP_CONTROLLER_PROFILING_THRESHOLD', None)
+CHECKSUM_BATCH_SIZE = getattr(settings, 'OPENWISP_CONTROLLER_CHECKSUM_BATCH_SIZE', 100)
+PUBSUB_BACKEND = getattr(settings, 'OPENWISP_CONTROLLER_PUBSUB_BACKEND',
+                         'openwisp_controller.config.pubsub.CacheBackend')
+LONG_POLL_TIMEOUT = getattr(settings, 'OPENWISP_CONTROLLER_LONG_POLL_TIMEOUT', 30)
+DEVICE_LIST_PAGE_SIZE = getattr(settings, 'OPENWISP_CONTROLLER_DEVICE_LIST_PAGE_SIZE', 100)
+SHARED_CONFIG = getattr(settings, 'OPENWISP_CONTROLLER_SHARED_CONFIG', False)
@@ -0,0 +1,94 @@
+/*
+ * loads on demand the choices of the autocomplete
+ * widgets defined in openwisp_controller.widgets
+ */
+(function ($) {
+    'use strict';
+    var delay = 250,
+        counter = 0;
+
+    function fetch(url, query, page, callback) {
+        var params = {q: query, page: page},
+            organization = $('#id_organization').val();
+        if (organization) { params.organization = organization; }
+        $.getJSON(url, params).done(callback);
+    }
+
+    function debounce(fn) {
+        var timeout;
+        return function () {
+            var context = this, args = arguments;
+            clearTimeout(timeout);
+            timeout = setTimeout(function () { fn.apply(context, args); }, delay);
+        };
+    }
+
+    // adds an unchecked item to a sortedm2m list, returns its checkbox
+    function addSortedItem(ul, id, text) {
+        var hidden = ul.siblings('input[type=hidden]'),
+            inputId = hidden.attr('id') + '_autocomplete_' + (counter += 1),
+            input = $('<input type="checkbox" class="sortedm2m" />').attr('id', inputId).val(id);
+        ul.append($('<li class="sortedm2m-item"/>').append(
+            $('<label/>').attr('for', inputId).append(input).append($('<span/>').text(' ' + text))
+        ));
+        return input;
+    }
+
+    function initSortedm2m(container) {
+        var url = container.data('autocomplete-url'),
+            ul = container.find('.sortedm2m-items'),
+            search = container.find('.selector-filter input'),
+            more = $('<a href="#" class="autocomplete-more"/>').text(gettext('Load more')).hide(),
+            page = 1;
+        ul.after(more);
+        function load(reset) {
+            page = reset ? 1 : page + 1;
+            fetch(url, search.val(), page, function (data) {
+                if (reset) { ul.find('input[type=checkbox]:not(:checked)').closest('li').remove(); }
+                $.each(data.results, function (i, result) {
+                    if (!ul.find('input[type=checkbox][value="' + result.id + '"]').length) {
+                        addSortedItem(ul, result.id, result.text);
+                    }
+                });
+                more.toggle(data.more);
+            });
+        }
+        search.on('input', debounce(function () { load(true); }));
+        more.click(function (e) {
+            e.preventDefault();
+            load(false);
+        });
+        load(true);
+    }
+
+    function initSelect(select) {
+        var url = select.data('autocomplete-url'),
+            search = $('<input type="text" class="autocomplete-search"/>').attr('placeholder', gettext('Filter'));
+        select.before(search);
+        function load() {
+            fetch(url, search.val(), 1, function (data) {
+                var value = select.val();
+                select.find('option').filter(function () {
+                    return this.value && this.value !== value;
+                }).remove();
+                $.each(data.results, function (i, result) {
+                    if (result.id !== value) {
+                        select.append($('<option/>').val(result.id).text(result.text));
+                    }
+                });
+                if (data.more) {
+                    select.append($('<option disabled/>').val('').text('...'));
+                }
+            });
+        }
+        search.on('input', debounce(load));
+        load();
+    }
+
+    window.openwispAutocomplete = {addSortedItem: addSortedItem};
+
+    $(function () {
+        $('.autocomplete-sortedm2m').each(function () { initSortedm2m($(this)); });
+        $('select.autocomplete').each(function () { initSelect($(this)); });
+    });
+})(django.jQuery);
@@ -0,0 +1,30 @@
+/*
+ * loads the pages of large previews
+ * (see openwisp_controller.config.admin.PreviewCacheMixin)
+ */
+django.jQuery(function ($) {
+    'use strict';
+    var overlay = $('.djnjc-overlay'),
+        inner = overlay.find('.inner');
+
+    function closePreview() {
+        overlay.hide();
+        inner.html('');
+        $('body').attr('style', '');
+    }
+
+    overlay.on('click', '.preview-page', function (e) {
+        e.preventDefault();
+        $.get($(this).attr('href'), function (html) {
+            inner.html($('#content-main div', html).html());
+            inner.find('.close').click(function (e) {
+                e.preventDefault();
+                closePreview();
+            });
+        }).fail(function () {
+            var message = 'The preview has expired, please open it again';
+            if (window.gettext) { message = gettext(message); }
+            alert(message);
+        });
+    });
+});
@@ -13,6 +13,25 @@ class TestVpnX509Mixin(CreateVpnMixin, TestPkiMixin):
             ca_options['organization'] = org
         return super(TestVpnX509Mixin, self)._create_vpn(ca_options, **kwargs)
 
+    def _create_vpn_configs(self, count=1, add_template=True):
+        """
+        creates an organization with a VPN, a VPN template with ``auto_cert``
+        and ``count`` configurations (see ``_create_configs``), to which the
+        template is added if ``add_template`` is ``True``;
+        returns the template and the configurations
+        """
+        org = self._create_org()
+        template = self._create_template(name='vpn-test',
+                                         type='vpn',
+                                         vpn=self._create_vpn(organization=org),
+                                         auto_cert=True,
+                                         organization=org)
+        configs = self._create_configs(org, count=count)
+        if add_template:
+            for config in configs:
+                config.templates.add(template)
+        return template, configs
+
 
 class CreateConfigTemplateMixin(CreateTemplateMixin, CreateConfigMixin):
     def _create_config(self, **kwargs):
@@ -20,3 +39,16 @@ class CreateConfigTemplateMixin(CreateTemplateMixin, CreateConfigMixin):
             kwargs['device'] = self._create_device(name='test-device',
                                                    organization=kwargs.get('organization', None))
         return super(CreateConfigTemplateMixin, self)._create_config(**kwargs)
+
+    def _create_configs(self, organization, count=3, **kwargs):
+        """
+        creates ``count`` devices named ``device0``, ``device1``, ...
+        with their configurations (``kwargs`` are passed to ``_create_config``)
+        """
+        configs = []
+        for i in range(count):
+            device = self._create_device(name='device{0}'.format(i),
+                                         mac_address='00:11:22:33:44:{0:02d}'.format(i),
+                                         organization=organization)
+            configs.append(self._create_config(device=device, organization=organization, **kwargs))
+        return configs
@@ -1,13 +1,19 @@
 import json
 
+import mock
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
 from openwisp_users.tests.utils import TestOrganizationMixin
 
 from . import CreateConfigTemplateMixin, TestVpnX509Mixin
+from .. import settings as app_settings
 from ...pki.models import Ca, Cert
 from ...tests.utils import TestAdminMixin
+from ..admin import TemplateAdmin
 from ..models import Config, Device, Template, Vpn
 
 
@@ -24,6 +30,8 @@ class TestAdmin(CreateConfigTemplateMixin, TestAdminMixin,
         {'codename__endswith': 'device'},
         {'codename__endswith': 'template'},
         {'codename__endswith': 'vpn'},
+        {'codename__endswith': 'ca'},
+        {'codename__endswith': 'cert'},
     ]
 
     def _get_device_params(self, org):
@@ -121,6 +129,140 @@ class TestAdmin(CreateConfigTemplateMixin, TestAdminMixin,
         self.assertContains(response, 'eth0')
         self.assertContains(response, 'dhcp')
 
+    def _get_preview_data(self, org):
+        return {
+            'name': 'test-device',
+            'organization': org.pk,
+            'mac_address': self.TEST_MAC_ADDRESS,
+            'backend': 'netjsonconfig.OpenWrt',
+            'config': json.dumps({'general': {'description': 'test'}}),
+            'csrfmiddlewaretoken': 'test',
+            'templates': ','.join([str(t.pk) for t in Template.objects.all()])
+        }
+
+    def test_preview_device_cached(self):
+        org = self._create_org()
+        template = self._create_template(organization=org)
+        path = reverse('admin:config_device_preview')
+        data = self._get_preview_data(org)
+        self._login()
+        response = self.client.post(path, data)
+        self.assertContains(response, 'eth0')
+        with mock.patch.object(Config, 'get_backend_instance') as get_backend_instance:
+            cached = self.client.post(path, dict(data, csrfmiddlewaretoken='other'))
+        get_backend_instance.assert_not_called()
+        self.assertEqual(cached.content, response.content)
+        # changes of the templates are not hidden by the cache
+        template.config['interfaces'][0]['name'] = 'eth9'
+        template.full_clean()
+        template.save()
+        response = self.client.post(path, data)
+        self.assertContains(response, 'eth9')
+
+    def test_preview_errors_not_cached(self):
+        org = self._create_org()
+        path = reverse('admin:config_device_preview')
+        data = dict(self._get_preview_data(org), config='{"interfaces": [{"wrong": 1}]}')
+        self._login()
+        with mock.patch('openwisp_controller.config.admin.set_preview') as set_preview:
+            response = self.client.post(path, data)
+        self.assertEqual(response.status_code, 400)
+        set_preview.assert_not_called()
+
+    @mock.patch.object(app_settings, 'PREVIEW_PAGE_SIZE', 3)
+    def test_preview_template_pages(self):
+        org = self._create_org()
+        path = reverse('admin:config_template_preview')
+        data = {
+            'name': 'test-template',
+            'organization': org.pk,
+            'backend': 'netjsonconfig.OpenWrt',
+            'config': json.dumps({'general': {'description': 'test'}}),
+            'csrfmiddlewaretoken': 'test'
+        }
+        self._login()
+        response = self.client.post(path, data)
+        num_pages = response.context['num_pages']
+        self.assertGreater(num_pages, 1)
+        self.assertContains(response, 'page 1 of {0}'.format(num_pages))
+        key = response.context['preview_key']
+        response = self.client.get(path, {'key': key, 'page': num_pages})
+        self.assertContains(response, 'page {0} of {0}'.format(num_pages))
+        response = self.client.get(path, {'key': key, 'raw': 1})
+        output = b''.join(response.streaming_content).decode()
+        self.assertIn('test', output)
+        self.assertGreater(len(output.splitlines()), 3 * (num_pages - 1))
+        response = self.client.get(path, {'key': 'wrong'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_assign_templates_action(self):
+        org = self._create_org()
+        config = self._create_config(organization=org)
+        t1 = self._create_template(name='t1', organization=org)
+        t2 = self._create_template(name='t2', organization=None)
+        path = reverse('admin:config_device_changelist')
+        data = {'action': 'assign_templates', '_selected_action': [str(config.device.pk)]}
+        self._login()
+        response = self.client.post(path, data)
+        self.assertContains(response, 'The templates of 1 device will be replaced')
+        self.assertContains(response, 'name="apply"')
+        response = self.client.post(path, dict(data, apply='1', templates='{0},{1}'.format(t2.pk, t1.pk)),
+                                    follow=True)
+        self.assertContains(response, 'The templates of 1 devices have been updated')
+        self.assertEqual(list(config.templates.all()), [t2, t1])
+
+    def test_import_devices(self):
+        org = self._create_org()
+        t = self._create_template(name='t1', organization=org)
+        path = reverse('admin:config_device_import')
+        self._login()
+        self.assertContains(self.client.get(reverse('admin:config_device_changelist')), path)
+        csv = SimpleUploadedFile('devices.csv', b'name,mac_address,templates\n'
+                                                b'device1,00:11:22:33:44:01,t1\n'
+                                                b'device2,wrong,t1\n')
+        response = self.client.post(path, {'organization': org.pk, 'format': 'csv', 'file': csv},
+                                    follow=True)
+        self.assertContains(response, '1 devices have been imported')
+        self.assertContains(response, '3: mac_address: Must be a valid mac address')
+        self.assertEqual(list(Device.objects.get(name='device1').config.templates.all()), [t])
+
+    def test_import_devices_organization(self):
+        org1 = self._create_org()
+        org2 = self._create_org(name='org2', slug='org2')
+        self._create_operator(organizations=[org1])
+        self._login(username='operator', password='tester')
+        path = reverse('admin:config_device_import')
+        data = b'{"name": "device1", "mac_address": "00:11:22:33:44:01"}\n'
+        response = self.client.post(path, {'organization': org2.pk, 'format': 'netjson',
+                                           'file': SimpleUploadedFile('devices.json', data)})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Select a valid choice')
+        self.assertFalse(Device.objects.exists())
+        response = self.client.post(path, {'organization': org1.pk, 'format': 'netjson',
+                                           'file': SimpleUploadedFile('devices.json', data)})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Device.objects.get().organization, org1)
+
+    def test_device_search(self):
+        org = self._create_org()
+        c1 = self._create_config(device=self._create_device(name='device1', organization=org,
+                                                            mac_address='00:11:22:33:44:01'),
+                                 organization=org)
+        self._create_device(name='device2', organization=org, mac_address='00:11:22:33:44:02')
+        c1.last_ip = '10.0.0.1'
+        c1.save()
+        path = reverse('admin:config_device_changelist')
+        self._login()
+        for search, visible, hidden in [('DEVICE1', 'device1', 'device2'),
+                                        ('00:11:22:33:44:02', 'device2', 'device1'),
+                                        ('001122334402', 'device2', 'device1'),
+                                        ('10.0.0.1', 'device1', 'device2'),
+                                        # other search_fields are still looked up
+                                        (c1.device.key, 'device1', 'device2')]:
+            response = self.client.get(path, {'q': search})
+            self.assertContains(response, '/{0}/change/'.format(Device.objects.get(name=visible).pk))
+            self.assertNotContains(response, '/{0}/change/'.format(Device.objects.get(name=hidden).pk))
+
     def test_device_preview_button(self):
         config = self._create_config(organization=self._create_org())
         path = reverse('admin:config_device_change', args=[config.device.pk])
@@ -142,6 +284,18 @@ class TestAdmin(CreateConfigTemplateMixin, TestAdminMixin,
         response = self.client.get(path)
         self.assertIn('Preview', str(response.content))
 
+    @mock.patch.object(app_settings, 'DH_POOL_SIZE', 0)
+    def test_vpn_dh_status(self):
+        v = self._create_vpn(organization=self._create_org(), dh='')
+        path = reverse('admin:config_vpn_change', args=[v.pk])
+        self._login()
+        response = self.client.get(path)
+        self.assertContains(response, 'generating (started')
+        v.dh = self._dh
+        v.save()
+        response = self.client.get(path)
+        self.assertContains(response, 'ready')
+
     def _create_multitenancy_test_env(self, vpn=False):
         org1 = self._create_org(name='test1org')
         org2 = self._create_org(name='test2org')
@@ -207,7 +361,7 @@ class TestAdmin(CreateConfigTemplateMixin, TestAdminMixin,
         t_shared = self._create_template(name='t-shared',
                                          organization=None)
         self._test_multitenant_admin(
-            url=reverse('admin:config_device_add'),
+            url=reverse('admin:config_template_autocomplete'),
             visible=[str(data['t1']), str(t_shared)],
             hidden=[str(data['t2']), str(data['t3_inactive'])],
         )
@@ -233,10 +387,9 @@ class TestAdmin(CreateConfigTemplateMixin, TestAdminMixin,
     def test_template_vpn_fk_queryset(self):
         data = self._create_multitenancy_test_env(vpn=True)
         self._test_multitenant_admin(
-            url=reverse('admin:config_template_add'),
+            url=reverse('admin:config_vpn_autocomplete'),
             visible=[data['vpn1'].name, data['vpn_shared'].name],
-            hidden=[data['vpn2'].name, data['vpn_inactive'].name],
-            select_widget=True
+            hidden=[data['vpn2'].name, data['vpn_inactive'].name]
         )
 
     def test_vpn_queryset(self):
@@ -261,21 +414,89 @@ class TestAdmin(CreateConfigTemplateMixin, TestAdminMixin,
     def test_vpn_ca_fk_queryset(self):
         data = self._create_multitenancy_test_env(vpn=True)
         self._test_multitenant_admin(
-            url=reverse('admin:config_vpn_add'),
+            url=reverse('admin:pki_ca_autocomplete'),
             visible=[data['vpn1'].ca.name, data['vpn_shared'].ca.name],
-            hidden=[data['vpn2'].ca.name, data['vpn_inactive'].ca.name],
-            select_widget=True
+            hidden=[data['vpn2'].ca.name, data['vpn_inactive'].ca.name]
         )
 
     def test_vpn_cert_fk_queryset(self):
         data = self._create_multitenancy_test_env(vpn=True)
         self._test_multitenant_admin(
-            url=reverse('admin:config_vpn_add'),
+            url=reverse('admin:pki_cert_autocomplete'),
             visible=[data['vpn1'].cert.name, data['vpn_shared'].cert.name],
-            hidden=[data['vpn2'].cert.name, data['vpn_inactive'].cert.name],
-            select_widget=True
+            hidden=[data['vpn2'].cert.name, data['vpn_inactive'].cert.name]
         )
 
+    def test_device_templates_autocomplete_widget(self):
+        data = self._create_multitenancy_test_env()
+        t_unused = self._create_template(name='t-unused', organization=data['org1'])
+        self._login()
+        path = reverse('admin:config_device_change', args=[data['c1'].device.pk])
+        response = self.client.get(path)
+        self.assertContains(response, reverse('admin:config_template_autocomplete'))
+        self.assertContains(response, 'openwisp-controller/js/autocomplete.js')
+        self.assertContains(response, data['t1'].name)
+        self.assertNotContains(response, t_unused.name)
+
+    def test_template_vpn_autocomplete_widget(self):
+        data = self._create_multitenancy_test_env(vpn=True)
+        self._login()
+        path = reverse('admin:config_template_change', args=[data['t1_vpn'].pk])
+        response = self.client.get(path)
+        self.assertContains(response, reverse('admin:config_vpn_autocomplete'))
+        self.assertContains(response, '{0}</option>'.format(data['vpn1'].name))
+        self.assertNotContains(response, '{0}</option>'.format(data['vpn2'].name))
+
+    def test_autocomplete_search_and_pagination(self):
+        org = self._create_org()
+        for i in range(3):
+            self._create_template(name='template{0}'.format(i), organization=org)
+        self._create_template(name='other', organization=org)
+        self._login()
+        path = reverse('admin:config_template_autocomplete')
+        with mock.patch.object(TemplateAdmin, 'autocomplete_page_size', 2):
+            response = self.client.get(path, {'q': 'templ'})
+            data = response.json()
+            self.assertEqual([r['text'] for r in data['results']], ['template0', 'template1'])
+            self.assertTrue(data['more'])
+            response = self.client.get(path, {'q': 'templ', 'page': 2})
+            data = response.json()
+            self.assertEqual([r['text'] for r in data['results']], ['template2'])
+            self.assertFalse(data['more'])
+
+    def test_autocomplete_permission(self):
+        self._create_operator(organizations=[self._create_org()])
+        self._login(username='operator', password='tester')
+        with mock.patch.object(TemplateAdmin, 'has_change_permission', return_value=False):
+            response = self.client.get(reverse('admin:config_template_autocomplete'))
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get(reverse('admin:config_template_autocomplete'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_autocomplete_organization_filter(self):
+        data = self._create_multitenancy_test_env()
+        t_shared = self._create_template(name='t-shared', organization=None)
+        self._login()
+        path = reverse('admin:config_template_autocomplete')
+        response = self.client.get(path, {'organization': data['org1'].pk})
+        names = [r['text'] for r in response.json()['results']]
+        self.assertIn(data['t1'].name, names)
+        self.assertIn(t_shared.name, names)
+        self.assertNotIn(data['t2'].name, names)
+        response = self.client.get(path, {'organization': 'invalid'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_operator_organizations_looked_up_once(self):
+        data = self._create_multitenancy_test_env(vpn=True)
+        self._login(username='operator', password='tester')
+        path = reverse('admin:config_device_change', args=[data['c1'].device.pk])
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(path)
+        self.assertContains(response, data['t1'].name)
+        queries = [q['sql'] for q in context.captured_queries
+                   if 'openwisp_users_organizationuser' in q['sql']]
+        self.assertEqual(len(queries), 1)
+
     def test_changelist_recover_deleted_button(self):
         self._create_multitenancy_test_env()
         self._test_changelist_recover_deleted('config', 'device')
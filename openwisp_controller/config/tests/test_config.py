@@ -1,17 +1,35 @@
+from datetime import timedelta
+
+import mock
+import reversion
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.six import StringIO
+from reversion.models import Version
 
 from openwisp_users.tests.utils import TestOrganizationMixin
 
 from . import CreateConfigTemplateMixin, TestVpnX509Mixin
-from ..models import Config, Device, Template
+from ...pki.models import Ca, Cert
+from .. import settings as app_settings
+from ..archive import read_archive
+from ..cache import get_cache
+from ..models import (Config, ConfigBlob, ConfigContent, ConfigVersion, DeactivationJob, Device,
+                      GenerationProfile, Template, Vpn, VpnClient)
 
 
 class TestConfig(CreateConfigTemplateMixin, TestVpnX509Mixin,
                  TestOrganizationMixin, TestCase):
+    ca_model = Ca
+    cert_model = Cert
     config_model = Config
     device_model = Device
     template_model = Template
+    vpn_model = Vpn
 
     def test_config_with_org(self):
         org = self._create_org()
@@ -48,3 +66,387 @@ class TestConfig(CreateConfigTemplateMixin, TestVpnX509Mixin,
             self.assertIn('do not match the organization', e.messages[0])
         else:
             self.fail('ValidationError not raised')
+
+    def test_vpn_context_cache(self):
+        get_cache().clear()
+        config = self._create_vpn_configs()[1][0]
+        vpnclient = config.vpnclient_set.first()
+        keys = vpnclient.vpn._get_auto_context_keys()
+        context = config.get_context()
+        self.assertEqual(context[keys['cert_contents']], vpnclient.cert.certificate)
+        self.assertEqual(context[keys['ca_contents']], vpnclient.vpn.ca.certificate)
+        self.assertIn('client-{0}.pem'.format(vpnclient.vpn.pk.hex), context[keys['cert_path']])
+        config = Config.objects.get(pk=config.pk)
+        # device query + VPN client versions query
+        with self.assertNumQueries(2):
+            self.assertEqual(config.get_context(), context)
+
+    def test_vpn_context_cache_invalidation(self):
+        config = self._create_vpn_configs()[1][0]
+        vpnclient = config.vpnclient_set.first()
+        keys = vpnclient.vpn._get_auto_context_keys()
+        config.get_context()
+        cache_key = vpnclient.get_context_cache_key(vpnclient.pk)
+        self.assertIsNotNone(get_cache().get(cache_key))
+        vpnclient.cert.renew()
+        self.assertIsNone(get_cache().get(cache_key))
+        context = Config.objects.get(pk=config.pk).get_context()
+        vpnclient.cert.refresh_from_db()
+        self.assertEqual(context[keys['cert_contents']], vpnclient.cert.certificate)
+
+    def _create_history_config(self, name='test-device', organization=None,
+                               mac_address='00:11:22:33:44:55'):
+        org = organization or self._create_org()
+        template = self._create_template(name=name, organization=org, config={'files': [{
+            'path': '/etc/test', 'mode': '0644', 'contents': 'test'
+        }]})
+        device = self._create_device(name=name, organization=org, mac_address=mac_address)
+        config = self._create_config(device=device, organization=org)
+        config.templates.add(template)
+        return Config.objects.get(pk=config.pk)
+
+    def _change_config(self, config):
+        config.config['general'] = {'description': 'changed'}
+        config.full_clean()
+        config.save()
+        # the backend instance of ``config`` is cached
+        return Config.objects.get(pk=config.pk)
+
+    def test_config_history(self):
+        config = self._create_history_config()
+        # saving configurations and templates doesn't render them
+        self.assertEqual(config.versions.count(), 0)
+        config.get_archive()
+        self.assertEqual(config.versions.count(), 1)
+        version = config.versions.first()
+        self.assertEqual(version.checksum, config.checksum)
+        self.assertEqual(read_archive(version.get_archive()),
+                         read_archive(config.generate().getvalue()))
+        # unchanged configuration
+        config.get_archive()
+        self.assertEqual(config.versions.count(), 1)
+        config = self._change_config(config)
+        self.assertEqual(config.versions.count(), 1)
+        config.get_archive()
+        self.assertEqual(config.versions.count(), 2)
+        self.assertEqual(config.get_version_at(version.created), version)
+        self.assertIsNone(config.get_version_at(timezone.now() - timedelta(days=1)))
+
+    def test_config_history_not_recorded_on_save(self):
+        with mock.patch.object(ConfigVersion, 'record') as record:
+            config = self._create_history_config()
+            config.set_status_running()
+            config.last_ip = '10.0.0.1'
+            config.save()
+            self._change_config(config)
+            config.templates.add(self._create_template(name='other', organization=config.organization))
+            config.templates.clear()
+        record.assert_not_called()
+
+    @mock.patch.object(app_settings, 'ARCHIVE_HISTORY', 2)
+    def test_config_history_download(self):
+        config = self._create_history_config()
+        config.get_archive()
+        # the latest archive of the history is not recorded again
+        with mock.patch.object(ConfigVersion, 'record') as record:
+            config.get_archive()
+        record.assert_not_called()
+
+    def test_config_history_dedup(self):
+        c1 = self._create_history_config(name='device1')
+        c1.get_archive()
+        blobs = ConfigBlob.objects.count()
+        c2 = self._create_history_config(name='device2',
+                                         organization=c1.device.organization,
+                                         mac_address='00:11:22:33:44:66')
+        c2.get_archive()
+        # only the system file of the second device is stored
+        self.assertEqual(ConfigBlob.objects.count(), blobs + 1)
+        self.assertEqual(read_archive(c2.versions.first().get_archive())['etc/test'],
+                         read_archive(c1.versions.first().get_archive())['etc/test'])
+
+    def test_config_history_reversion(self):
+        config = self._create_history_config()
+        config.get_archive()
+        with reversion.create_revision():
+            config.save()
+        revision = Version.objects.get_for_object(config).first().revision
+        config = self._change_config(config)
+        config.get_archive()
+        blobs = ConfigBlob.objects.count()
+        revision.revert()
+        config = Config.objects.get(pk=config.pk)
+        config.get_archive()
+        self.assertEqual(config.versions.count(), 3)
+        self.assertEqual(config.versions.first().checksum, config.checksum)
+        # the files of the reverted configuration are stored already
+        self.assertEqual(ConfigBlob.objects.count(), blobs)
+
+    def test_config_history_clean(self):
+        config = self._create_history_config()
+        config.get_archive()
+        config = self._change_config(config)
+        config.get_archive()
+        for days, version in enumerate(config.versions.all(), 100):
+            version.created = timezone.now() - timedelta(days=days)
+            version.save()
+        latest = config.versions.first()
+        blobs = ConfigBlob.objects.count()
+        out = StringIO()
+        call_command('clean_config_history', days=90, chunk_size=1, stdout=out)
+        # the system file of the first version is not used by the latest one
+        self.assertIn('Deleted 1 versions and 1 blobs', out.getvalue())
+        self.assertEqual(list(config.versions.all()), [latest])
+        self.assertEqual(ConfigBlob.objects.count(), blobs - 1)
+        config.delete()
+        self.assertEqual(ConfigVersion.delete_expired(days=90), (0, blobs - 1))
+
+    def test_bulk_set_templates(self):
+        org = self._create_org()
+        configs = self._create_configs(org)
+        t1 = self._create_template(name='t1', organization=org)
+        t2 = self._create_template(name='t2', organization=None)
+        vpn_template = self._create_template(name='vpn-test',
+                                             type='vpn',
+                                             vpn=self._create_vpn(organization=org),
+                                             auto_cert=True,
+                                             organization=org)
+        configs[0].templates.add(t1)
+        Config.objects.update(status='running')
+        queryset = Config.objects.filter(organization=org)
+        with mock.patch.object(Config, '_validate_bulk_templates',
+                               wraps=Config._validate_bulk_templates) as validate:
+            count = Config.bulk_set_templates(queryset, [t2, vpn_template, t1], chunk_size=2)
+        self.assertEqual(count, 3)
+        # configs with the same configuration are validated once
+        self.assertEqual(validate.call_count, 1)
+        for config in Config.objects.all():
+            self.assertEqual(config.status, 'modified')
+            self.assertEqual(list(config.templates.all()), [t2, vpn_template, t1])
+        self.assertEqual(VpnClient.objects.count(), 3)
+        # reorder and remove the VPN template
+        Config.bulk_set_templates(queryset, [t1, t2])
+        self.assertEqual(list(configs[1].templates.all()), [t1, t2])
+        self.assertEqual(VpnClient.objects.count(), 0)
+
+    def test_bulk_set_templates_invalid(self):
+        org = self._create_org()
+        configs = self._create_configs(org, count=2)
+        configs[1].config = {'general': {'description': 'different'}}
+        configs[1].full_clean()
+        configs[1].save()
+        t1 = self._create_template(name='t1', organization=org)
+        configs[0].templates.add(t1)
+        org2 = self._create_org(name='org2', slug='org2')
+        t2 = self._create_template(name='t2', organization=org2)
+        with self.assertRaises(ValidationError) as context:
+            Config.bulk_set_templates(Config.objects.all(), [t2])
+        self.assertEqual(set(context.exception.message_dict.keys()), {'device0', 'device1'})
+        self.assertEqual(list(configs[0].templates.all()), [t1])
+
+    def test_generation_profile_disabled(self):
+        config = self._create_history_config()
+        config.generate()
+        self.assertEqual(GenerationProfile.objects.count(), 0)
+
+    @mock.patch.object(app_settings, 'PROFILING', True)
+    def test_generation_profile(self):
+        config = self._create_history_config()
+        template = config.templates.first()
+        # validation of the template added to the configuration
+        validate = GenerationProfile.objects.get(operation='validate', template=template)
+        self.assertEqual(validate.count, 1)
+        GenerationProfile.objects.all().delete()
+        config.generate()
+        config.generate()
+        org_profile = GenerationProfile.objects.get(operation='generate', template=None)
+        self.assertEqual(org_profile.organization_id, config.organization_id)
+        self.assertEqual(org_profile.backend, config.backend)
+        self.assertEqual(org_profile.count, 2)
+        self.assertGreater(org_profile.total_time, 0)
+        self.assertGreaterEqual(org_profile.total_time, org_profile.max_time)
+        self.assertEqual(org_profile.profile, '')
+        template_profile = GenerationProfile.objects.get(operation='generate', template=template)
+        self.assertEqual(template_profile.count, 2)
+
+    @mock.patch.object(app_settings, 'PROFILING', True)
+    @mock.patch.object(app_settings, 'PROFILING_THRESHOLD', 0)
+    def test_generation_profile_cprofile(self):
+        config = self._create_history_config()
+        GenerationProfile.objects.all().delete()
+        config.generate()
+        org_profile = GenerationProfile.objects.get(operation='generate', template=None)
+        self.assertIn('cumulative', org_profile.profile)
+        self.assertIn('generate', org_profile.profile)
+        self.assertEqual(org_profile.profile_time, org_profile.max_time)
+
+    @mock.patch.object(app_settings, 'PROFILING', True)
+    def test_profile_report(self):
+        config = self._create_history_config(name='slow-template')
+        config.generate()
+        out = StringIO()
+        call_command('profile_report', stdout=out)
+        output = out.getvalue()
+        self.assertIn('Organizations (generate, by total time):', output)
+        self.assertIn('  {0}: '.format(config.organization.name), output)
+        self.assertIn('  slow-template ({0}): '.format(config.organization.name), output)
+        out = StringIO()
+        call_command('profile_report', clear=True, stdout=out)
+        self.assertEqual(GenerationProfile.objects.count(), 0)
+        out = StringIO()
+        call_command('profile_report', operation='validate', stdout=out)
+        self.assertIn('no data collected', out.getvalue())
+
+    def test_deactivation_job(self):
+        template, configs = self._create_vpn_configs(count=3)
+        org = template.organization
+        Config.objects.update(status='running')
+        config = Config.objects.get(pk=configs[0].pk)
+        config.get_archive()
+        self.assertIsNotNone(get_cache().get(Config.get_archive_cache_key(config.pk)))
+        org.is_active = False
+        org.save()
+        job = DeactivationJob.objects.get(organization=org)
+        self.assertEqual(job.status, 'pending')
+        # saving again the inactive organization does not create more jobs
+        org.save()
+        self.assertEqual(DeactivationJob.objects.count(), 1)
+        self.assertEqual(DeactivationJob.run_job(job.pk, chunk_size=2), 'completed')
+        job.refresh_from_db()
+        self.assertEqual(job.stage, 'vpnclients')
+        # 3 devices, 3 configs, 3 certs, 3 VPN clients
+        self.assertEqual(job.processed, 12)
+        self.assertEqual(Config.objects.filter(status='modified').count(), 3)
+        self.assertEqual(Cert.objects.filter(vpnclient__isnull=False, revoked=False).count(), 0)
+        self.assertIsNone(get_cache().get(Config.get_archive_cache_key(config.pk)))
+        # completed jobs are not run again
+        self.assertIsNone(DeactivationJob.run_job(job.pk))
+
+    def test_deactivation_job_resume(self):
+        template, configs = self._create_vpn_configs(count=3)
+        org = template.organization
+        Config.objects.update(status='running')
+        Organization = org._meta.model
+        Organization.objects.filter(pk=org.pk).update(is_active=False)
+        job = DeactivationJob.objects.create(organization=org)
+        process_certs = DeactivationJob.process_certs
+        calls = []
+
+        def fail_second_chunk(job, pks):
+            calls.append(pks)
+            if len(calls) == 2:
+                raise ValueError('interrupted')
+            process_certs(job, pks)
+
+        with mock.patch.object(DeactivationJob, 'process_certs', fail_second_chunk):
+            with self.assertRaises(ValueError):
+                job.run(chunk_size=2)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.error, 'interrupted')
+        self.assertEqual(job.stage, 'certs')
+        self.assertEqual(Cert.objects.filter(revoked=True).count(), 2)
+        out = StringIO()
+        call_command('run_deactivation_jobs', chunk_size=2, stdout=out)
+        self.assertIn('{0}: completed'.format(org.slug), out.getvalue())
+        self.assertEqual(Cert.objects.filter(vpnclient__isnull=False, revoked=False).count(), 0)
+
+    def test_deactivation_job_cancelled(self):
+        template, configs = self._create_vpn_configs()
+        org = template.organization
+        Config.objects.update(status='running')
+        job = DeactivationJob.objects.create(organization=org)
+        self.assertEqual(job.run(), 'cancelled')
+        self.assertEqual(Config.objects.filter(status='modified').count(), 0)
+
+    @mock.patch.object(app_settings, 'SHARED_CONFIG', True)
+    def test_shared_config(self):
+        configs = self._create_configs(self._create_org(), config={'general': {'timezone': 'UTC'}})
+        self.assertEqual(ConfigContent.objects.count(), 1)
+        content = ConfigContent.objects.get()
+        self.assertEqual(set(Config.objects.values_list('content', flat=True)), {content.pk})
+        # the column of shared configurations is left empty
+        self.assertEqual(list(Config.objects.values_list('config', flat=True)), ['{}', '{}', '{}'])
+        config = Config.objects.get(pk=configs[0].pk)
+        self.assertEqual(config.config, {'general': {'timezone': 'UTC'}})
+        self.assertEqual(config.checksum, configs[0].checksum)
+        self.assertEqual(Device.objects.select_related('config').get(pk=config.device_id).config.config,
+                         {'general': {'timezone': 'UTC'}})
+        # contents are loaded once per process
+        with self.assertNumQueries(1):
+            Config.objects.get(pk=configs[1].pk)
+        config.config['general']['timezone'] = 'Europe/Rome'
+        config.full_clean()
+        config.save()
+        self.assertEqual(ConfigContent.objects.count(), 2)
+        self.assertEqual(Config.objects.get(pk=config.pk).config['general']['timezone'], 'Europe/Rome')
+        self.assertEqual(Config.objects.get(pk=configs[1].pk).config['general']['timezone'], 'UTC')
+        # unchanged configurations don't look up their content again
+        with CaptureQueriesContext(connection) as context:
+            config.save(update_fields=['status', 'config'])
+        self.assertFalse([q for q in context.captured_queries if 'config_configcontent' in q['sql']])
+        # empty configurations are not shared
+        config.config = {}
+        config.save()
+        self.assertIsNone(Config.objects.get(pk=config.pk).content_id)
+        self.assertEqual(ConfigContent.delete_unreferenced(), 1)
+
+    def test_share_configs_command(self):
+        configs = self._create_configs(self._create_org(), config={'general': {'timezone': 'UTC'}})
+        self.assertEqual(ConfigContent.objects.count(), 0)
+        out = StringIO()
+        with mock.patch.object(app_settings, 'SHARED_CONFIG', True):
+            call_command('share_configs', chunk_size=2, stdout=out)
+        self.assertIn('Shared 3 configurations', out.getvalue())
+        self.assertEqual(ConfigContent.objects.count(), 1)
+        self.assertEqual(list(Config.objects.values_list('config', flat=True)), ['{}', '{}', '{}'])
+        self.assertEqual(Config.objects.get(pk=configs[0].pk).checksum, configs[0].checksum)
+        out = StringIO()
+        call_command('share_configs', chunk_size=2, stdout=out)
+        self.assertIn('Moved 3 configurations back to their rows', out.getvalue())
+        self.assertIn('Deleted 1 unreferenced contents', out.getvalue())
+        self.assertFalse(ConfigContent.objects.exists())
+        self.assertEqual(Config.objects.get(pk=configs[0].pk).config, {'general': {'timezone': 'UTC'}})
+
+    def test_warm_cache(self):
+        configs = self._create_configs(self._create_org(), config={'general': {'timezone': 'UTC'}})
+        invalid = configs[2]
+        invalid_config = {'interfaces': [{'name': 'eth0', 'type': 'wrong'}]}
+        Config.objects.filter(pk=invalid.pk).update(config=invalid_config)
+        get_cache().clear()
+        ConfigVersion.objects.all().delete()
+        with mock.patch('openwisp_controller.config.models.logger.warning') as warning:
+            self.assertEqual(Config.warm_cache([c.pk for c in configs]), (2, 1))
+        warning.assert_called_once()
+        self.assertIn(str(invalid.pk), warning.call_args[0][0])
+        # warming up the cache does not record versions
+        self.assertFalse(ConfigVersion.objects.exists())
+        config = Config.objects.get(pk=configs[0].pk)
+        auth_data = Device.get_cached_auth_data([str(config.device_id)])[str(config.device_id)]
+        self.assertEqual(auth_data['checksum'], config.checksum)
+        expected = read_archive(config.generate().getvalue())
+        with mock.patch.object(Config, 'generate') as generate:
+            self.assertEqual(read_archive(config.get_current_archive()), expected)
+            generate.assert_not_called()
+        self.assertEqual(Device.get_cached_auth_data([str(invalid.device_id)]), {})
+
+    def test_warm_up_cache_command(self):
+        configs = self._create_configs(self._create_org(), config={'general': {'timezone': 'UTC'}})
+        org2 = self._create_org(name='org2', slug='org2')
+        other = self._create_config(device=self._create_device(name='other',
+                                                               mac_address='00:11:22:33:44:10',
+                                                               organization=org2),
+                                    organization=org2)
+        get_cache().clear()
+        out = StringIO()
+        call_command('warm_up_cache', organization=[configs[0].organization.slug],
+                     chunk_size=2, workers=1, stdout=out)
+        self.assertIn('Rendered 3 configurations (0 errors)', out.getvalue())
+        pks = [str(c.device_id) for c in configs + [other]]
+        self.assertEqual(set(Device.get_cached_auth_data(pks).keys()), set(pks[:3]))
+        get_cache().clear()
+        with mock.patch('time.sleep') as sleep:
+            call_command('warm_up_cache', rate=2, workers=1, stdout=StringIO())
+        self.assertEqual(len(Device.get_cached_auth_data(pks)), 4)
+        # chunks of 2 configurations, waits after each chunk
+        self.assertEqual(sleep.call_count, 2)
@@ -1,11 +1,24 @@
-from django.test import TestCase
+import json
+import uuid
+from unittest import skipIf
+
+import mock
+from django.db import connections
+from django.test import Client, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import six
 from django_netjsonconfig import settings as django_netjsonconfig_settings
 
 from openwisp_users.tests.utils import TestOrganizationMixin
 
 from . import CreateConfigTemplateMixin
-from ..models import Config, Device, OrganizationConfigSettings, Template
+from ...metrics import controller_request_duration, controller_requests, registration_fast_path
+from .. import settings as app_settings
+from ..archive import get_checksum, read_archive
+from ..cache import get_cache
+from ..models import Config, ConfigVersion, Device, OrganizationConfigSettings, Template
+from ..replica import use_replica
 
 TEST_MACADDR = '00:11:22:33:44:55'
 TEST_MACADDR_NAME = TEST_MACADDR.replace(':', '-')
@@ -63,6 +76,81 @@ class TestController(CreateConfigTemplateMixin, TestOrganizationMixin,
         self.assertEqual(d.config.templates.filter(name=t1.name).count(), 1)
         self.assertEqual(d.config.templates.filter(name=t_shared.name).count(), 1)
 
+    def test_register_template_tags_order(self):
+        org = self._create_org()
+        t1 = self._create_template(name='b', organization=org)
+        t1.tags.add('mesh')
+        t2 = self._create_template(name='a', organization=org)
+        t2.tags.add('4g')
+        Template.get_tag_index(org.pk)
+        response = self.client.post(REGISTER_URL, {
+            'secret': TEST_ORG_SHARED_SECRET,
+            'name': TEST_MACADDR_NAME,
+            'mac_address': TEST_MACADDR,
+            'backend': 'netjsonconfig.OpenWrt',
+            'tags': 'mesh 4g'
+        })
+        self.assertEqual(response.status_code, 201)
+        device = Device.objects.get(mac_address=TEST_MACADDR)
+        self.assertEqual(list(device.config.templates.all()), [t2, t1])
+
+    def _register_again(self, **kwargs):
+        params = {
+            'secret': TEST_ORG_SHARED_SECRET,
+            'name': TEST_MACADDR_NAME,
+            'mac_address': TEST_MACADDR,
+            'backend': 'netjsonconfig.OpenWrt'
+        }
+        params.update(kwargs)
+        return self.client.post(REGISTER_URL, params)
+
+    def test_register_existing_fast_path(self):
+        self._create_org()
+        self.assertEqual(self._register_again(key=self.TEST_KEY).status_code, 201)
+        device = Device.objects.get(mac_address=TEST_MACADDR)
+        hits = registration_fast_path.get(result='hit')
+        # organization settings + device
+        with self.assertNumQueries(2):
+            response = self._register_again(key=self.TEST_KEY, mac_address=TEST_MACADDR.lower())
+        self.assertEqual(response.status_code, 201)
+        self.assertIn('key: {0}'.format(device.key), response.content.decode())
+        self.assertIn('is-new: 0', response.content.decode())
+        self.assertEqual(registration_fast_path.get(result='hit'), hits + 1)
+        self.assertEqual(Device.objects.count(), 1)
+
+    def test_register_existing_without_key(self):
+        self._create_org()
+        self._register_again(key=self.TEST_KEY)
+        misses = registration_fast_path.get(result='miss')
+        # the shared secret, MAC address and name are not enough
+        # to obtain the key of a device which has been registered
+        for key in [None, 'wrong{0}'.format(self.TEST_KEY[5:])]:
+            response = self._register_again(key=key) if key else self._register_again()
+            self.assertNotIn(self.TEST_KEY, response.content.decode())
+        self.assertEqual(registration_fast_path.get(result='miss'), misses + 2)
+
+    def test_register_existing_tags(self):
+        org = self._create_org()
+        self._register_again(key=self.TEST_KEY)
+        t = self._create_template(name='t1', organization=org)
+        t.tags.add('mesh')
+        misses = registration_fast_path.get(result='miss')
+        response = self._register_again(key=self.TEST_KEY, tags='mesh')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(registration_fast_path.get(result='miss'), misses + 1)
+        config = Device.objects.get(mac_address=TEST_MACADDR).config
+        self.assertIn(t, config.templates.all())
+        hits = registration_fast_path.get(result='hit')
+        self._register_again(key=self.TEST_KEY, tags='mesh')
+        self.assertEqual(registration_fast_path.get(result='hit'), hits + 1)
+
+    def test_register_existing_changed(self):
+        self._create_org()
+        self._register_again(key=self.TEST_KEY)
+        misses = registration_fast_path.get(result='miss')
+        self._register_again(key=self.TEST_KEY, backend='netjsonconfig.OpenWisp')
+        self.assertEqual(registration_fast_path.get(result='miss'), misses + 1)
+
     def test_register_400(self):
         self._create_org()
         # missing secret
@@ -135,6 +223,256 @@ class TestController(CreateConfigTemplateMixin, TestOrganizationMixin,
         response = self.client.get(reverse('controller:checksum', args=[c.device.pk]), {'key': c.device.key})
         self.assertEqual(response.status_code, 200)
 
+    def test_checksum_batch(self):
+        configs = self._create_configs(self._create_org())
+        get_cache().clear()
+        url = reverse('controller:checksum_batch')
+        devices = ['{0}:{1}'.format(c.device.pk, c.device.key) for c in configs]
+        missing = '{0}:{1}'.format(uuid.uuid4(), 'a' * 32)
+        wrong_key = '{0}:wrong'.format(configs[0].device.pk)
+        with CaptureQueriesContext(connections['default']) as context:
+            response = self.client.post(url, {'device': devices + [missing, 'invalid:key', wrong_key]})
+        self.assertEqual(response.status_code, 200)
+        # devices are looked up with one query, last_ip is updated with another one
+        # and the search text of the devices with two more (regardless of their number)
+        device_queries = [q for q in context.captured_queries if 'FROM "config_device"' in q['sql']]
+        self.assertEqual(len(device_queries), 2)
+        update_queries = [q for q in context.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(update_queries), 2)
+        lines = response.content.decode().splitlines()
+        self.assertEqual(lines[:3], ['{0} {1}'.format(c.device.pk, c.checksum) for c in configs])
+        self.assertEqual(lines[3:], ['{0} 404'.format(missing.split(':')[0]),
+                                     'invalid 404',
+                                     '{0} 403'.format(configs[0].device.pk)])
+        for config in configs:
+            config.refresh_from_db()
+            self.assertEqual(config.last_ip, '127.0.0.1')
+        # data is cached and last_ip is unchanged
+        with self.assertNumQueries(0):
+            response = self.client.post(url, {'device': devices})
+        self.assertEqual(len(response.content.decode().splitlines()), 3)
+
+    def test_checksum_batch_400(self):
+        url = reverse('controller:checksum_batch')
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(url, {'device': 'no-key'})
+        self.assertEqual(response.status_code, 400)
+        with mock.patch.object(app_settings, 'CHECKSUM_BATCH_SIZE', 1):
+            response = self.client.post(url, {'device': ['a:b', 'c:d']})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('too many devices', response.content.decode())
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 405)
+
+    def test_checksum_batch_disabled_org(self):
+        org = self._create_org(is_active=False)
+        config = self._create_config(organization=org)
+        response = self.client.post(reverse('controller:checksum_batch'),
+                                    {'device': '{0}:{1}'.format(config.device.pk, config.device.key)})
+        self.assertEqual(response.content.decode(), '{0} 404\n'.format(config.device.pk))
+
+    def test_checksum_wait(self):
+        c = self._create_config(organization=self._create_org())
+        url = reverse('controller:checksum_wait', args=[c.device.pk])
+        # the checksum is different, returned immediately
+        response = self.client.get(url, {'key': c.device.key, 'checksum': 'old'})
+        self.assertEqual(response.content.decode(), c.checksum)
+        response = self.client.get(url, {'key': c.device.key, 'checksum': c.checksum, 'timeout': 0.1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content.decode(), c.checksum)
+
+    @mock.patch.object(app_settings, 'PUBSUB_BACKEND', 'openwisp_controller.config.pubsub.LocalBackend')
+    def test_checksum_wait_change(self):
+        c = self._create_config(organization=self._create_org())
+        checksum = c.checksum
+        url = reverse('controller:checksum_wait', args=[c.device.pk])
+        waits = []
+
+        def wait(timeout):
+            waits.append(timeout)
+            if len(waits) == 1:
+                # notification which does not change the configuration
+                return True
+            c.config = {'general': {'description': 'changed'}}
+            c.full_clean()
+            c.save()
+            return True
+
+        with mock.patch('openwisp_controller.config.pubsub.LocalSubscription.wait', side_effect=wait):
+            response = self.client.get(url, {'key': c.device.key, 'checksum': checksum})
+        self.assertEqual(len(waits), 2)
+        self.assertLessEqual(waits[0], app_settings.LONG_POLL_TIMEOUT)
+        self.assertNotEqual(response.content.decode(), checksum)
+        self.assertEqual(response.content.decode(), Config.objects.get(pk=c.pk).checksum)
+
+    def test_checksum_wait_errors(self):
+        c = self._create_config(organization=self._create_org())
+        url = reverse('controller:checksum_wait', args=[c.device.pk])
+        response = self.client.get(url, {'key': c.device.key})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(url, {'key': c.device.key, 'checksum': c.checksum, 'timeout': 'a'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(url, {'key': 'wrong', 'checksum': c.checksum})
+        self.assertEqual(response.status_code, 403)
+        url = reverse('controller:checksum_wait', args=['invalid'])
+        response = self.client.get(url, {'key': c.device.key, 'checksum': c.checksum})
+        self.assertEqual(response.status_code, 404)
+
+    def test_checksum_metrics(self):
+        c = self._create_config(organization=self._create_org())
+        url = reverse('controller:checksum', args=[c.device.pk])
+        ok = controller_requests.get(view='checksum', status=200)
+        forbidden = controller_requests.get(view='checksum', status=403)
+        observations = controller_request_duration.get(view='checksum')[0]
+        self.client.get(url, {'key': c.device.key})
+        self.client.get(url, {'key': 'wrong'})
+        self.assertEqual(controller_requests.get(view='checksum', status=200), ok + 1)
+        self.assertEqual(controller_requests.get(view='checksum', status=403), forbidden + 1)
+        self.assertEqual(controller_request_duration.get(view='checksum')[0], observations + 2)
+
+    def test_checksum_cached(self):
+        c = self._create_config(organization=self._create_org())
+        url = reverse('controller:checksum', args=[c.device.pk])
+        response = self.client.get(url, {'key': c.device.key})
+        self.assertEqual(response.content.decode(), c.checksum)
+        c.refresh_from_db()
+        self.assertEqual(c.last_ip, '127.0.0.1')
+        with self.assertNumQueries(0):
+            response = self.client.get(url, {'key': c.device.key})
+        self.assertEqual(response.content.decode(), c.checksum)
+        with self.assertNumQueries(0):
+            response = self.client.get(url, {'key': 'wrong'})
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 400)
+
+    def test_checksum_cache_device_invalidation(self):
+        c = self._create_config(organization=self._create_org())
+        device = c.device
+        url = reverse('controller:checksum', args=[device.pk])
+        self.client.get(url, {'key': device.key})
+        old_key = device.key
+        device.key = 'a' * 32
+        device.save()
+        response = self.client.get(url, {'key': old_key})
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get(url, {'key': device.key})
+        self.assertEqual(response.status_code, 200)
+        device.organization.is_active = False
+        device.organization.save()
+        response = self.client.get(url, {'key': device.key})
+        self.assertEqual(response.status_code, 404)
+
+    def test_checksum_cache_template_invalidation(self):
+        org = self._create_org()
+        c = self._create_config(organization=org)
+        t = self._create_template(organization=org)
+        url = reverse('controller:checksum', args=[c.device.pk])
+        checksum = self.client.get(url, {'key': c.device.key}).content.decode()
+        c.templates.add(t)
+        response = self.client.get(url, {'key': c.device.key})
+        self.assertNotEqual(response.content.decode(), checksum)
+        checksum = response.content.decode()
+        t.config['interfaces'][0]['name'] = 'eth9'
+        t.full_clean()
+        t.save()
+        response = self.client.get(url, {'key': c.device.key})
+        self.assertNotEqual(response.content.decode(), checksum)
+        self.assertEqual(response.content.decode(), Config.objects.get(pk=c.pk).checksum)
+
+    def test_csrf_exempt(self):
+        client = Client(enforce_csrf_checks=True)
+        self._create_org()
+        response = client.post(REGISTER_URL, {
+            'secret': TEST_ORG_SHARED_SECRET,
+            'name': TEST_MACADDR_NAME,
+            'mac_address': TEST_MACADDR,
+            'backend': 'netjsonconfig.OpenWrt'
+        })
+        self.assertEqual(response.status_code, 201)
+        device = Device.objects.get(mac_address=TEST_MACADDR)
+        response = client.post(reverse('controller:report_status', args=[device.pk]),
+                               {'key': device.key, 'status': 'running'})
+        self.assertEqual(response.status_code, 200)
+
+    def _get_delta(self, config, checksum):
+        url = reverse('controller:download_config_delta', args=[config.device.pk])
+        return self.client.get(url, {'key': config.device.key, 'checksum': checksum})
+
+    def test_download_config_delta(self):
+        org = self._create_org()
+        c = self._create_config(organization=org)
+        t = self._create_template(organization=org, config={'files': [{
+            'path': '/etc/test', 'mode': '0644', 'contents': 'test'
+        }]})
+        c.templates.add(t)
+        # unknown checksum: full archive
+        response = self._get_delta(c, 'unknown')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Openwisp-Controller-Delta'], 'false')
+        full = response.content
+        checksum = response['X-Openwisp-Controller-Checksum']
+        self.assertEqual(checksum, get_checksum(full))
+        self.assertEqual(list(read_archive(full).keys()), ['etc/config/system', 'etc/test'])
+        # only the changed file is delivered
+        c.config['general'] = {'hostname': 'changed'}
+        c.full_clean()
+        c.save()
+        c.templates.remove(t)
+        response = self._get_delta(c, checksum)
+        self.assertEqual(response['X-Openwisp-Controller-Delta'], 'true')
+        self.assertEqual(json.loads(response['X-Openwisp-Controller-Removed']), ['etc/test'])
+        self.assertEqual(list(read_archive(response.content).keys()), ['etc/config/system'])
+        # up to date
+        response = self._get_delta(c, response['X-Openwisp-Controller-Checksum'])
+        self.assertEqual(response['X-Openwisp-Controller-Delta'], 'true')
+        self.assertEqual(read_archive(response.content), {})
+        self.assertFalse(response.has_header('X-Openwisp-Controller-Removed'))
+
+    def test_download_config_delta_400(self):
+        c = self._create_config(organization=self._create_org())
+        url = reverse('controller:download_config_delta', args=[c.device.pk])
+        response = self.client.get(url, {'key': c.device.key})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(url, {'key': 'wrong', 'checksum': c.checksum})
+        self.assertEqual(response.status_code, 403)
+
+    @mock.patch.object(app_settings, 'ARCHIVE_HISTORY', 2)
+    @mock.patch.object(app_settings, 'CONFIG_HISTORY', False)
+    def test_archive_history(self):
+        c = self._create_config(organization=self._create_org())
+        checksums = []
+        for hostname in ['first', 'second', 'third']:
+            c = Config.objects.get(pk=c.pk)
+            c.config['general'] = {'hostname': hostname}
+            checksums.append(get_checksum(c.get_archive()))
+        self.assertIsNone(c.get_stored_archive(checksums[0]))
+        self.assertIsNotNone(c.get_stored_archive(checksums[1]))
+        self.assertIsNotNone(c.get_stored_archive(checksums[2]))
+        delta, removed = c.get_archive_delta(checksums[0])
+        self.assertIsNone(removed)
+
+    @mock.patch.object(app_settings, 'ARCHIVE_HISTORY', 0)
+    def test_archive_delta_config_history(self):
+        c = self._create_config(organization=self._create_org())
+        # the archive downloaded by the device is recorded,
+        # then the archive history is flushed
+        checksum = get_checksum(c.get_archive())
+        Config.delete_archive_cache([c.pk])
+        c.config['general'] = {'description': 'changed'}
+        c.full_clean()
+        c.save()
+        response = self._get_delta(c, checksum)
+        self.assertEqual(response['X-Openwisp-Controller-Delta'], 'true')
+        self.assertEqual(list(read_archive(response.content).keys()), ['etc/config/system'])
+
+    @mock.patch.object(app_settings, 'ARCHIVE_HISTORY', 0)
+    @mock.patch.object(app_settings, 'CONFIG_HISTORY', False)
+    def test_archive_history_disabled(self):
+        c = self._create_config(organization=self._create_org())
+        self.assertIsNone(c.get_stored_archive(get_checksum(c.get_archive())))
+
 
 class TestRegistrationDisabled(TestOrganizationMixin, TestCase):
     @classmethod
@@ -159,3 +497,68 @@ class TestRegistrationDisabled(TestOrganizationMixin, TestCase):
         count = Device.objects.filter(mac_address=TEST_MACADDR,
                                       organization=org).count()
         self.assertEqual(count, 0)
+
+
+class TestControllerReplica(CreateConfigTemplateMixin, TestOrganizationMixin,
+                            TransactionTestCase):
+    """
+    tests for reads performed on OPENWISP_CONTROLLER_DATABASE_REPLICA
+    (the test replica is a mirror of the default database, a
+    TransactionTestCase is used in order to make data visible to it)
+    """
+    multi_db = True
+    config_model = Config
+    device_model = Device
+    template_model = Template
+
+    def _test_replica_reads(self, url_name, pinned=False):
+        config = self._create_config(organization=self._create_org())
+        device = config.device
+        if not pinned:
+            get_cache().clear()
+        url = reverse(url_name, args=[device.pk])
+        with CaptureQueriesContext(connections['replica']) as replica:
+            response = self.client.get(url, {'key': device.key})
+        self.assertEqual(response.status_code, 200)
+        return len(replica.captured_queries)
+
+    @skipIf(six.PY2, 'the in-memory test database is not shared with the replica on python 2')
+    @mock.patch.object(app_settings, 'DATABASE_REPLICA', 'replica')
+    def test_checksum_replica(self):
+        self.assertGreater(self._test_replica_reads('controller:checksum'), 0)
+        # last_ip has been saved on the primary database
+        config = Config.objects.using('default').get()
+        self.assertEqual(config.last_ip, '127.0.0.1')
+
+    @mock.patch.object(app_settings, 'DATABASE_REPLICA', 'replica')
+    def test_checksum_replica_pinned(self):
+        self.assertEqual(self._test_replica_reads('controller:checksum', pinned=True), 0)
+
+    @skipIf(six.PY2, 'the in-memory test database is not shared with the replica on python 2')
+    @mock.patch.object(app_settings, 'DATABASE_REPLICA', 'replica')
+    def test_download_config_replica(self):
+        self.assertGreater(self._test_replica_reads('controller:download_config'), 0)
+
+    def test_checksum_replica_disabled(self):
+        self.assertEqual(self._test_replica_reads('controller:checksum'), 0)
+
+    @mock.patch.object(app_settings, 'DATABASE_REPLICA', 'replica')
+    def test_template_change_pins_reads(self):
+        config = self._create_config(organization=self._create_org())
+        get_cache().clear()
+        self._create_template()
+        url = reverse('controller:checksum', args=[config.device.pk])
+        with CaptureQueriesContext(connections['replica']) as replica:
+            response = self.client.get(url, {'key': config.device.key})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(replica.captured_queries), 0)
+
+    @mock.patch.object(app_settings, 'DATABASE_REPLICA', 'replica')
+    def test_config_version_primary(self):
+        config = self._create_config(organization=self._create_org())
+        contents = config.generate().getvalue()
+        get_cache().clear()
+        with use_replica():
+            with CaptureQueriesContext(connections['replica']) as replica:
+                ConfigVersion.record(config, contents)
+        self.assertEqual(len(replica.captured_queries), 0)
@@ -1,3 +1,4 @@
+import mock
 from django.core.exceptions import ValidationError
 from django.test import TestCase
 
@@ -5,6 +6,7 @@ from openwisp_users.tests.utils import TestOrganizationMixin
 
 from . import CreateConfigTemplateMixin
 from ..models import Config, Device
+from ..utils import get_search_text
 
 
 class TestDevice(CreateConfigTemplateMixin, TestOrganizationMixin, TestCase):
@@ -24,3 +26,85 @@ class TestDevice(CreateConfigTemplateMixin, TestOrganizationMixin, TestCase):
             self.assertIn('This field', e.message_dict['organization'][0])
         else:
             self.fail('ValidationError not raised')
+
+    def test_search_text(self):
+        org = self._create_org()
+        device = self._create_device(organization=org, name='Test-Device', mac_address='00:11:22:AA:BB:CC')
+        self.assertEqual(device.search, 'test-device 00:11:22:aa:bb:cc 001122aabbcc')
+        config = self._create_config(device=device, organization=org)
+        config.last_ip = '10.0.0.1'
+        config.save()
+        device.refresh_from_db()
+        self.assertEqual(device.search, 'test-device 00:11:22:aa:bb:cc 001122aabbcc 10.0.0.1')
+        device.name = 'renamed'
+        device.save()
+        device.refresh_from_db()
+        self.assertEqual(device.search, 'renamed 00:11:22:aa:bb:cc 001122aabbcc 10.0.0.1')
+        # the last ip is not looked up if name and mac address are unchanged
+        device = Device.objects.get(pk=device.pk)
+        device.notes = 'notes'
+        with self.assertNumQueries(1):
+            device.save()
+        self.assertEqual(device.search, 'renamed 00:11:22:aa:bb:cc 001122aabbcc 10.0.0.1')
+        auth_data = Device.get_auth_data(str(device.pk))
+        Device.update_auth_last_ip(str(device.pk), auth_data, '10.0.0.2')
+        device.refresh_from_db()
+        self.assertEqual(device.search, 'renamed 00:11:22:aa:bb:cc 001122aabbcc 10.0.0.2')
+        Device.update_many_auth_last_ip({str(device.pk): auth_data}, '10.0.0.3')
+        device.refresh_from_db()
+        self.assertTrue(device.search.endswith(' 10.0.0.3'))
+
+    def test_search_query(self):
+        org = self._create_org()
+        devices = []
+        for i in range(2000):
+            mac_address = '00:11:22:33:{0:02x}:{1:02x}'.format(i // 256, i % 256)
+            name = 'device-{0}'.format(i)
+            last_ip = '10.0.{0}.{1}'.format(i // 256, i % 256)
+            devices.append(Device(organization=org,
+                                  name=name,
+                                  mac_address=mac_address,
+                                  key='{0:032d}'.format(i),
+                                  search=get_search_text(name, mac_address, last_ip)))
+        Device.objects.bulk_create(devices)
+        queryset = Device.objects.filter(Device.get_search_query('DEVICE-1999'))
+        self.assertEqual(list(queryset.values_list('name', flat=True)), ['device-1999'])
+        # mac addresses match with or without separators and in any case
+        for search in ['00:11:22:33:07:CF', '00112233 07cf']:
+            queryset = Device.objects.filter(Device.get_search_query(search))
+            self.assertEqual(list(queryset.values_list('name', flat=True)), ['device-1999'])
+        queryset = Device.objects.filter(Device.get_search_query('10.0.7.20'))
+        self.assertEqual(sorted(queryset.values_list('name', flat=True)),
+                         ['device-1812'] + ['device-{0}'.format(i) for i in range(1992, 2000)])
+        self.assertEqual(Device.objects.filter(Device.get_search_query('device 10.0.0.')).count(), 256)
+        # only the normalized column is looked up
+        sql = str(Device.objects.filter(Device.get_search_query('device-1')).query)
+        self.assertIn('"config_device"."search" LIKE', sql)
+        self.assertNotIn('"config_device"."name" LIKE', sql)
+
+    def test_auth_data_invalidated_while_built(self):
+        config = self._create_config(organization=self._create_org())
+        pk = str(config.device_id)
+        build = Device._build_auth_data
+
+        def build_and_invalidate(*args, **kwargs):
+            data = build(*args, **kwargs)
+            # eg: the configuration is changed by a concurrent request
+            Device.invalidate_many_auth_cache([pk])
+            return data
+
+        with mock.patch.object(Device, '_build_auth_data', build_and_invalidate):
+            Device.get_auth_data(pk)
+        # the data built before the invalidation is not used
+        self.assertEqual(Device.get_cached_auth_data([pk]), {})
+        Device.get_auth_data(pk)
+        self.assertIn(pk, Device.get_cached_auth_data([pk]))
+
+    def test_auth_data_pk_format(self):
+        config = self._create_config(organization=self._create_org())
+        device = config.device
+        # devices use the hex of their UUID
+        Device.get_auth_data(device.pk.hex)
+        self.assertIn(device.pk.hex, Device.get_cached_auth_data([device.pk.hex]))
+        device.save()
+        self.assertEqual(Device.get_cached_auth_data([device.pk.hex]), {})
@@ -0,0 +1,181 @@
+import json
+import os
+import tempfile
+
+import mock
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils.six import StringIO
+
+from openwisp_users.tests.utils import TestOrganizationMixin
+
+from . import CreateConfigTemplateMixin, TestVpnX509Mixin
+from ...pki.models import Ca, Cert
+from .. import settings as app_settings
+from ..importer import DeviceImporter
+from ..models import Config, ConfigContent, Device, Template, Vpn
+
+CSV_HEADER = 'name,mac_address,key,model,backend,config,templates\n'
+
+
+class TestImporter(CreateConfigTemplateMixin, TestVpnX509Mixin,
+                   TestOrganizationMixin, TestCase):
+    ca_model = Ca
+    cert_model = Cert
+    config_model = Config
+    device_model = Device
+    template_model = Template
+    vpn_model = Vpn
+
+    def _csv_row(self, name, mac, templates='', config=None, key=''):
+        config = json.dumps(config).replace('"', '""') if config else ''
+        return '{0},{1},{2},,,"{3}","{4}"\n'.format(name, mac, key, config, templates)
+
+    def test_import_csv(self):
+        org = self._create_org()
+        t1 = self._create_template(name='t1', organization=org)
+        t2 = self._create_template(name='t2')
+        config = {'general': {'description': 'imported'}}
+        stream = StringIO(CSV_HEADER +
+                          self._csv_row('device1', '00:11:22:33:44:01', 't2,t1', config) +
+                          self._csv_row('device2', '00:11:22:33:44:02', 't1'))
+        importer = DeviceImporter(org, batch_size=1)
+        self.assertEqual(importer.run(stream), 2)
+        self.assertEqual(importer.errors, [])
+        device = Device.objects.get(name='device1')
+        self.assertEqual(device.organization, org)
+        self.assertEqual(len(device.key), 32)
+        self.assertEqual(device.config.organization, org)
+        self.assertEqual(device.config.config, config)
+        self.assertEqual(list(device.config.templates.all()), [t2, t1])
+        self.assertEqual(list(Device.objects.get(name='device2').config.templates.all()), [t1])
+
+    def test_import_netjson(self):
+        org = self._create_org()
+        t = self._create_template(name='t1', organization=org)
+        rows = [
+            {'name': 'device1', 'mac_address': '00:11:22:33:44:01', 'templates': ['t1']},
+            {'name': 'device2', 'mac_address': '00:11:22:33:44:02', 'key': self.TEST_KEY,
+             'config': {'general': {'hostname': 'device2'}}},
+        ]
+        stream = StringIO('\n'.join(json.dumps(row) for row in rows) + '\n\n')
+        importer = DeviceImporter(org)
+        self.assertEqual(importer.run(stream, 'netjson'), 2)
+        self.assertEqual(list(Device.objects.get(name='device1').config.templates.all()), [t])
+        device = Device.objects.get(name='device2')
+        self.assertEqual(device.key, self.TEST_KEY)
+        self.assertEqual(device.config.config, {'general': {'hostname': 'device2'}})
+        self.assertEqual(device.config.templates.count(), 0)
+
+    def test_default_templates(self):
+        org1 = self._create_org()
+        org2 = self._create_org(name='org2', slug='org2')
+        t1 = self._create_template(name='t1', organization=org1, default=True)
+        t2 = self._create_template(name='t2', default=True)
+        self._create_template(name='t3', organization=org2, default=True)
+        self._create_template(name='t4', organization=org1, default=True,
+                              backend='netjsonconfig.OpenWisp')
+        self._create_template(name='t5', organization=org1)
+        stream = StringIO(CSV_HEADER + self._csv_row('device1', '00:11:22:33:44:01'))
+        DeviceImporter(org1).run(stream)
+        config = Device.objects.get(name='device1').config
+        self.assertEqual(list(config.templates.all()), [t1, t2])
+
+    def test_errors(self):
+        org = self._create_org()
+        self._create_template(name='t1', organization=org)
+        self._create_config(organization=org)
+        invalid_config = {'interfaces': [{'name': 'eth0', 'type': 'wrong'}]}
+        stream = StringIO(CSV_HEADER +
+                          self._csv_row('test-device', '00:11:22:33:44:01') +
+                          self._csv_row('device2', '00:11:22:33:44:02', 'missing') +
+                          self._csv_row('device3', '00:11:22:33:44:03', '', invalid_config) +
+                          'device4,00:11:22:33:44:04,,,,"{invalid",\n' +
+                          self._csv_row('device5', 'wrong') +
+                          self._csv_row('device6', '00:11:22:33:44:06') +
+                          self._csv_row('device6', '00:11:22:33:44:07'))
+        received = []
+        importer = DeviceImporter(org, on_error=lambda line, error: received.append(line))
+        self.assertEqual(importer.run(stream), 1)
+        # duplicates are detected when the batch is inserted
+        self.assertEqual(received, [3, 4, 5, 6, 2, 8])
+        self.assertEqual([line for line, error in importer.errors], [3, 4, 5, 6, 2, 8])
+        self.assertEqual(importer.error_count, 6)
+        errors = dict(importer.errors)
+        self.assertIn('name: device with this name already exists', errors[2])
+        self.assertEqual(errors[3], 'unknown templates: missing')
+        self.assertIn('Invalid configuration', errors[4])
+        self.assertIn('invalid JSON in config', errors[5])
+        self.assertIn('mac_address', errors[6])
+        self.assertIn('name: device with this name already exists', errors[8])
+        self.assertEqual(Device.objects.filter(organization=org).count(), 2)
+
+    @mock.patch.object(app_settings, 'SHARED_CONFIG', True)
+    def test_shared_config(self):
+        org = self._create_org()
+        config = {'general': {'description': 'imported'}}
+        stream = StringIO(CSV_HEADER +
+                          self._csv_row('device1', '00:11:22:33:44:01', '', config) +
+                          self._csv_row('device2', '00:11:22:33:44:02', '', config) +
+                          self._csv_row('device3', '00:11:22:33:44:03'))
+        DeviceImporter(org).run(stream)
+        self.assertEqual(ConfigContent.objects.count(), 1)
+        self.assertEqual(Config.objects.exclude(content=None).count(), 2)
+        self.assertEqual(Device.objects.get(name='device2').config.config, config)
+        self.assertEqual(Device.objects.get(name='device3').config.config, {})
+
+    def test_netjson_errors(self):
+        org = self._create_org()
+        stream = StringIO('{invalid\n[]\n')
+        importer = DeviceImporter(org)
+        self.assertEqual(importer.run(stream, 'netjson'), 0)
+        self.assertEqual([line for line, error in importer.errors], [1, 2])
+        self.assertIn('expected an object', importer.errors[1][1])
+
+    def test_max_errors(self):
+        org = self._create_org()
+        stream = StringIO(CSV_HEADER + self._csv_row('device1', 'wrong') * 3)
+        importer = DeviceImporter(org)
+        importer.max_errors = 2
+        importer.run(stream)
+        self.assertEqual(len(importer.errors), 2)
+        self.assertEqual(importer.error_count, 3)
+
+    def test_configurations_validated_once(self):
+        org = self._create_org()
+        self._create_template(name='t1', organization=org)
+        stream = StringIO(CSV_HEADER + ''.join(
+            self._csv_row('device{0}'.format(i), '00:11:22:33:44:0{0}'.format(i), 't1')
+            for i in range(5)
+        ))
+        importer = DeviceImporter(org)
+        importer.run(stream)
+        self.assertEqual(importer.created, 5)
+        self.assertEqual(len(importer._validated), 1)
+
+    def test_vpn_clients(self):
+        org = self._create_org()
+        vpn = self._create_vpn(organization=org)
+        self._create_template(name='vpn', organization=org, type='vpn', vpn=vpn, auto_cert=True)
+        stream = StringIO(CSV_HEADER +
+                          self._csv_row('device1', '00:11:22:33:44:01', 'vpn') +
+                          self._csv_row('device2', '00:11:22:33:44:02', 'vpn'))
+        DeviceImporter(org).run(stream)
+        for name in ['device1', 'device2']:
+            vpnclient = Device.objects.get(name=name).config.vpnclient_set.get()
+            self.assertEqual(vpnclient.vpn, vpn)
+            self.assertIsNotNone(vpnclient.cert)
+
+    def test_import_devices_command(self):
+        org = self._create_org()
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as f:
+            f.write(CSV_HEADER +
+                    self._csv_row('device1', '00:11:22:33:44:01') +
+                    self._csv_row('device2', 'wrong'))
+        out, err = StringIO(), StringIO()
+        call_command('import_devices', path, '--organization', org.slug, stdout=out, stderr=err)
+        self.assertIn('Imported 1 devices, 1 errors', out.getvalue())
+        self.assertIn('line 3: mac_address', err.getvalue())
+        self.assertTrue(Device.objects.filter(name='device1', organization=org).exists())
@@ -0,0 +1,63 @@
+import threading
+
+import mock
+from django.test import TestCase, TransactionTestCase
+
+from openwisp_users.tests.utils import TestOrganizationMixin
+
+from . import CreateConfigTemplateMixin
+from .. import settings as app_settings
+from ..models import Config, Device, Template
+from ..pubsub import BROADCAST, CacheBackend, LocalBackend, get_pubsub_backend
+
+LOCAL_BACKEND = 'openwisp_controller.config.pubsub.LocalBackend'
+
+
+class TestPubSub(TestCase):
+    def _test_backend(self, backend):
+        with backend.subscribe('device1') as s1, backend.subscribe('device2') as s2:
+            self.assertFalse(s1.wait(0))
+            timer = threading.Timer(0.1, backend.publish, args=['device1'])
+            timer.start()
+            self.assertTrue(s1.wait(5))
+            timer.join()
+            self.assertFalse(s2.wait(0))
+            # notifications are consumed
+            self.assertFalse(s1.wait(0))
+            backend.publish(BROADCAST)
+            self.assertTrue(s1.wait(0.1))
+            self.assertTrue(s2.wait(0.1))
+
+    def test_local_backend(self):
+        backend = LocalBackend()
+        self._test_backend(backend)
+        self.assertEqual(backend._channels, {})
+
+    def test_cache_backend(self):
+        backend = CacheBackend()
+        backend.poll_interval = 0.01
+        self._test_backend(backend)
+
+
+class TestPublishChange(CreateConfigTemplateMixin, TestOrganizationMixin, TransactionTestCase):
+    config_model = Config
+    device_model = Device
+    template_model = Template
+
+    @mock.patch.object(app_settings, 'PUBSUB_BACKEND', LOCAL_BACKEND)
+    def test_publish_change(self):
+        org = self._create_org()
+        config = self._create_config(organization=org)
+        backend = get_pubsub_backend()
+        with backend.subscribe(config.device.pk.hex) as subscription:
+            config.config = {'general': {'description': 'changed'}}
+            config.full_clean()
+            config.save()
+            self.assertTrue(subscription.wait(0))
+            # changes to templates are published to the devices which use them
+            template = self._create_template(organization=org)
+            self.assertFalse(subscription.wait(0))
+            config.templates.add(template)
+            self.assertTrue(subscription.wait(0))
+            template.save()
+            self.assertTrue(subscription.wait(0))
@@ -3,7 +3,7 @@ from django_netjsonconfig.tests import CreateTemplateMixin
 
 from openwisp_users.tests.utils import TestOrganizationMixin
 
-from ..models import Template
+from ..models import Template, TemplateTag
 
 
 class TestTag(TestOrganizationMixin, CreateTemplateMixin, TestCase):
@@ -16,3 +16,35 @@ class TestTag(TestOrganizationMixin, CreateTemplateMixin, TestCase):
         t = self._create_template(organization=self._create_org())
         t.tags.add('mesh')
         self.assertEqual(t.tags.filter(name='mesh').count(), 1)
+
+    def test_tag_index(self):
+        org1 = self._create_org(name='org1')
+        org2 = self._create_org(name='org2')
+        t1 = self._create_template(name='t1', organization=org1)
+        t1.tags.add('mesh', '4g')
+        shared = self._create_template(name='shared')
+        shared.tags.add('mesh')
+        t2 = self._create_template(name='t2', organization=org2)
+        t2.tags.add('mesh')
+        self.assertEqual(Template.get_tagged_template_pks(org1.pk, ['mesh']), [shared.pk, t1.pk])
+        with self.assertNumQueries(0):
+            self.assertEqual(Template.get_tagged_template_pks(org1.pk, ['4g', 'mesh', 'wds']),
+                             [shared.pk, t1.pk])
+        self.assertEqual(Template.get_tagged_template_pks(org2.pk, ['4g']), [])
+
+    def test_tag_index_invalidation(self):
+        org = self._create_org()
+        t1 = self._create_template(name='t1', organization=org)
+        t1.tags.add('mesh')
+        self.assertEqual(Template.get_tagged_template_pks(org.pk, ['mesh']), [t1.pk])
+        t2 = self._create_template(name='t0', organization=org)
+        t2.tags.add('mesh')
+        self.assertEqual(Template.get_tagged_template_pks(org.pk, ['mesh']), [t2.pk, t1.pk])
+        t1.tags.remove('mesh')
+        self.assertEqual(Template.get_tagged_template_pks(org.pk, ['mesh']), [t2.pk])
+        tag = TemplateTag.objects.get(name='mesh')
+        tag.name = 'wds'
+        tag.save()
+        self.assertEqual(Template.get_tagged_template_pks(org.pk, ['wds']), [t2.pk])
+        t2.delete()
+        self.assertEqual(Template.get_tagged_template_pks(org.pk, ['wds']), [])
@@ -0,0 +1,137 @@
+import threading
+
+import mock
+from django.test import TestCase
+from django.urls import reverse
+
+from openwisp_users.tests.utils import TestOrganizationMixin
+
+from . import CreateConfigTemplateMixin
+from .. import settings as app_settings
+from ..models import Config, Device, Template
+from ..throttling import CacheBackend, MemoryBackend, RequestCoalescer
+
+MEMORY_BACKEND = 'openwisp_controller.config.throttling.MemoryBackend'
+
+
+class TestThrottling(CreateConfigTemplateMixin, TestOrganizationMixin, TestCase):
+    config_model = Config
+    device_model = Device
+    template_model = Template
+
+    def _test_backend(self, backend):
+        self.assertEqual(backend.consume('test', 2, 60), 0)
+        self.assertEqual(backend.consume('test', 2, 60), 0)
+        retry_after = backend.consume('test', 2, 60)
+        self.assertGreater(retry_after, 0)
+        self.assertLessEqual(retry_after, 30)
+        # other buckets are not affected
+        self.assertEqual(backend.consume('other', 2, 60), 0)
+
+    def test_memory_backend(self):
+        self._test_backend(MemoryBackend())
+
+    def test_memory_backend_max_size(self):
+        backend = MemoryBackend()
+        backend.max_size = 2
+        for key in ['a', 'b', 'c']:
+            backend.consume(key, 1, 60)
+        self.assertEqual(list(backend._buckets.keys()), ['b', 'c'])
+
+    def test_cache_backend(self):
+        self._test_backend(CacheBackend())
+
+    def test_coalescer(self):
+        coalescer = RequestCoalescer()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def render():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'result'
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(coalescer.do('key', render)))
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=lambda: results.append(coalescer.do('key', render)))
+                     for i in range(3)]
+        for thread in followers:
+            thread.start()
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+        self.assertEqual(results, ['result'] * 4)
+        self.assertEqual(len(calls), 1)
+        # calls made after the first one completed run again
+        self.assertEqual(coalescer.do('key', render), 'result')
+        self.assertEqual(len(calls), 2)
+
+    def test_coalescer_error(self):
+        coalescer = RequestCoalescer()
+        with self.assertRaises(ValueError):
+            coalescer.do('key', int, 'invalid')
+        self.assertEqual(coalescer._calls, {})
+
+    @mock.patch.object(app_settings, 'RATE_LIMIT_BACKEND', MEMORY_BACKEND)
+    @mock.patch.object(app_settings, 'RATE_LIMIT_DEVICE', (2, 60))
+    def test_device_rate_limit(self):
+        c = self._create_config(organization=self._create_org())
+        url = reverse('controller:checksum', args=[c.device.pk])
+        for i in range(2):
+            response = self.client.get(url, {'key': c.device.key})
+            self.assertEqual(response.status_code, 200)
+        response = self.client.get(url, {'key': c.device.key})
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        url = reverse('controller:download_config', args=[c.device.pk])
+        response = self.client.get(url, {'key': c.device.key})
+        self.assertEqual(response.status_code, 429)
+        response = self.client.post(reverse('controller:checksum_batch'),
+                                    {'device': '{0}:{1}'.format(c.device.pk, c.device.key)})
+        self.assertEqual(response.content.decode(), '{0} 429\n'.format(c.device.pk))
+
+    @mock.patch.object(app_settings, 'RATE_LIMIT_BACKEND', MEMORY_BACKEND)
+    @mock.patch.object(app_settings, 'RATE_LIMIT_ORGANIZATION', (3, 60))
+    def test_organization_rate_limit(self):
+        org = self._create_org()
+        c1 = self._create_config(organization=org)
+        d2 = self._create_device(name='device2',
+                                 organization=org,
+                                 mac_address='00:11:22:33:44:66',
+                                 key='device2key')
+        c2 = self._create_config(device=d2, organization=org)
+        for c in [c1, c2, c1]:
+            url = reverse('controller:checksum', args=[c.device.pk])
+            response = self.client.get(url, {'key': c.device.key})
+            self.assertEqual(response.status_code, 200)
+        url = reverse('controller:report_status', args=[c2.device.pk])
+        response = self.client.post(url, {'key': c2.device.key, 'status': 'running'})
+        self.assertEqual(response.status_code, 429)
+
+    @mock.patch.object(app_settings, 'RATE_LIMIT_BACKEND', MEMORY_BACKEND)
+    @mock.patch.object(app_settings, 'RATE_LIMIT_DEVICE', (2, 60))
+    @mock.patch.object(app_settings, 'RATE_LIMIT_ORGANIZATION', (2, 60))
+    @mock.patch.object(app_settings, 'RATE_LIMIT_FAILED_AUTH', (2, 60))
+    @mock.patch('openwisp_controller.config.throttling._backend', None)
+    def test_failed_auth_rate_limit(self):
+        c = self._create_config(organization=self._create_org())
+        url = reverse('controller:checksum', args=[c.device.pk])
+        # requests with a wrong key don't consume the tokens of the device
+        for status in [403, 403, 429]:
+            response = self.client.get(url, {'key': 'wrong'})
+            self.assertEqual(response.status_code, status)
+        response = self.client.post(reverse('controller:report_status', args=[c.device.pk]),
+                                    {'key': 'wrong', 'status': 'running'})
+        self.assertEqual(response.status_code, 429)
+        response = self.client.post(reverse('controller:checksum_batch'),
+                                    {'device': '{0}:wrong'.format(c.device.pk)})
+        self.assertEqual(response.content.decode(), '{0} 429\n'.format(c.device.pk))
+        for i in range(2):
+            response = self.client.get(url, {'key': c.device.key})
+            self.assertEqual(response.status_code, 200)
+        response = self.client.get(url, {'key': c.device.key})
+        self.assertEqual(response.status_code, 429)
@@ -1,16 +1,24 @@
+import json
+
+import mock
 from django.test import TestCase
 from django.urls import reverse
 
 from openwisp_users.tests.utils import TestOrganizationMixin
 
 from . import CreateConfigTemplateMixin
+from ... import metrics
 from ...tests.utils import TestAdminMixin
-from ..models import Template
+from .. import settings as app_settings
+from ..models import Config, Device, Template
 
 
 class TestTemplate(CreateConfigTemplateMixin, TestAdminMixin,
                    TestOrganizationMixin, TestCase):
+    config_model = Config
+    device_model = Device
     template_model = Template
+    operator_permission_filters = [{'codename__endswith': 'device'}]
 
     def _create_template_test_data(self):
         org1 = self._create_org(name='org1')
@@ -35,6 +43,7 @@ class TestTemplate(CreateConfigTemplateMixin, TestAdminMixin,
         self.assertEqual(len(templates), 2)
         self.assertIn(str(t1.pk), templates)
         self.assertIn(str(t3.pk), templates)
+        self.assertEqual(response.json()['names'][str(t1.pk)], t1.name)
         response = self.client.get(reverse('config:get_default_templates',
                                            args=[org2.pk]))
         templates = response.json()['default_templates']
@@ -66,3 +75,185 @@ class TestTemplate(CreateConfigTemplateMixin, TestAdminMixin,
         response = self.client.get(reverse('config:get_default_templates',
                                            args=['wrong']))
         self.assertEqual(response.status_code, 404)
+
+    def _bulk_assign(self, devices, templates):
+        return self.client.post(reverse('config:bulk_assign_templates'),
+                                json.dumps({'devices': [str(d.pk) for d in devices],
+                                            'templates': [str(t.pk) for t in templates]}),
+                                content_type='application/json')
+
+    def test_bulk_assign_templates(self):
+        org1, org2, t1, t2, t3, inactive_org, inactive_t = self._create_template_test_data()
+        c1 = self._create_config(organization=org1)
+        self._login()
+        response = self._bulk_assign([c1.device], [t3, t1])
+        self.assertEqual(response.json(), {'updated': 1})
+        self.assertEqual(list(c1.templates.all()), [t3, t1])
+        response = self._bulk_assign([c1.device], [t2])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(c1.device.name, response.json()['errors'])
+        self.assertEqual(list(c1.templates.all()), [t3, t1])
+        response = self._bulk_assign([c1.device], [t1, t3, t1])
+        self.assertEqual(response.json(), {'updated': 1})
+        self.assertEqual(list(c1.templates.all()), [t1, t3])
+
+    def test_bulk_assign_templates_operator(self):
+        org1, org2, t1, t2, t3, inactive_org, inactive_t = self._create_template_test_data()
+        c1 = self._create_config(organization=org1)
+        templates = list(c1.templates.all())
+        self._create_operator(organizations=[org2])
+        self._login(username='operator')
+        # templates and devices of other organizations are not visible
+        response = self._bulk_assign([c1.device], [t1])
+        self.assertEqual(response.status_code, 400)
+        response = self._bulk_assign([c1.device], [t3])
+        self.assertEqual(response.json(), {'updated': 0})
+        self.assertEqual(list(c1.templates.all()), templates)
+
+    def test_bulk_assign_templates_errors(self):
+        path = reverse('config:bulk_assign_templates')
+        response = self.client.post(path, '{}', content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+        self._login()
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 405)
+        response = self.client.post(path, '{"devices": []}', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(path, json.dumps({'devices': [], 'templates': ['wrong']}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def _create_device_list_data(self):
+        org1 = self._create_org(name='org1', slug='org1')
+        org2 = self._create_org(name='org2', slug='org2')
+        self._create_configs(org1)
+        self._create_device(name='device3', mac_address='00:11:22:33:44:03', organization=org2)
+        return org1, org2
+
+    def test_device_list(self):
+        org1, org2 = self._create_device_list_data()
+        path = reverse('config:device_list')
+        self._login()
+        with mock.patch.object(app_settings, 'DEVICE_LIST_PAGE_SIZE', 2):
+            response = self.client.get(path, {'limit': 10})
+        data = response.json()
+        self.assertEqual([d['name'] for d in data['results']], ['device0', 'device1'])
+        device = Device.objects.get(name='device0')
+        self.assertEqual(data['results'][0], {
+            'id': str(device.pk),
+            'name': 'device0',
+            'mac_address': '00:11:22:33:44:00',
+            'organization': 'org1',
+            'backend': device.config.backend,
+            'status': 'modified',
+            'last_ip': None,
+            'checksum': None,
+        })
+        response = self.client.get(data['next'])
+        data = response.json()
+        self.assertEqual([d['name'] for d in data['results']], ['device2', 'device3'])
+        self.assertIsNone(data['next'])
+        # devices without configuration
+        self.assertIsNone(data['results'][1]['backend'])
+        self.assertIsNone(data['results'][1]['checksum'])
+
+    def test_device_list_checksum(self):
+        self._create_device_list_data()
+        device = Device.objects.get(name='device0')
+        Device.get_auth_data(str(device.pk))
+        self._login()
+        response = self.client.get(reverse('config:device_list'), {'name': 'device0'})
+        self.assertEqual(response.json()['results'][0]['checksum'], device.config.checksum)
+
+    def test_device_list_filters(self):
+        org1, org2 = self._create_device_list_data()
+        path = reverse('config:device_list')
+        self._login()
+        for params, names in [({'organization': 'org2'}, ['device3']),
+                              ({'name': 'device'}, ['device0', 'device1', 'device2', 'device3']),
+                              ({'name': 'device1'}, ['device1']),
+                              ({'mac_address': '00:11:22:33:44:02'}, ['device2']),
+                              ({'status': 'modified', 'limit': 1}, ['device0']),
+                              ({'backend': 'netjsonconfig.OpenWisp'}, []),
+                              ({'search': '00:11:22:33:44:03'}, ['device3']),
+                              ({'search': 'DEVICE 112233440'}, ['device0', 'device1', 'device2', 'device3'])]:
+            response = self.client.get(path, params)
+            self.assertEqual([d['name'] for d in response.json()['results']], names)
+        response = self.client.get(path, {'status': 'modified', 'limit': 1})
+        response = self.client.get(response.json()['next'])
+        self.assertEqual([d['name'] for d in response.json()['results']], ['device1'])
+
+    def test_device_list_operator(self):
+        org1, org2 = self._create_device_list_data()
+        self._create_operator(organizations=[org2])
+        self._login(username='operator')
+        response = self.client.get(reverse('config:device_list'))
+        self.assertEqual([d['name'] for d in response.json()['results']], ['device3'])
+
+    def test_device_list_errors(self):
+        path = reverse('config:device_list')
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 403)
+        self._login()
+        for params in [{'limit': 'wrong'}, {'limit': 0}, {'cursor': '_w'}]:
+            response = self.client.get(path, params)
+            self.assertEqual(response.status_code, 400, params)
+
+    def test_device_list_queries(self):
+        self._create_device_list_data()
+        self._login()
+        path = reverse('config:device_list')
+        # session, user, devices
+        with self.assertNumQueries(3):
+            response = self.client.get(path)
+        self.assertEqual(len(response.json()['results']), 4)
+
+    def test_metrics(self):
+        path = reverse('config:metrics')
+        config = self._create_config(organization=self._create_org())
+        config.generate()
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 403)
+        self._login()
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        content = response.content.decode()
+        self.assertIn('# TYPE openwisp_controller_config_render_duration_seconds histogram', content)
+        self.assertIn('openwisp_controller_config_render_duration_seconds_bucket'
+                      '{backend="netjsonconfig.OpenWrt",le="+Inf"}', content)
+
+    def test_metrics_token(self):
+        path = reverse('config:metrics')
+        response = self.client.get(path, HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 403)
+        with mock.patch.object(app_settings, 'METRICS_TOKEN', 'secret'):
+            response = self.client.get(path, HTTP_AUTHORIZATION='Bearer wrong')
+            self.assertEqual(response.status_code, 403)
+            response = self.client.get(path, HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 200)
+
+    def test_metrics_format(self):
+        registry = metrics.Registry()
+        counter = metrics.Counter('test_total', 'Test counter', ['view'], registry)
+        histogram = metrics.Histogram('test_seconds', 'Test histogram', registry=registry,
+                                      buckets=(0.1, 1, float('inf')))
+        counter.inc(view='a"b')
+        counter.inc(2, view='a"b')
+        histogram.observe(0.5)
+        self.assertEqual(counter.get(view='a"b'), 3)
+        self.assertEqual(histogram.get(), (1, 0.5))
+        self.assertEqual(registry.expose(), '\n'.join([
+            '# HELP test_total Test counter',
+            '# TYPE test_total counter',
+            'test_total{view="a\\"b"} 3.0',
+            '# HELP test_seconds Test histogram',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="0.1"} 0',
+            'test_seconds_bucket{le="1.0"} 1',
+            'test_seconds_bucket{le="+Inf"} 1',
+            'test_seconds_count 1',
+            'test_seconds_sum 0.5',
+        ]) + '\n')
+        with self.assertRaises(ValueError):
+            counter.inc(status=200)
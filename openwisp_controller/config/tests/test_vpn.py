@@ -1,17 +1,31 @@
+from datetime import timedelta
+
+import mock
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db.models.signals import post_save
 from django.test import TestCase
+from django.utils import timezone
+from django.utils.six import StringIO
 
 from openwisp_users.tests.utils import TestOrganizationMixin
 
-from . import TestVpnX509Mixin
+from . import CreateConfigTemplateMixin, TestVpnX509Mixin
+from .. import settings as app_settings
 from ...pki.models import Ca, Cert
-from ..models import Vpn
+from ..cache import get_cache
+from ..dh import dh_pool
+from ..models import Config, Device, Template, Vpn, VpnClient
 
 
-class TestVpn(TestOrganizationMixin, TestVpnX509Mixin, TestCase):
+class TestVpn(TestOrganizationMixin, CreateConfigTemplateMixin,
+              TestVpnX509Mixin, TestCase):
     ca_model = Ca
     cert_model = Cert
     vpn_model = Vpn
+    config_model = Config
+    device_model = Device
+    template_model = Template
 
     def test_vpn_with_org(self):
         org = self._create_org()
@@ -55,3 +69,197 @@ class TestVpn(TestOrganizationMixin, TestVpnX509Mixin, TestCase):
             self.assertIn('related certificate match', e.message_dict['organization'][0])
         else:
             self.fail('ValidationError not raised')
+
+    def test_renew_expiring_certs(self):
+        vpnclient = VpnClient.objects.get(config=self._create_vpn_configs()[1][0])
+        cert = vpnclient.cert
+        Cert.objects.filter(pk=cert.pk).update(validity_end=timezone.now() + timedelta(days=3))
+        Config.objects.filter(pk=vpnclient.config_id).update(status='running')
+        self.assertEqual(VpnClient.renew_expiring_certs(days=30), 1)
+        cert.refresh_from_db()
+        self.assertGreater(cert.validity_end, timezone.now() + timedelta(days=30))
+        self.assertEqual(Config.objects.get(pk=vpnclient.config_id).status, 'modified')
+        self.assertEqual(VpnClient.renew_expiring_certs(days=30), 0)
+
+    def test_renew_expiring_certs_command(self):
+        vpnclient = VpnClient.objects.get(config=self._create_vpn_configs()[1][0])
+        Cert.objects.filter(pk=vpnclient.cert_id).update(validity_end=timezone.now() + timedelta(days=3))
+        out = StringIO()
+        call_command('renew_expiring_certs', days=30, chunk_size=1, stdout=out)
+        self.assertIn('Renewed 1 certificates', out.getvalue())
+
+    @mock.patch.object(app_settings, 'DH_POOL_SIZE', 0)
+    def test_vpn_dh_pending(self):
+        vpn = self._create_vpn(dh='')
+        self.assertTrue(vpn.dh_pending)
+        self.assertTrue(Vpn.objects.get(pk=vpn.pk).dh_pending)
+        self.assertEqual(Vpn.objects.get(pk=vpn.pk).dh, '')
+        modified = vpn.modified
+        handler = mock.Mock()
+        post_save.connect(handler, sender=Vpn, dispatch_uid='test_vpn_dh_pending')
+        self.addCleanup(post_save.disconnect, sender=Vpn, dispatch_uid='test_vpn_dh_pending')
+        with mock.patch.object(Vpn, 'dhparam', return_value=self._dh):
+            Vpn.generate_dh(vpn.pk)
+        vpn.refresh_from_db()
+        self.assertFalse(vpn.dh_pending)
+        self.assertEqual(vpn.dh, self._dh)
+        self.assertGreater(vpn.modified, modified)
+        self.assertEqual(handler.call_count, 1)
+        # nothing is done once the parameters have been generated
+        with mock.patch.object(Vpn, 'dhparam') as dhparam:
+            Vpn.generate_dh(vpn.pk)
+        dhparam.assert_not_called()
+
+    @mock.patch.object(app_settings, 'DH_POOL_SIZE', 0)
+    def test_vpn_dh_pending_set_manually(self):
+        vpn = self._create_vpn(dh='')
+        vpn.dh = self._dh
+        vpn.save()
+        self.assertFalse(Vpn.objects.get(pk=vpn.pk).dh_pending)
+
+    @mock.patch.object(app_settings, 'DH_POOL_SIZE', 0)
+    def test_vpn_dh_job_not_duplicated(self):
+        vpn = self._create_vpn(dh='')
+        with mock.patch('openwisp_controller.config.executor.LocalExecutor.submit') as submit:
+            self.assertTrue(Vpn.schedule_dh(vpn.pk))
+            self.assertFalse(Vpn.schedule_dh(vpn.pk))
+        self.assertEqual(submit.call_count, 1)
+        # the job releases its key when it ends
+        with mock.patch.object(Vpn, 'dhparam', return_value=self._dh):
+            submit.call_args[0][0]()
+        self.assertFalse(Vpn.objects.get(pk=vpn.pk).dh_pending)
+        with mock.patch('openwisp_controller.config.executor.LocalExecutor.submit') as submit:
+            self.assertTrue(Vpn.schedule_dh(vpn.pk))
+
+    @mock.patch.object(app_settings, 'DH_POOL_SIZE', 0)
+    def test_generate_pending_dh_command(self):
+        vpn = self._create_vpn(dh='')
+        out = StringIO()
+        with mock.patch.object(Vpn, 'dhparam', return_value=self._dh):
+            call_command('generate_pending_dh', stdout=out)
+        self.assertIn('Generated DH parameters of 1 VPN servers', out.getvalue())
+        self.assertEqual(Vpn.objects.get(pk=vpn.pk).dh, self._dh)
+
+    @mock.patch.object(app_settings, 'DH_POOL_SIZE', 0)
+    def test_vpn_dh_from_pool(self):
+        dh_pool.put(app_settings.DH_LENGTH, self._dh)
+        vpn = self._create_vpn(dh='')
+        self.assertFalse(vpn.dh_pending)
+        self.assertEqual(vpn.dh, self._dh)
+
+    @mock.patch.object(app_settings, 'DH_ASYNC', False)
+    def test_vpn_dh_sync(self):
+        with mock.patch.object(Vpn, 'dhparam', return_value=self._dh) as dhparam:
+            vpn = self._create_vpn(dh='')
+        dhparam.assert_called_once_with(1024)
+        self.assertEqual(vpn.dh, self._dh)
+
+    @mock.patch.object(app_settings, 'EXECUTOR', 'openwisp_controller.config.executor.SyncExecutor')
+    def test_dh_pool_fill(self):
+        generator = mock.Mock(return_value=self._dh)
+        dh_pool.fill(2048, generator, size=2)
+        self.assertEqual(dh_pool.size(2048), 2)
+        generator.assert_called_with(2048)
+        dh_pool.fill(2048, generator, size=2)
+        self.assertEqual(generator.call_count, 2)
+        self.assertEqual(dh_pool.get(2048), self._dh)
+        self.assertEqual(dh_pool.get(2048), self._dh)
+        self.assertIsNone(dh_pool.get(2048))
+
+    def test_vpn_template_reverse_add(self):
+        template, configs = self._create_vpn_configs(count=3, add_template=False)
+        Config.objects.update(status='applied')
+        template.config_relations.add(*configs)
+        self.assertEqual(VpnClient.objects.count(), 3)
+        self.assertEqual(Config.objects.filter(status='modified').count(), 3)
+        for client in VpnClient.objects.select_related('cert', 'config__device'):
+            self.assertTrue(client.auto_cert)
+            self.assertEqual(client.cert.organization, template.organization)
+            self.assertEqual(client.cert.ca, template.vpn.ca)
+            self.assertEqual(client.cert.name, client.config.device.name)
+            self.assertIn('BEGIN CERTIFICATE', client.cert.certificate)
+        serials = set(Cert.objects.filter(vpnclient__isnull=False).values_list('serial_number', flat=True))
+        self.assertEqual(len(serials), 3)
+        # adding the same relations again is a no-op
+        template.config_relations.add(*configs)
+        self.assertEqual(VpnClient.objects.count(), 3)
+
+    def test_vpn_template_reverse_remove(self):
+        template, configs = self._create_vpn_configs(count=3, add_template=False)
+        template.config_relations.add(*configs)
+        template.config_relations.remove(configs[0])
+        self.assertEqual(VpnClient.objects.count(), 2)
+        self.assertFalse(VpnClient.objects.filter(config=configs[0]).exists())
+        template.config_relations.clear()
+        self.assertEqual(VpnClient.objects.count(), 0)
+        # certificates of auto_cert clients are deleted too
+        self.assertEqual(Cert.objects.filter(name__startswith='device').count(), 0)
+
+    def test_vpn_template_reverse_add_different_organization(self):
+        template, configs = self._create_vpn_configs(add_template=False)
+        org2 = self._create_org(name='org2', slug='org2')
+        config = self._create_config(organization=org2)
+        with self.assertRaises(ValidationError):
+            template.config_relations.add(config)
+
+    def test_vpn_template_reverse_add_invalid_cert(self):
+        template, configs = self._create_vpn_configs(add_template=False)
+        # the common name of the certificate would be too long
+        Device.objects.filter(pk=configs[0].device_id).update(name='a' * 60)
+        configs = Config.objects.select_related('device').filter(pk=configs[0].pk)
+        with self.assertRaises(ValidationError):
+            VpnClient.bulk_create_clients(configs, [template])
+        self.assertFalse(VpnClient.objects.exists())
+        self.assertFalse(Cert.objects.filter(vpnclient__isnull=False).exists())
+
+    def test_bulk_create_clients_cache_invalidation(self):
+        template, configs = self._create_vpn_configs(add_template=False)
+        config = configs[0]
+        Device.get_auth_data(str(config.device_id))
+        auth_key = Device.get_auth_cache_key(config.device_id)
+        self.assertIsNotNone(get_cache().get(auth_key))
+        clients = VpnClient.bulk_create_clients([config], [template])
+        self.assertEqual(len(clients), 1)
+        self.assertIsNone(get_cache().get(auth_key))
+        # the cached context of the other VPN clients of the config is discarded
+        context_key = VpnClient.get_context_cache_key(VpnClient.objects.get().pk)
+        get_cache().set(context_key, 'cached')
+        org = template.organization
+        template2 = self._create_template(name='vpn-test2',
+                                          type='vpn',
+                                          vpn=self._create_vpn(name='vpn2', organization=org),
+                                          auto_cert=True,
+                                          organization=org)
+        VpnClient.bulk_create_clients([config], [template2])
+        self.assertIsNone(get_cache().get(context_key))
+
+    def test_related_auth_cache_invalidation(self):
+        template, configs = self._create_vpn_configs(count=2)
+        org2 = self._create_org(name='org2', slug='org2')
+        other = self._create_config(device=self._create_device(name='other',
+                                                               mac_address='00:11:22:33:44:99',
+                                                               organization=org2),
+                                    organization=org2)
+        pks = [str(config.device_id) for config in configs + [other]]
+        Device.get_many_auth_data(pks)
+        client = VpnClient.objects.get(config=configs[0])
+        client.cert.renew()
+        # only the device of the renewed certificate is affected
+        self.assertEqual(set(Device.get_cached_auth_data(pks).keys()), set(pks[1:]))
+        Device.get_many_auth_data(pks)
+        template.vpn.save()
+        self.assertEqual(set(Device.get_cached_auth_data(pks).keys()), {pks[2]})
+        Device.get_many_auth_data(pks)
+        template.organization.save()
+        self.assertEqual(set(Device.get_cached_auth_data(pks).keys()), {pks[2]})
+        Device.get_many_auth_data(pks)
+        # relations are looked up before they are deleted
+        template.delete()
+        self.assertEqual(set(Device.get_cached_auth_data(pks).keys()), {pks[2]})
+
+    def test_vpn_template_forward_add(self):
+        template, configs = self._create_vpn_configs(add_template=False)
+        configs[0].templates.add(template)
+        client = VpnClient.objects.get()
+        self.assertEqual(client.config, configs[0])
+        self.assertEqual(client.cert.organization, template.organization)
@@ -0,0 +1,159 @@
+"""
+Protection of the controller views from misbehaving devices:
+token bucket rate limiters and coalescing of concurrent requests
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.utils.module_loading import import_string
+
+from . import settings as app_settings
+from .cache import get_cache, get_cache_key
+
+
+def _consume(state, limit, period, now):
+    """
+    token bucket algorithm: ``limit`` tokens are refilled
+    every ``period`` seconds, each request consumes a token;
+    returns ``(state, retry_after)``, where ``retry_after``
+    is ``0`` if the request is allowed
+    """
+    rate = float(limit) / period
+    if state is None:
+        tokens = float(limit)
+    else:
+        tokens, last = state
+        tokens = min(float(limit), tokens + (now - last) * rate)
+    if tokens >= 1:
+        return (tokens - 1, now), 0
+    return (tokens, now), (1 - tokens) / rate
+
+
+class MemoryBackend(object):
+    """
+    keeps buckets in the memory of the current process,
+    least recently used buckets are discarded after ``max_size``
+    """
+    max_size = 100000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def consume(self, key, limit, period):
+        with self._lock:
+            state, retry_after = _consume(self._buckets.pop(key, None), limit, period, time.time())
+            self._buckets[key] = state
+            if len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+
+class CacheBackend(object):
+    """
+    keeps buckets in ``OPENWISP_CONTROLLER_CACHE``, so that
+    limits are shared between processes; updates are not atomic,
+    concurrent requests may occasionally consume the same token
+    """
+    def consume(self, key, limit, period):
+        cache = get_cache()
+        key = get_cache_key('ratelimit', key)
+        state, retry_after = _consume(cache.get(key), limit, period, time.time())
+        cache.set(key, state, period)
+        return retry_after
+
+
+_backend = None
+
+
+def get_rate_limit_backend():
+    """
+    returns the instance of ``OPENWISP_CONTROLLER_RATE_LIMIT_BACKEND``
+    (instantiated once per process, buckets of ``MemoryBackend``
+    live in the instance)
+    """
+    global _backend
+    path = app_settings.RATE_LIMIT_BACKEND
+    if _backend is None or _backend[0] != path:
+        _backend = (path, import_string(path)())
+    return _backend[1]
+
+
+def check_rate_limit(device_pk, organization_pk=None):
+    """
+    consumes a token from the buckets of the device and of its
+    organization (limits are defined in ``OPENWISP_CONTROLLER_RATE_LIMIT_DEVICE``
+    and ``OPENWISP_CONTROLLER_RATE_LIMIT_ORGANIZATION``); returns the number
+    of seconds after which the request can be retried if a limit has been
+    exceeded, ``0`` otherwise
+    """
+    buckets = [('device:{0}'.format(device_pk), app_settings.RATE_LIMIT_DEVICE)]
+    if organization_pk is not None:
+        buckets.append(('organization:{0}'.format(organization_pk),
+                        app_settings.RATE_LIMIT_ORGANIZATION))
+    backend = get_rate_limit_backend()
+    for key, limit in buckets:
+        if not limit:
+            continue
+        retry_after = backend.consume(key, *limit)
+        if retry_after:
+            return retry_after
+    return 0
+
+
+def check_failed_auth_rate_limit(address):
+    """
+    consumes a token from the bucket of the failed authentications
+    of ``address`` (limit defined in ``OPENWISP_CONTROLLER_RATE_LIMIT_FAILED_AUTH``),
+    which is separate from the buckets of devices and organizations, so that
+    requests with wrong keys can't exhaust the tokens of the devices they target;
+    returns values like ``check_rate_limit``
+    """
+    limit = app_settings.RATE_LIMIT_FAILED_AUTH
+    if not limit:
+        return 0
+    return get_rate_limit_backend().consume('failed-auth:{0}'.format(address), *limit)
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class RequestCoalescer(object):
+    """
+    runs only once the function passed to ``do`` for concurrent
+    calls with the same key: the first caller runs it, the other
+    callers wait and get the same result (or exception)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+
+coalescer = RequestCoalescer()
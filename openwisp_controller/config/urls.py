@@ -6,4 +6,13 @@ urlpatterns = [
     url(r'^config/get-default-templates/(?P<organization_id>[^/]+)/$',
         views.get_default_templates,
         name='get_default_templates'),
+    url(r'^config/bulk-assign-templates/$',
+        views.bulk_assign_templates,
+        name='bulk_assign_templates'),
+    url(r'^config/api/devices/$',
+        views.device_list,
+        name='device_list'),
+    url(r'^config/metrics/$',
+        views.metrics,
+        name='metrics'),
 ]
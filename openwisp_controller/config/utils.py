@@ -1,3 +1,5 @@
+import re
+
 from django.db.models import Q
 
 
@@ -15,3 +17,42 @@ def get_default_templates_queryset(organization_id, queryset=None, model=None):
     queryset = queryset.filter(Q(organization_id=organization_id) |
                                Q(organization_id=None))
     return queryset
+
+
+def normalize_mac_address(mac_address):
+    """
+    returns the hexadecimal digits of ``mac_address`` in lowercase,
+    without separators (eg: ``00:11:22:AA:BB:CC`` and ``00-11-22-aa-bb-cc``
+    are both normalized to ``001122aabbcc``)
+    """
+    return re.sub('[^0-9a-f]', '', (mac_address or '').lower())
+
+
+def get_search_text(name, mac_address, last_ip=None):
+    """
+    returns the text stored in the ``search`` field of devices:
+    lowercase name, mac address (also without separators) and
+    last ip, see ``Device.get_search_query``
+    """
+    mac_address = (mac_address or '').lower()
+    parts = [(name or '').lower(), mac_address, re.sub('[^0-9a-f]', '', mac_address)]
+    if last_ip:
+        parts.append(last_ip.lower())
+    return ' '.join(parts)[:255]
+
+
+def chunked_queryset(queryset, chunk_size):
+    """
+    Iterates over ``queryset`` yielding lists of at most ``chunk_size``
+    objects; uses keyset pagination on the primary key, so that each
+    chunk is a short query regardless of how large the table is.
+    """
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        qs = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        chunk = list(qs[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1].pk
@@ -1,9 +1,19 @@
-from django.http import HttpResponse, JsonResponse
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseNotAllowed, JsonResponse
+from django.utils.crypto import constant_time_compare
+from django.utils.encoding import force_bytes, force_text
+from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
 from django_netjsonconfig.utils import get_object_or_404
 
 from openwisp_users.models import Organization
 
-from .models import Template
+from .. import metrics as metrics_registry
+from . import settings as app_settings
+from .models import Config, Device, Template
+from .replica import is_pinned, use_replica
 from .utils import get_default_templates_queryset
 
 
@@ -14,7 +24,142 @@ def get_default_templates(request, organization_id):
     user = request.user
     if not user.is_authenticated() and not user.is_staff:
         return HttpResponse(status=403)
+    if is_pinned():
+        return _get_default_templates(organization_id)
+    with use_replica():
+        return _get_default_templates(organization_id)
+
+
+def _get_default_templates(organization_id):
     org = get_object_or_404(Organization, pk=organization_id, is_active=True)
-    templates = get_default_templates_queryset(org.pk, model=Template).only('id')
+    templates = list(get_default_templates_queryset(org.pk, model=Template).only('id', 'name'))
     uuids = [str(t.pk) for t in templates]
-    return JsonResponse({'default_templates': uuids})
+    names = {str(t.pk): t.name for t in templates}
+    return JsonResponse({'default_templates': uuids, 'names': names})
+
+
+DEVICE_LIST_FIELDS = ('id', 'name', 'mac_address', 'organization', 'organization__slug',
+                      'config__id', 'config__device', 'config__backend', 'config__status',
+                      'config__last_ip')
+DEVICE_LIST_FILTERS = {
+    'organization': 'organization__slug',
+    'name': 'name__startswith',
+    'mac_address': 'mac_address',
+    'backend': 'config__backend',
+    'status': 'config__status',
+}
+
+
+def device_list(request):
+    """
+    returns the devices visible to the user ordered by name, in pages of
+    at most ``OPENWISP_CONTROLLER_DEVICE_LIST_PAGE_SIZE`` devices; the next
+    page is requested with the opaque ``cursor`` returned in ``next``;
+    supports the filters listed in ``DEVICE_LIST_FILTERS`` and ``search``
+    (see ``Device.get_search_query``); configurations
+    are not loaded, checksums are taken from the cached auth data
+    (``null`` if not cached)
+    """
+    user = request.user
+    if not user.is_authenticated() or not user.is_staff or not user.has_perm('config.change_device'):
+        return HttpResponse(status=403)
+    if is_pinned():
+        return _device_list(request)
+    with use_replica():
+        return _device_list(request)
+
+
+def _device_list(request):
+    devices = Device.objects.select_related('organization', 'config') \
+                            .only(*DEVICE_LIST_FIELDS) \
+                            .order_by('name')
+    if not request.user.is_superuser:
+        devices = devices.filter(organization__in=[pk for pk, in request.user.organizations_pk])
+    for param, lookup in DEVICE_LIST_FILTERS.items():
+        if request.GET.get(param):
+            devices = devices.filter(**{lookup: request.GET[param]})
+    if request.GET.get('search'):
+        devices = devices.filter(Device.get_search_query(request.GET['search']))
+    try:
+        limit = int(request.GET.get('limit') or app_settings.DEVICE_LIST_PAGE_SIZE)
+        if limit < 1:
+            raise ValueError()
+        if request.GET.get('cursor'):
+            devices = devices.filter(name__gt=force_text(urlsafe_base64_decode(request.GET['cursor'])))
+    except (ValueError, UnicodeDecodeError):
+        return JsonResponse({'errors': ['invalid limit or cursor']}, status=400)
+    limit = min(limit, app_settings.DEVICE_LIST_PAGE_SIZE)
+    # fetch one more device to know whether there's a next page
+    devices = list(devices[:limit + 1])
+    next_url = None
+    if len(devices) > limit:
+        devices = devices[:limit]
+        params = request.GET.copy()
+        params['cursor'] = force_text(urlsafe_base64_encode(force_bytes(devices[-1].name)))
+        next_url = '{0}?{1}'.format(request.path, params.urlencode())
+    auth_data = Device.get_cached_auth_data([str(device.pk) for device in devices])
+    results = []
+    for device in devices:
+        config = device.config if device._has_config() else None
+        results.append({
+            'id': str(device.pk),
+            'name': device.name,
+            'mac_address': device.mac_address,
+            'organization': device.organization.slug,
+            'backend': config and config.backend,
+            'status': config and config.status,
+            'last_ip': config and config.last_ip,
+            'checksum': auth_data.get(str(device.pk), {}).get('checksum'),
+        })
+    return JsonResponse({'results': results, 'next': next_url})
+
+
+def bulk_assign_templates(request):
+    """
+    replaces the templates of many devices (see ``Config.bulk_set_templates``),
+    expects a JSON body like ``{"devices": [<id>, ...], "templates": [<id>, ...]}``;
+    non superusers can change only the devices of their organizations
+    """
+    user = request.user
+    if not user.is_authenticated() or not user.is_staff or not user.has_perm('config.change_device'):
+        return HttpResponse(status=403)
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    try:
+        data = json.loads(request.body.decode())
+        device_pks = [str(pk) for pk in data['devices']]
+        template_pks = [str(pk) for pk in data['templates']]
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'errors': ['invalid request body']}, status=400)
+    configs = Config.objects.filter(device__in=device_pks)
+    templates = Template.objects.filter(pk__in=template_pks)
+    if not user.is_superuser:
+        orgs_pk = [pk for pk, in user.organizations_pk]
+        configs = configs.filter(organization__in=orgs_pk)
+        templates = templates.filter(Q(organization__in=orgs_pk) | Q(organization=None))
+    try:
+        templates = {str(t.pk): t for t in templates}
+        missing = [pk for pk in template_pks if pk not in templates]
+        if missing:
+            return JsonResponse({'errors': ['unknown templates: {0}'.format(', '.join(missing))]},
+                                status=400)
+        count = Config.bulk_set_templates(configs, [templates[pk] for pk in template_pks])
+    except ValidationError as e:
+        errors = e.message_dict if hasattr(e, 'error_dict') else e.messages
+        return JsonResponse({'errors': errors}, status=400)
+    return JsonResponse({'updated': count})
+
+
+def metrics(request):
+    """
+    returns the metrics of the current process in the Prometheus
+    text format; allowed to superusers and to scrapers which send
+    ``OPENWISP_CONTROLLER_METRICS_TOKEN`` as bearer token
+    """
+    token = app_settings.METRICS_TOKEN
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if not (token and constant_time_compare(authorization, 'Bearer {0}'.format(token))) \
+       and not (request.user.is_authenticated() and request.user.is_superuser):
+        return HttpResponse(status=403)
+    return HttpResponse(metrics_registry.registry.expose(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
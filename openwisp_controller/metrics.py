@@ -0,0 +1,176 @@
+"""
+Instrumentation of openwisp-controller: counters and histograms kept
+in an in-process registry and exposed in the Prometheus text format
+(see ``openwisp_controller.config.views.metrics``); each process has
+its own registry, like the default registry of the Prometheus clients
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, float('inf'))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ['{0}="{1}"'.format(name, str(value).replace('\\', '\\\\')
+                                                .replace('"', '\\"')
+                                                .replace('\n', '\\n'))
+             for name, value in labels]
+    return '{{{0}}}'.format(','.join(pairs))
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        if registry is not None:
+            registry.register(self)
+
+    def _get_key(self, labels):
+        if set(labels.keys()) != set(self.labelnames):
+            raise ValueError('{0} expects the labels: {1}'.format(self.name,
+                                                                  ', '.join(self.labelnames)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+
+    def expose(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.documentation),
+                 '# TYPE {0} {1}'.format(self.name, self.type)]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.extend(self._expose_value(list(zip(self.labelnames, key)), value))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def get(self, **labels):
+        return self._values.get(self._get_key(labels), 0)
+
+    def _expose_value(self, labels, value):
+        return ['{0}{1} {2}'.format(self.name, _format_labels(labels), _format_value(value))]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._get_key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0)
+            counts = list(counts)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        observes the duration of the ``with`` block
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def get(self, **labels):
+        """
+        returns ``(count, sum)`` of the observations
+        """
+        counts, total = self._values.get(self._get_key(labels)) or ([0] * len(self.buckets), 0)
+        return counts[-1], total
+
+    def _expose_value(self, labels, value):
+        counts, total = value
+        lines = []
+        for bound, count in zip(self.buckets, counts):
+            bucket_labels = labels + [('le', _format_value(bound))]
+            lines.append('{0}_bucket{1} {2}'.format(self.name, _format_labels(bucket_labels), count))
+        lines.append('{0}_count{1} {2}'.format(self.name, _format_labels(labels), counts[-1]))
+        lines.append('{0}_sum{1} {2}'.format(self.name, _format_labels(labels), _format_value(total)))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def clear(self):
+        """
+        resets the values of all the metrics
+        """
+        for metric in self._metrics:
+            metric.clear()
+
+    def expose(self):
+        """
+        returns the metrics in the Prometheus text format
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+controller_requests = Counter('openwisp_controller_requests_total',
+                              'Requests to the controller views',
+                              ['view', 'status'],
+                              registry)
+controller_request_duration = Histogram('openwisp_controller_request_duration_seconds',
+                                        'Duration of the requests to the controller views',
+                                        ['view'],
+                                        registry)
+registration_fast_path = Counter('openwisp_controller_registration_fast_path_total',
+                                 'Registrations of existing devices, by use of the fast path',
+                                 ['result'],
+                                 registry)
+cache_requests = Counter('openwisp_controller_cache_requests_total',
+                         'Lookups of cached data, by cache and result',
+                         ['cache', 'result'],
+                         registry)
+config_render_duration = Histogram('openwisp_controller_config_render_duration_seconds',
+                                   'Duration of the generation of configurations',
+                                   ['backend'],
+                                   registry)
+template_validation_duration = Histogram('openwisp_controller_template_validation_duration_seconds',
+                                         'Duration of the validation of the templates of configurations',
+                                         ['backend'],
+                                         registry)
+cert_generation_duration = Histogram('openwisp_controller_cert_generation_duration_seconds',
+                                     'Duration of the generation of keys and certificates',
+                                     ['model'],
+                                     registry)
@@ -3,13 +3,11 @@ from django_x509.base.admin import CaAdmin as BaseCaAdmin
 from django_x509.base.admin import CertAdmin as BaseCertAdmin
 from reversion.admin import VersionAdmin
 
-from openwisp_utils.admin import MultitenantOrgFilter
-
-from ..admin import MultitenantAdminMixin
+from ..admin import AutocompleteAdminMixin, MultitenantAdminMixin, MultitenantOrgFilter
 from .models import Ca, Cert
 
 
-class CaAdmin(MultitenantAdminMixin, VersionAdmin, BaseCaAdmin):
+class CaAdmin(MultitenantAdminMixin, AutocompleteAdminMixin, VersionAdmin, BaseCaAdmin):
     fields = ['name',
               'organization',
               'notes',
@@ -35,8 +33,9 @@ CaAdmin.list_filter.insert(0, ('organization', MultitenantOrgFilter))
 CaAdmin.list_display.insert(1, 'organization')
 
 
-class CertAdmin(MultitenantAdminMixin, VersionAdmin, BaseCertAdmin):
+class CertAdmin(MultitenantAdminMixin, AutocompleteAdminMixin, VersionAdmin, BaseCertAdmin):
     multitenant_shared_relations = ('ca',)
+    autocomplete_fields = ('ca',)
     fields = ['name',
               'organization',
               'ca',
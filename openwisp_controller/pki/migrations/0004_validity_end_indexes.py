@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pki', '0003_fill_organization_name'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ca',
+            index=models.Index(fields=['validity_end'], name='pki_ca_validity_end_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cert',
+            index=models.Index(fields=['validity_end'], name='pki_cert_validity_end_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 22:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pki', '0004_validity_end_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ca',
+            name='serial_number',
+            field=models.CharField(blank=True, help_text='leave blank to determine automatically', max_length=39, null=True, verbose_name='serial number'),
+        ),
+        migrations.AlterField(
+            model_name='cert',
+            name='serial_number',
+            field=models.CharField(blank=True, help_text='leave blank to determine automatically', max_length=39, null=True, verbose_name='serial number'),
+        ),
+    ]
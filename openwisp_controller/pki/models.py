@@ -1,16 +1,57 @@
+import uuid
+from datetime import timedelta
+
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
-from django_x509.base.models import AbstractCa, AbstractCert
+from django_x509.base.models import (AbstractCa, AbstractCert, default_cert_validity_end,
+                                     default_validity_start)
 
 from openwisp_users.mixins import ShareableOrgMixin
 
+from .. import metrics
+
+
+class X509QuerySet(models.QuerySet):
+    """
+    expiry lookups shared by ``Ca`` and ``Cert``,
+    backed by the index on ``validity_end``
+    """
+    def expired(self, now=None):
+        now = now or timezone.now()
+        return self.filter(validity_end__lt=now)
+
+    def expiring(self, days, now=None):
+        """
+        returns objects which are still valid
+        but will expire within ``days`` days
+        """
+        now = now or timezone.now()
+        return self.filter(validity_end__gte=now,
+                           validity_end__lt=now + timedelta(days=days))
+
+
+class CertQuerySet(X509QuerySet):
+    def expiring(self, days, now=None):
+        """
+        like ``X509QuerySet.expiring`` but excludes revoked certificates
+        """
+        return super(CertQuerySet, self).expiring(days, now).filter(revoked=False)
+
 
 class Ca(ShareableOrgMixin, AbstractCa):
     """
     openwisp-controller CA model
     """
+    objects = X509QuerySet.as_manager()
+
     class Meta(AbstractCa.Meta):
         abstract = False
+        indexes = [models.Index(fields=['validity_end'], name='pki_ca_validity_end_idx')]
+
+    def _generate(self):
+        with metrics.cert_generation_duration.time(model='ca'):
+            super(Ca, self)._generate()
 
 
 class Cert(ShareableOrgMixin, AbstractCert):
@@ -19,8 +60,29 @@ class Cert(ShareableOrgMixin, AbstractCert):
     """
     ca = models.ForeignKey(Ca, verbose_name=_('CA'))
 
+    objects = CertQuerySet.as_manager()
+
     class Meta(AbstractCert.Meta):
         abstract = False
+        indexes = [models.Index(fields=['validity_end'], name='pki_cert_validity_end_idx')]
 
     def clean(self):
         self._validate_org_relation('ca')
+
+    def _generate(self):
+        with metrics.cert_generation_duration.time(model='cert'):
+            super(Cert, self)._generate()
+
+    def renew(self):
+        """
+        regenerates key, certificate and serial number
+        of this certificate, resetting its validity period
+        """
+        self.validity_start = default_validity_start()
+        self.validity_end = default_cert_validity_end()
+        self.serial_number = str(uuid.uuid4().int)
+        self._generate()
+        # discard x509 objects cached from the previous certificate
+        for attr in ['x509', 'x509_text', 'pkey']:
+            self.__dict__.pop(attr, None)
+        self.save()
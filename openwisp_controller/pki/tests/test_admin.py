@@ -85,12 +85,18 @@ class TestAdmin(TestPkiMixin, TestAdminMixin,
     def test_cert_ca_fk_queryset(self):
         data = self._create_multitenancy_test_env()
         self._test_multitenant_admin(
-            url=reverse('admin:pki_cert_add'),
+            url=reverse('admin:pki_ca_autocomplete'),
             visible=[data['ca1'].name, data['ca_shared'].name],
-            hidden=[data['ca2'].name, data['ca_inactive'].name],
-            select_widget=True
+            hidden=[data['ca2'].name, data['ca_inactive'].name]
         )
 
+    def test_cert_ca_autocomplete_widget(self):
+        data = self._create_multitenancy_test_env()
+        self._login()
+        response = self.client.get(reverse('admin:pki_cert_add'))
+        self.assertContains(response, reverse('admin:pki_ca_autocomplete'))
+        self.assertNotContains(response, '{0}</option>'.format(data['ca1'].name))
+
     def test_cert_changeform_200(self):
         org = self._create_org(name='test-org')
         self._create_operator(organizations=[org])
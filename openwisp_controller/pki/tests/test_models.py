@@ -1,6 +1,9 @@
+from datetime import timedelta
+
 from django.core.exceptions import ValidationError
 from django.test import TestCase
 from django.urls import reverse
+from django.utils import timezone
 from OpenSSL import crypto
 
 from openwisp_users.tests.utils import TestOrganizationMixin
@@ -52,3 +55,24 @@ class TestModels(TestCase, TestPkiMixin, TestOrganizationMixin):
         crl = crypto.load_crl(crypto.FILETYPE_PEM, response.content)
         revoked_list = crl.get_revoked()
         self.assertIsNone(revoked_list)
+
+    def test_expiring_queryset(self):
+        ca = self._create_ca()
+        soon = self._create_cert(ca=ca, name='soon', validity_end=timezone.now() + timedelta(days=5))
+        self._create_cert(ca=ca, name='later', validity_end=timezone.now() + timedelta(days=60))
+        self._create_cert(ca=ca, name='expired', validity_end=timezone.now() - timedelta(days=1))
+        revoked = self._create_cert(ca=ca, name='revoked', validity_end=timezone.now() + timedelta(days=5))
+        revoked.revoke()
+        self.assertEqual(list(Cert.objects.expiring(days=30)), [soon])
+        self.assertEqual(Cert.objects.expired().count(), 1)
+        self.assertEqual(Ca.objects.expiring(days=30).count(), 0)
+
+    def test_cert_renew(self):
+        cert = self._create_cert(validity_end=timezone.now() + timedelta(days=5))
+        old_certificate = cert.certificate
+        old_serial_number = cert.serial_number
+        cert.renew()
+        cert.refresh_from_db()
+        self.assertNotEqual(cert.certificate, old_certificate)
+        self.assertNotEqual(cert.serial_number, old_serial_number)
+        self.assertEqual(Cert.objects.expiring(days=30).count(), 0)
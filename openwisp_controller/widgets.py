@@ -0,0 +1,60 @@
+import copy
+
+from django import forms
+from django.core.exceptions import ValidationError
+from django.utils.encoding import force_text
+from django.utils.html import format_html
+from sortedm2m.forms import SortedCheckboxSelectMultiple
+
+
+class AutocompleteMixin(object):
+    """
+    renders only the selected choices, the other
+    choices are loaded on demand from ``url``
+    by ``openwisp-controller/js/autocomplete.js``
+    """
+    class Media:
+        js = ('openwisp-controller/js/autocomplete.js',)
+
+    def __init__(self, url, *args, **kwargs):
+        self.url = url
+        super(AutocompleteMixin, self).__init__(*args, **kwargs)
+
+    def _get_selected_choices(self, value):
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        values = [force_text(v) for v in value if v not in (None, '')]
+        if not values:
+            return []
+        field = self.choices.field
+        try:
+            objects = {force_text(obj.pk): obj
+                       for obj in self.choices.queryset.filter(pk__in=values)}
+        # invalid values submitted with the form
+        except (ValueError, ValidationError):
+            return []
+        return [(pk, field.label_from_instance(objects[pk]))
+                for pk in values if pk in objects]
+
+
+class AutocompleteSelect(AutocompleteMixin, forms.Select):
+    def get_context(self, name, value, attrs):
+        widget = copy.copy(self)
+        widget.choices = self._get_selected_choices(value)
+        empty_label = self.choices.field.empty_label
+        if empty_label is not None:
+            widget.choices.insert(0, ('', empty_label))
+        attrs = dict(attrs or {}, **{'data-autocomplete-url': force_text(self.url)})
+        attrs['class'] = ' '.join(filter(None, [attrs.get('class'), 'autocomplete']))
+        return super(AutocompleteSelect, widget).get_context(name, value, attrs)
+
+
+class AutocompleteSortedCheckboxSelectMultiple(AutocompleteMixin, SortedCheckboxSelectMultiple):
+    def render(self, name, value, attrs=None, choices=(), renderer=None):
+        widget = copy.copy(self)
+        widget.choices = self._get_selected_choices(value or [])
+        html = super(AutocompleteSortedCheckboxSelectMultiple, widget).render(
+            name, value, attrs, renderer=renderer
+        )
+        return format_html('<div class="autocomplete-sortedm2m" data-autocomplete-url="{0}">{1}</div>',
+                           force_text(self.url), html)
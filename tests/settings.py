@@ -10,9 +10,17 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': 'openwisp-controller.db',
-    }
+    },
+    # used to test OPENWISP_CONTROLLER_DATABASE_REPLICA
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'openwisp-controller.db',
+        'TEST': {'MIRROR': 'default'},
+    },
 }
 
+DATABASE_ROUTERS = ['openwisp_controller.config.replica.ReplicaRouter']
+
 SECRET_KEY = 'fn)t*+$)ugeyip6-#txyy$5wf2ervc0d2n#h)qb)y5@ly$t*@w'
 
 INSTALLED_APPS = [